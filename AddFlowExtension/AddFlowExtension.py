@@ -54,6 +54,9 @@ class AddFlowExtensionWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
     self.logic = None
     self._parameterNode = None
     self._updatingGUIFromParameterNode = False
+    self.openBoundariesCheckBoxDict = {}
+    self.openBoundariesExtLengthDict = {}
+    self.previewNode = None
 
   def setup(self):
     """
@@ -89,6 +92,7 @@ class AddFlowExtensionWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
     self.ui.outputSurfaceSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.updateParameterNodeFromGUI)
     # Buttons
     self.ui.applyButton.connect('clicked(bool)', self.onApplyButton)
+    self.ui.previewCheckBox.connect('toggled(bool)', self.updatePreview)
 
     # Make sure parameter node is initialized (needed for module reload)
     self.initializeParameterNode()
@@ -99,6 +103,7 @@ class AddFlowExtensionWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
     Called when the application closes and the module widget is destroyed.
     """
     self.removeObservers()
+    self.removePreview()
 
   def enter(self):
     """
@@ -120,6 +125,7 @@ class AddFlowExtensionWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
     """
     # Parameter node will be reset, do not use it anymore
     self.setParameterNode(None)
+    self.removePreview()
 
   def onSceneEndClose(self, caller, event):
     """
@@ -225,38 +231,23 @@ class AddFlowExtensionWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
     """
     with slicer.util.tryWithErrorDisplay("Failed to compute results.", waitCursor=True):
 
-
-      from vtk.numpy_interface import dataset_adapter as dsa
-      
       # Compute output
       inputSurfacePolyData = self.logic.polyDataFromNode(self._parameterNode.GetNodeReference("InputSurface"))
       inputCenterlinePolyData = self.logic.polyDataFromNode(self._parameterNode.GetNodeReference("InputCenterline"))
       
       openBoundariesIds = self._parameterNode.GetNodeReference("OpenBoundariesIds")
 
-
-      # get the ids of the open boundaries to extend
-      outputSurfacePolyData = inputSurfacePolyData
-      for id in self.openBoundariesCheckBoxDict:
-        checkbox = self.openBoundariesCheckBoxDict[id]
-        if checkbox.checked:
-          # extend the open boundary
-          idPoint = openBoundariesIds.GetNthControlPointPosition(id)
-          
-          extensionLength = self.openBoundariesExtLengthDict[id].value
-
-          # while in the loop, once the surface is extended, the id of barycenters can change from the original id, so check which number it is now
-          # get the barycenters of the open boundaries of the current model
-          baryCenterPolyData = self.logic.getOpenBoundariesBarycenters(outputSurfacePolyData)
-          wrapper = dsa.WrapDataObject(baryCenterPolyData)
-          barycenterPoints = wrapper.Points
-          
-          # which barycenter is closes the the point with label id?
-          dist = (barycenterPoints[:,0]-idPoint[0])**2 + (barycenterPoints[:,1]-idPoint[1])**2 + (barycenterPoints[:,2]-idPoint[2])**2
-          pointIdx = np.argmin(dist)
-
-          outputSurfacePolyData = self.logic.addFlowExtensions(outputSurfacePolyData, inputCenterlinePolyData, [pointIdx],extensionLength)
+      # the labels are placed at the barycenters of the open boundaries, match them to the boundaries of the input surface
+      checkedIds = [id for id in self.openBoundariesCheckBoxDict if self.openBoundariesCheckBoxDict[id].checked]
+      labelPositions = np.array([openBoundariesIds.GetNthControlPointPosition(id) for id in checkedIds]).reshape(-1,3)
+      boundaryIds = self.logic.getOpenBoundaries(inputSurfacePolyData).findClosestBoundaries(labelPositions)
       
+      # extend all checked open boundaries at once
+      extensionRatios = {int(boundaryId): self.openBoundariesExtLengthDict[id].value for (boundaryId, id) in zip(boundaryIds, checkedIds)}
+      outputSurfacePolyData = self.logic.addFlowExtensionsToBoundaries(inputSurfacePolyData, inputCenterlinePolyData, extensionRatios)
+      
+      # the preview is replaced by the flow extensions
+      self.ui.previewCheckBox.checked = False
       
       if self.ui.addCapsCheckBox.checked:
         outputSurfacePolyData = self.logic.addCaps(outputSurfacePolyData)
@@ -337,6 +328,7 @@ class AddFlowExtensionWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
       newSpinBox.singleStep = 0.5
       newSpinBox.value = 5
       newSpinBox.enabled = False
+      newSpinBox.valueChanged.connect(lambda value: self.updatePreview())
       self.openBoundariesCheckBoxDict[id] = newCheckBox
       self.openBoundariesExtLengthDict[id] = newSpinBox
       layout.addWidget(newCheckBox,i,0) # add checkbox widget to layout
@@ -356,7 +348,146 @@ class AddFlowExtensionWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
     else:
       self.openBoundariesExtLengthDict[id].enabled = False
       #enable the spinbox
+    self.updatePreview()
+
+  def updatePreview(self):
+    # show straight tubes in place of the flow extensions of the checked open boundaries
+    if not self.ui.previewCheckBox.checked or self._parameterNode is None:
+      if self.previewNode and slicer.mrmlScene.IsNodePresent(self.previewNode):
+        self.previewNode.GetDisplayNode().SetVisibility(0)
+      return
+
+    inputSurfacePolyData = self.logic.polyDataFromNode(self._parameterNode.GetNodeReference("InputSurface"))
+    inputCenterlinePolyData = self.logic.polyDataFromNode(self._parameterNode.GetNodeReference("InputCenterline"))
+    openBoundariesIds = self._parameterNode.GetNodeReference("OpenBoundariesIds")
+    if not inputSurfacePolyData or not inputCenterlinePolyData or not openBoundariesIds:
+      return
+
+    checkedIds = [id for id in self.openBoundariesCheckBoxDict if self.openBoundariesCheckBoxDict[id].checked]
+    labelPositions = np.array([openBoundariesIds.GetNthControlPointPosition(id) for id in checkedIds]).reshape(-1,3)
+    boundaryIds = self.logic.getOpenBoundaries(inputSurfacePolyData).findClosestBoundaries(labelPositions)
+    extensionRatios = {int(boundaryId): self.openBoundariesExtLengthDict[id].value for (boundaryId, id) in zip(boundaryIds, checkedIds)}
+    previewPolyData = self.logic.createFlowExtensionsPreview(inputSurfacePolyData, inputCenterlinePolyData, extensionRatios)
+
+    # the preview node is not stored in the parameter node, so updating it does not rebuild the open boundaries
+    if not self.previewNode or not slicer.mrmlScene.IsNodePresent(self.previewNode):
+      self.previewNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLModelNode', 'flow_extensions_preview')
+      self.previewNode.CreateDefaultDisplayNodes()
+      self.previewNode.GetDisplayNode().SetColor(0.90,0.34,0.69)
+      self.previewNode.GetDisplayNode().SetOpacity(0.6)
+    self.previewNode.SetAndObserveMesh(previewPolyData)
+    self.previewNode.GetDisplayNode().SetVisibility(1)
+
+  def removePreview(self):
+    if self.previewNode and slicer.mrmlScene.IsNodePresent(self.previewNode):
+      slicer.mrmlScene.RemoveNode(self.previewNode)
+    self.previewNode = None
     
+#
+# OpenBoundaries
+#
+
+class OpenBoundaries:
+  """ Open boundaries of a surface, shared by the widget and the logic: the boundary loops (in the order of 
+  vtkvmtkPolyDataBoundaryExtractor, which is also the order of the boundary ids of the flow extensions filter) as CSR 
+  offsets/connectivity into the boundary points, and the barycenters, mean radii and normals of all boundaries.
+  Use OpenBoundaries.get to reuse the boundaries of a surface that was already extracted.
+  """
+
+  # recently extracted surfaces, a ClipBranches.PolyDataCache created on first use
+  cache = None
+
+  @classmethod
+  def get(cls, surfacePolyData):
+    """ OpenBoundaries of the polydata, extracted only once as long as the polydata is not modified """
+    if cls.cache is None:
+      import ClipBranches
+      cls.cache = ClipBranches.PolyDataCache(8)
+    return cls.cache.get(surfacePolyData, cls)
+
+  def __init__(self, surfacePolyData):
+    # based on code in https://github.com/vmtk/vmtk/blob/master/vmtkScripts/vmtkflowextensions.py
+    import vtkvmtkComputationalGeometryPython as vtkvmtkComputationalGeometry
+    from vtk.util import numpy_support
+
+    boundaryExtractor = vtkvmtkComputationalGeometry.vtkvmtkPolyDataBoundaryExtractor()
+    boundaryExtractor.SetInputData(surfacePolyData)
+    boundaryExtractor.Update()
+    boundaries = boundaryExtractor.GetOutput()
+
+    if boundaries.GetPoints():
+      self.points = numpy_support.vtk_to_numpy(boundaries.GetPoints().GetData()).astype(float)
+    else:
+      self.points = np.zeros((0,3))
+    lines = boundaries.GetLines()
+    self.offsets = numpy_support.vtk_to_numpy(lines.GetOffsetsArray()).astype(np.int64)
+    self.connectivity = numpy_support.vtk_to_numpy(lines.GetConnectivityArray()).astype(np.int64)
+    if self.offsets.size == 0:
+      self.offsets = np.zeros(1, dtype=np.int64)
+
+    # the boundary extractor stores the ids of the surface points as point scalars
+    self.surfacePointIds = None
+    if boundaries.GetPointData().GetScalars():
+      self.surfacePointIds = numpy_support.vtk_to_numpy(boundaries.GetPointData().GetScalars()).astype(np.int64)
+
+    self.computeGeometry()
+
+  @property
+  def numberOfBoundaries(self):
+    return self.offsets.shape[0] - 1
+
+  def getBoundaryPointIds(self, boundaryId):
+    """ ids of the boundary points (rows of points) of the boundary loop """
+    return self.connectivity[self.offsets[boundaryId]:self.offsets[boundaryId+1]]
+
+  def computeGeometry(self):
+    """ barycenters, mean radii and normals of all boundaries at once, computed the same way as 
+    vtkvmtkBoundaryReferenceSystems: the barycenter is the mean of the loop edge midpoints weighted by the edge lengths, 
+    the mean radius the mean distance of the loop points to the barycenter and the normal the normalized sum of the 
+    cross products of consecutive loop points relative to the barycenter
+    """
+    numberOfBoundaries = self.numberOfBoundaries
+    self.barycenters = np.zeros((numberOfBoundaries,3))
+    self.meanRadii = np.zeros(numberOfBoundaries)
+    self.normals = np.zeros((numberOfBoundaries,3))
+    loopSizes = np.diff(self.offsets)
+    valid = loopSizes > 0
+    if not np.any(valid):
+      return
+    starts = self.offsets[:-1][valid]
+
+    # each loop point and the next point of the loop, the last point is connected to the first
+    loopPoints = self.points[self.connectivity]
+    entryBoundaryIds = np.repeat(np.arange(numberOfBoundaries), loopSizes)
+    nextEntries = np.arange(1, self.connectivity.shape[0]+1)
+    nextEntries[self.offsets[1:][valid]-1] = starts
+    nextLoopPoints = loopPoints[nextEntries]
+
+    edgeLengths = np.linalg.norm(nextLoopPoints - loopPoints, axis=1)
+    weightSums = np.add.reduceat(edgeLengths, starts)
+    weightedMidpoints = np.add.reduceat(0.5*(loopPoints + nextLoopPoints)*edgeLengths[:,None], starts, axis=0)
+    # loops without length (e.g. a single point): use the mean of the points
+    pointSums = np.add.reduceat(loopPoints, starts, axis=0)
+    degenerate = weightSums < 1e-12
+    barycenters = np.where(degenerate[:,None], pointSums/loopSizes[valid][:,None], weightedMidpoints/np.where(degenerate, 1.0, weightSums)[:,None])
+    self.barycenters[valid] = barycenters
+
+    relativePoints = loopPoints - self.barycenters[entryBoundaryIds]
+    self.meanRadii[valid] = np.add.reduceat(np.linalg.norm(relativePoints, axis=1), starts)/loopSizes[valid]
+
+    relativeNextPoints = nextLoopPoints - self.barycenters[entryBoundaryIds]
+    normals = np.add.reduceat(np.cross(relativePoints, relativeNextPoints), starts, axis=0)
+    normalLengths = np.linalg.norm(normals, axis=1)
+    self.normals[valid] = normals/np.where(normalLengths > 0, normalLengths, 1.0)[:,None]
+
+  def findClosestBoundaries(self, positions):
+    """ ids of the boundaries with the barycenter closest to the positions (array of shape (n,3)) """
+    positions = np.asarray(positions, dtype=float).reshape(-1,3)
+    if self.numberOfBoundaries == 0 or positions.shape[0] == 0:
+      return np.zeros(0, dtype=np.int64)
+    distances = np.sum((positions[:,None,:] - self.barycenters[None,:,:])**2, axis=2)
+    return np.argmin(distances, axis=1)
+
 #
 # AddFlowExtensionLogic
 #
@@ -376,6 +507,9 @@ class AddFlowExtensionLogic(ScriptedLoadableModuleLogic):
     Called when the logic class is instantiated. Can be used for initializing member variables.
     """
     ScriptedLoadableModuleLogic.__init__(self)
+    # patch id of each cell of the capped surface: the wall has id wallEntityId, the caps the following ids
+    self.cellEntityIdsArrayName = 'CellEntityIds'
+    self.wallEntityId = 1
 
   def setDefaultParameters(self, parameterNode):
     """
@@ -394,24 +528,15 @@ class AddFlowExtensionLogic(ScriptedLoadableModuleLogic):
       logging.error("Surface can only be loaded from model node")
       return None
     
+  def getOpenBoundaries(self, surfacePolyData):
+    """ open boundaries of the surface, extracted only once as long as the surface is not modified """
+    return OpenBoundaries.get(surfacePolyData)
+
   def getOpenBoundariesBarycenters(self, surfacePolyData):
     """ compute the barycenters of the open boundaries of a surface """
-    # based on code in https://github.com/vmtk/vmtk/blob/master/vmtkScripts/vmtkflowextensions.py
-    import vtkvmtkComputationalGeometryPython as vtkvmtkComputationalGeometry
-    
-    
-    boundaryExtractor = vtkvmtkComputationalGeometry.vtkvmtkPolyDataBoundaryExtractor()
-    boundaryExtractor.SetInputData(surfacePolyData)
-    boundaryExtractor.Update()
-    boundaries = boundaryExtractor.GetOutput()
-    numberOfBoundaries = boundaries.GetNumberOfCells()
-    
+    from vtk.util import numpy_support
     seedPoints = vtk.vtkPoints()
-   
-    for i in range(numberOfBoundaries):
-      barycenter = [0.0, 0.0, 0.0]
-      vtkvmtkComputationalGeometry.vtkvmtkBoundaryReferenceSystems.ComputeBoundaryBarycenter(boundaries.GetCell(i).GetPoints(),barycenter)
-      seedPoints.InsertNextPoint(barycenter)
+    seedPoints.SetData(numpy_support.numpy_to_vtk(self.getOpenBoundaries(surfacePolyData).barycenters, deep=True))
       
     seedPolyData = vtk.vtkPolyData()
     seedPolyData.SetPoints(seedPoints)
@@ -456,6 +581,99 @@ class AddFlowExtensionLogic(ScriptedLoadableModuleLogic):
     flowExtensionsFilter.Update()
     
     return flowExtensionsFilter.GetOutput()
+
+  def addFlowExtensionsToBoundaries(self, inputSurfacePolyData, inputCenterlinePolyData, extensionRatios):
+    """
+    Add flow extensions to several open boundaries.
+    Can be used without GUI widget.
+    :param extensionRatios: dictionary open boundary id (of the input surface) -> extension ratio
+    The boundaries with the same extension ratio are extended in a single pass of the flow extensions filter, 
+    so the surface is only extended once per distinct ratio. The boundaries that are not extended yet keep their position, 
+    they are matched by their barycenter to the boundaries of the extended surface once per pass.
+    """
+    if not inputSurfacePolyData or not inputCenterlinePolyData:
+      raise ValueError("Input Surface, input Centerline, or output surface is invalid")
+
+    openBoundaries = self.getOpenBoundaries(inputSurfacePolyData)
+    numberOfBoundaries = openBoundaries.numberOfBoundaries
+    invalidIds = [boundaryId for boundaryId in extensionRatios if not 0 <= boundaryId < numberOfBoundaries]
+    if invalidIds:
+      raise ValueError(f"Invalid open boundary ids {invalidIds}, the surface has {numberOfBoundaries} open boundaries")
+    if not extensionRatios:
+      return inputSurfacePolyData
+    barycenters = openBoundaries.barycenters
+
+    # group the boundaries by extension ratio
+    ratioBoundaryIds = {}
+    for (boundaryId, extensionRatio) in sorted(extensionRatios.items()):
+      ratioBoundaryIds.setdefault(extensionRatio, []).append(boundaryId)
+
+    outputSurfacePolyData = inputSurfacePolyData
+    for (passIndex, (extensionRatio, boundaryIds)) in enumerate(ratioBoundaryIds.items()):
+      if passIndex > 0:
+        # the ids of the boundaries changed in the previous pass
+        boundaryIds = self.getOpenBoundaries(outputSurfacePolyData).findClosestBoundaries(barycenters[boundaryIds]).tolist()
+      outputSurfacePolyData = self.addFlowExtensions(outputSurfacePolyData, inputCenterlinePolyData, boundaryIds, extensionRatio)
+    
+    return outputSurfacePolyData
+
+  def createFlowExtensionsPreview(self, surfacePolyData, centerlinePolyData, extensionRatios, resolution=24):
+    """ fast preview of the flow extensions: a straight tube for each open boundary, from the barycenter of the boundary 
+    in the direction of the end of the closest centerline, with the mean radius of the boundary and length 
+    extension ratio * mean radius (as the adaptive extension length of the flow extensions filter). 
+    :param extensionRatios: dictionary open boundary id -> extension ratio
+    returns the tubes as one polydata
+    """
+    import ClipBranches
+    import OpenSurface
+    from vtk.util import numpy_support
+    previewPolyData = vtk.vtkPolyData()
+    openBoundaries = self.getOpenBoundaries(surfacePolyData)
+    centerlineData = ClipBranches.CenterlineData.get(centerlinePolyData)
+    boundaryIds = np.array([boundaryId for boundaryId in extensionRatios if 0 <= boundaryId < openBoundaries.numberOfBoundaries], dtype=np.int64)
+    if boundaryIds.shape[0] == 0 or centerlineData.points.shape[0] == 0:
+      return previewPolyData
+    barycenters = openBoundaries.barycenters[boundaryIds]
+    radii = openBoundaries.meanRadii[boundaryIds]
+    lengths = np.array([extensionRatios[boundaryId] for boundaryId in boundaryIds], dtype=float)*radii
+
+    # direction of the centerline at the closest point, pointing to the closest end of the centerline
+    closestPointIds = OpenSurface.CenterlinePointLocator.get(centerlinePolyData).findClosestPoints(barycenters)
+    cellIds = np.maximum(centerlineData.pointCellIds[closestPointIds], 0)
+    (starts, ends) = (centerlineData.offsets[cellIds], centerlineData.offsets[cellIds+1]-1)
+    entries = centerlineData.pointEntries[closestPointIds]
+    entries = np.where(entries < 0, starts, entries)
+    towardsEnd = entries - starts >= ends - entries
+    previousEntries = np.where(towardsEnd, np.maximum(entries-2, starts), np.minimum(entries+2, ends))
+    directions = centerlineData.points[closestPointIds] - centerlineData.points[centerlineData.connectivity[previousEntries]]
+    # the boundary normal for centerlines without direction
+    directionLengths = np.linalg.norm(directions, axis=1)
+    directions = np.where((directionLengths > 1e-12)[:,None], directions, openBoundaries.normals[boundaryIds])
+    directions /= np.maximum(np.linalg.norm(directions, axis=1), 1e-12)[:,None]
+
+    # two circles per tube, at the boundary and at the end of the extension
+    axes = np.eye(3)[np.argmin(np.abs(directions), axis=1)]
+    lateral0 = np.cross(directions, axes)
+    lateral0 /= np.linalg.norm(lateral0, axis=1)[:,None]
+    lateral1 = np.cross(directions, lateral0)
+    angles = np.linspace(0, 2*np.pi, resolution, endpoint=False)
+    circles = radii[:,None,None]*(np.cos(angles)[None,:,None]*lateral0[:,None,:] + np.sin(angles)[None,:,None]*lateral1[:,None,:])
+    points = np.stack([barycenters[:,None,:] + circles, (barycenters + lengths[:,None]*directions)[:,None,:] + circles], axis=1)
+
+    # quads between the circles
+    numberOfTubes = boundaryIds.shape[0]
+    circlePointIds = np.arange(numberOfTubes*2*resolution).reshape(numberOfTubes, 2, resolution)
+    nextPointIds = np.roll(circlePointIds, -1, axis=2)
+    quads = np.stack([circlePointIds[:,0], nextPointIds[:,0], nextPointIds[:,1], circlePointIds[:,1]], axis=2).reshape(-1,4)
+
+    previewPoints = vtk.vtkPoints()
+    previewPoints.SetData(numpy_support.numpy_to_vtk(points.reshape(-1,3), deep=True))
+    previewPolys = vtk.vtkCellArray()
+    previewPolys.SetData(numpy_support.numpy_to_vtk(np.arange(0, quads.size+1, 4, dtype=np.int64), deep=True, array_type=vtk.VTK_ID_TYPE),
+                         numpy_support.numpy_to_vtk(quads.ravel().astype(np.int64), deep=True, array_type=vtk.VTK_ID_TYPE))
+    previewPolyData.SetPoints(previewPoints)
+    previewPolyData.SetPolys(previewPolys)
+    return previewPolyData
   
   def addCaps(self, surfacePolyData):
     import vtkvmtkMiscPython as vtkvmtkMisc
@@ -465,9 +683,109 @@ class AddFlowExtensionLogic(ScriptedLoadableModuleLogic):
       
     addCapsFilter = vtkvmtkMisc.vtkvmtkSimpleCapPolyData()
     addCapsFilter.SetInputData(surfacePolyData)
+    # tag the wall and each cap with a patch id
+    addCapsFilter.SetCellEntityIdsArrayName(self.cellEntityIdsArrayName)
+    addCapsFilter.SetCellEntityIdOffset(self.wallEntityId)
     addCapsFilter.Update()
     
     return addCapsFilter.GetOutput()
+
+  def getPatchName(self, patchId):
+    return 'wall' if patchId == self.wallEntityId else f'cap{patchId - self.wallEntityId}'
+
+  def writeBinarySTL(self, filePath, points, offsets, connectivity, cellIds=None, attributes=None, header='', rasToLps=False, chunkSize=1000000):
+    """ write polygons to a binary STL file in chunks, without building the whole STL in memory. Triangles are written 
+    as they are, other polygons (e.g. caps) are fan triangulated.
+    :param points: array of shape (number of points,3)
+    :param offsets: CSR offsets of the polygons into the connectivity
+    :param connectivity: point ids of the polygons
+    :param cellIds: ids of the polygons to write (default: all)
+    :param attributes: attribute word (uint16) of each written polygon (default 0)
+    :param rasToLps: write the points in LPS coordinates
+    """
+    # readers take files with a header starting with "solid" for ascii STL
+    if header.lower().startswith('solid'):
+      header = 'binary ' + header
+    stlTriangleType = np.dtype([('normal', '<f4', (3,)), ('vertices', '<f4', (3,3)), ('attribute', '<u2')])
+    cellSizes = np.diff(offsets)
+    numberOfCells = cellSizes.shape[0] if cellIds is None else cellIds.shape[0]
+    numberOfTriangles = np.sum(np.maximum((cellSizes if cellIds is None else cellSizes[cellIds]) - 2, 0))
+    with open(filePath, 'wb') as f:
+      f.write(header.encode('ascii', 'replace')[:80].ljust(80, b' '))
+      f.write(np.uint32(numberOfTriangles).tobytes())
+      for start in range(0, numberOfCells, chunkSize):
+        chunk = slice(start, min(start+chunkSize, numberOfCells))
+        chunkCellIds = np.arange(chunk.start, chunk.stop) if cellIds is None else cellIds[chunk]
+        # fan triangles (0, j+1, j+2) of each polygon, a single triangle for triangles
+        cellTriangleCounts = np.maximum(cellSizes[chunkCellIds] - 2, 0)
+        triangleCells = np.repeat(np.arange(chunkCellIds.shape[0]), cellTriangleCounts)
+        fanIndices = np.arange(triangleCells.shape[0]) - np.repeat(np.cumsum(cellTriangleCounts) - cellTriangleCounts, cellTriangleCounts)
+        firstEntries = offsets[chunkCellIds][triangleCells]
+        vertices = points[connectivity[np.stack([firstEntries, firstEntries+fanIndices+1, firstEntries+fanIndices+2], axis=1)]]
+        if rasToLps:
+          # RAS to LPS is a rotation about the z axis, the triangle orientation is kept
+          vertices[...,:2] *= -1
+        normals = np.cross(vertices[:,1]-vertices[:,0], vertices[:,2]-vertices[:,0])
+        normalLengths = np.linalg.norm(normals, axis=1)
+        records = np.zeros(vertices.shape[0], dtype=stlTriangleType)
+        records['normal'] = normals/np.where(normalLengths > 0, normalLengths, 1.0)[:,None]
+        records['vertices'] = vertices
+        if attributes is not None:
+          records['attribute'] = attributes[chunk][triangleCells]
+        records.tofile(f)
+
+  def exportPatchesSTL(self, surfacePolyData, filePath, separateFiles=True, coordinateSystem='LPS'):
+    """ export the surface for meshing, with the patches defined by the cell entity ids of the capped surface 
+    (see addCaps); a surface without cell entity ids is exported as a single wall patch.
+    With separateFiles one binary STL file is written per patch (<file name>_<patch name>.stl), otherwise a single binary 
+    STL file is written with the patch id in the attribute word of each triangle (the header lists the patch names).
+    :param coordinateSystem: 'LPS' (default, as the models saved by Slicer) or 'RAS'
+    returns the paths of the written files
+    """
+    from vtk.util import numpy_support
+    if not surfacePolyData or not surfacePolyData.GetPoints():
+      raise ValueError("Input Surface is invalid")
+    if coordinateSystem not in ['LPS', 'RAS']:
+      raise ValueError(f"Unknown coordinate system {coordinateSystem}")
+
+    # the polygons are written directly (caps are fan triangulated by the writer), only triangle strips are triangulated
+    if surfacePolyData.GetNumberOfStrips() > 0:
+      triangleFilter = vtk.vtkTriangleFilter()
+      triangleFilter.SetInputData(surfacePolyData)
+      triangleFilter.PassVertsOff()
+      triangleFilter.PassLinesOff()
+      triangleFilter.Update()
+      surfacePolyData = triangleFilter.GetOutput()
+    polys = surfacePolyData.GetPolys()
+    points = numpy_support.vtk_to_numpy(surfacePolyData.GetPoints().GetData())
+    offsets = numpy_support.vtk_to_numpy(polys.GetOffsetsArray())
+    connectivity = numpy_support.vtk_to_numpy(polys.GetConnectivityArray())
+    numberOfPolys = offsets.shape[0] - 1
+
+    # cell data of the polygons follows the vertices and lines
+    patchIdsArray = surfacePolyData.GetCellData().GetArray(self.cellEntityIdsArrayName)
+    if patchIdsArray:
+      firstPolyId = surfacePolyData.GetNumberOfVerts() + surfacePolyData.GetNumberOfLines()
+      patchIds = numpy_support.vtk_to_numpy(patchIdsArray)[firstPolyId:firstPolyId+numberOfPolys].astype(np.int64)
+    else:
+      patchIds = np.full(numberOfPolys, self.wallEntityId, dtype=np.int64)
+    rasToLps = coordinateSystem == 'LPS'
+    
+    (basePath, extension) = os.path.splitext(filePath)
+    extension = extension or '.stl'
+    if not separateFiles:
+      header = f'patches ({coordinateSystem}) ' + ' '.join(f'{patchId}={self.getPatchName(patchId)}' for patchId in np.unique(patchIds))
+      self.writeBinarySTL(basePath+extension, points, offsets, connectivity, attributes=patchIds.astype(np.uint16), header=header, rasToLps=rasToLps)
+      return [basePath+extension]
+
+    filePaths = []
+    for patchId in np.unique(patchIds):
+      patchName = self.getPatchName(patchId)
+      patchFilePath = f'{basePath}_{patchName}{extension}'
+      self.writeBinarySTL(patchFilePath, points, offsets, connectivity, cellIds=np.flatnonzero(patchIds == patchId), 
+                          header=f'{patchName} patch (binary, {coordinateSystem})', rasToLps=rasToLps)
+      filePaths.append(patchFilePath)
+    return filePaths
     
 #
 # AddFlowExtensionTest
@@ -1,3 +1,4 @@
+import collections
 import logging
 import os
 import numpy as np
@@ -54,6 +55,8 @@ class CFDModelPostprocessingWidget(ScriptedLoadableModuleWidget, VTKObservationM
         self.logic = None
         self._parameterNode = None
         self._updatingGUIFromParameterNode = False
+        # parameters and node references of each GUI section at its last update
+        self._guiSectionValues = {}
         
 
     def setup(self):
@@ -68,14 +71,30 @@ class CFDModelPostprocessingWidget(ScriptedLoadableModuleWidget, VTKObservationM
         self.layout.addWidget(uiWidget)
         self.ui = slicer.util.childWidgetVariables(uiWidget)
 
-        # initialize pointslocator, used in the positioning of the ROI box for clipping, to None 
-        self.pointsLocator = None
-
         # intitialize indicator whether ROIbox should be moved or not
         self.moveROIBox = False
 
+        # undo/redo history of the clips, started at the first clip
+        self.clipHistory = None
+
+        # cursor events are coalesced: the timer updates the ROI box at most once per frame, for the latest cursor position
+        self.roiCursorPosition = None
+        self.roiUpdateInProgress = False
+        self.roiUpdateTimer = qt.QTimer()
+        self.roiUpdateTimer.setSingleShot(True)
+        self.roiUpdateTimer.setInterval(16)
+        self.roiUpdateTimer.connect('timeout()', self.onROIUpdateTimer)
+
         # initialize selection of groupIds to be mapped to 2D
         self.groupIdsCheckBoxList = None
+
+        # results are saved in the background, the timer reports finished saves
+        from CFDModelPostprocessingLib import AsyncSaveQueue
+        self.saveQueue = AsyncSaveQueue.AsyncSaveQueue()
+        self.saveQueueTimer = qt.QTimer()
+        self.saveQueueTimer.setInterval(200)
+        self.saveQueueTimer.connect('timeout()', self.onSaveQueueTimer)
+        self.ui.saveCompressionComboBox.addItems(AsyncSaveQueue.COMPRESSORS)
         # Set scene in MRML widgets. Make sure that in Qt designer the top-level qMRMLWidget's
         # "mrmlSceneChanged(vtkMRMLScene*)" signal in is connected to each MRML widget's.
         # "setMRMLScene(vtkMRMLScene*)" slot.
@@ -106,11 +125,17 @@ class CFDModelPostprocessingWidget(ScriptedLoadableModuleWidget, VTKObservationM
         self.ui.computeCenterlineButton.connect('clicked(bool)', self.onComputeCenterlineButton)
         self.ui.applyClipButton.connect('clicked(bool)', self.onApplyClipButton)
         self.ui.resetClipButton.connect('clicked(bool)', self.onResetClipButton)
+        self.ui.undoClipButton.connect('clicked(bool)', self.onUndoClipButton)
+        self.ui.redoClipButton.connect('clicked(bool)', self.onRedoClipButton)
         self.ui.saveClippedModelButton.connect('clicked(bool)',self.onSaveClippedModelButton)
         self.ui.endPointsROIMarkupsSelector.connect("currentNodeChanged(vtkMLMLNode*)", self.updateParameterNodeFromGUI)
         self.ui.autoDetectEndPointsROIButton.connect('clicked(bool)',self.onAutoDetectEndPointsROIButton)
         self.ui.noCircBinSpinBox.connect('valueChanged(int)', self.updateParameterNodeFromGUI)
         self.ui.longBinSizeSpinBox.connect('valueChanged(double)', self.updateParameterNodeFromGUI)
+        self.ui.parallelBranchProcessingCheckBox.connect("toggled(bool)", self.updateParameterNodeFromGUI)
+        self.ui.compactExportCheckBox.connect("toggled(bool)", self.updateParameterNodeFromGUI)
+        self.ui.adaptiveRefinementCheckBox.connect("toggled(bool)", self.updateParameterNodeFromGUI)
+        self.ui.saveCompressionComboBox.currentTextChanged.connect(self.updateParameterNodeFromGUI)
         self.ui.computeCenterlineFor2DMapButton.connect('clicked(bool)', self.onComputeCenterlineFor2DMapButton)
         self.ui.computeMapsButton.connect('clicked(bool)', self.onComputeMapsButton)
         self.ui.scalarSelectionComboBox.currentTextChanged.connect(self.onScalarSelected)
@@ -129,6 +154,10 @@ class CFDModelPostprocessingWidget(ScriptedLoadableModuleWidget, VTKObservationM
         Called when the application closes and the module widget is destroyed.
         """
         self.removeObservers()
+        self.roiUpdateTimer.stop()
+        # finish writing the pending saves
+        self.saveQueueTimer.stop()
+        self.saveQueue.shutdown(wait=True)
 
     def enter(self):
         """
@@ -208,7 +237,8 @@ class CFDModelPostprocessingWidget(ScriptedLoadableModuleWidget, VTKObservationM
         if self._parameterNode is not None:
             self.addObserver(self._parameterNode, vtk.vtkCommand.ModifiedEvent, self.updateGUIFromParameterNode)
 
-        # Initial GUI update
+        # Initial GUI update, all sections are updated
+        self._guiSectionValues = {}
         self.updateGUIFromParameterNode()
 
     def updateGUIFromParameterNode(self, caller=None, event=None):
@@ -223,25 +253,34 @@ class CFDModelPostprocessingWidget(ScriptedLoadableModuleWidget, VTKObservationM
         # Make sure GUI changes do not call updateParameterNodeFromGUI (it could cause infinite loop)
         self._updatingGUIFromParameterNode = True
 
-        # Update node selectors and slider
-        self.ui.endPointsMarkupsSelector.setCurrentNode(self._parameterNode.GetNodeReference("EndPoints"))
-
-        self.ui.endPointsROIMarkupsSelector.setCurrentNode(self._parameterNode.GetNodeReference("ROIEndPoints"))
-
-        # Update buttons states and tooltips
-        self.ui.filePathLineEdit.setCurrentPath(self._parameterNode.GetParameter("InputFilePath"))
-        self.ui.scaleFactorCheckBox.checked = (self._parameterNode.GetParameter("UseScaleFactor") == "true")
-        self.ui.scaleFactorLineEdit.enabled = (self._parameterNode.GetParameter("UseScaleFactor") == "true")
-        self.ui.lpsToRasCheckBox.checked = (self._parameterNode.GetParameter("LPSToRAS") == "true")
-        
-        # update text fields
-        self.ui.scaleFactorLineEdit.setText(self._parameterNode.GetParameter("ScaleFactor"))
-        self.ui.longBinSizeSpinBox.value = float(self._parameterNode.GetParameter("LongitudinalPatchSize"))   
-        self.ui.noCircBinSpinBox.value = int(self._parameterNode.GetParameter("CircularNumberOfPatches"))   
-
-        # update display scalar 
-        surfaceNode = self._parameterNode.GetNodeReference("SurfaceModel")
-        if surfaceNode:
+        # Only the GUI sections of which the parameters or node references changed are updated, so that e.g. moving the
+        # ROI box does not rebuild the radio buttons, reset the camera or switch the layout
+        parameterNode = self._parameterNode
+
+        # Update node selectors, buttons states and text fields
+        settingNames = ["InputFilePath", "UseScaleFactor", "LPSToRAS", "ScaleFactor", "LongitudinalPatchSize", "CircularNumberOfPatches",
+                        "ParallelBranchProcessing", "CompactExport", "AdaptiveRefinement", "SaveCompression"]
+        if self.guiSectionChanged("Settings", parameterNode.GetNodeReferenceID("EndPoints"), parameterNode.GetNodeReferenceID("ROIEndPoints"),
+                                  *[parameterNode.GetParameter(settingName) for settingName in settingNames]):
+            self.ui.endPointsMarkupsSelector.setCurrentNode(parameterNode.GetNodeReference("EndPoints"))
+            self.ui.endPointsROIMarkupsSelector.setCurrentNode(parameterNode.GetNodeReference("ROIEndPoints"))
+
+            self.ui.filePathLineEdit.setCurrentPath(parameterNode.GetParameter("InputFilePath"))
+            self.ui.scaleFactorCheckBox.checked = (parameterNode.GetParameter("UseScaleFactor") == "true")
+            self.ui.scaleFactorLineEdit.enabled = (parameterNode.GetParameter("UseScaleFactor") == "true")
+            self.ui.lpsToRasCheckBox.checked = (parameterNode.GetParameter("LPSToRAS") == "true")
+
+            self.ui.scaleFactorLineEdit.setText(parameterNode.GetParameter("ScaleFactor"))
+            self.ui.longBinSizeSpinBox.value = float(parameterNode.GetParameter("LongitudinalPatchSize"))
+            self.ui.noCircBinSpinBox.value = int(parameterNode.GetParameter("CircularNumberOfPatches"))
+            self.ui.parallelBranchProcessingCheckBox.checked = (parameterNode.GetParameter("ParallelBranchProcessing") == "true")
+            self.ui.compactExportCheckBox.checked = (parameterNode.GetParameter("CompactExport") == "true")
+            self.ui.adaptiveRefinementCheckBox.checked = (parameterNode.GetParameter("AdaptiveRefinement") == "true")
+            self.ui.saveCompressionComboBox.setCurrentText(parameterNode.GetParameter("SaveCompression"))
+
+        # new surface: show it and center the 3D view on it
+        surfaceNode = parameterNode.GetNodeReference("SurfaceModel")
+        if self.guiSectionChanged("Surface", parameterNode.GetNodeReferenceID("SurfaceModel")) and surfaceNode:
             # set visibility
             surfaceNode.GetDisplayNode().SetVisibility(1) 
 
@@ -260,24 +299,19 @@ class CFDModelPostprocessingWidget(ScriptedLoadableModuleWidget, VTKObservationM
             # display orientation marker
             viewNode.SetOrientationMarkerType(slicer.vtkMRMLAbstractViewNode.OrientationMarkerTypeCube)
 
-        # display inlet boundaries
-        endPointsNode = self._parameterNode.GetNodeReference("EndPoints")
-        if endPointsNode:
+        # display inlet boundaries, adding or removing endpoints is handled by the observers of the endpoints node
+        endPointsNode = parameterNode.GetNodeReference("EndPoints")
+        if self.guiSectionChanged("Inlet", parameterNode.GetNodeReferenceID("EndPoints")) and endPointsNode:
             self.updateInletRadioButtons(endPointsNode)
             
             # enable inlet radiobuttons groupbox
             self.ui.selectInletGroupBox.enabled = True
 
         # initialize/update clipping roi box
-        if self._parameterNode.GetNodeReference("CenterlineModel"):
-            if not self._parameterNode.GetNodeReference("OpenSurface_ROIBox"):
-                roiBoxReady = self.initializeROIBox()
-                # initialize points locator used in the positioning of the ROI box
-                if roiBoxReady:
-                    if not self.pointsLocator:
-                        self.pointsLocator = vtk.vtkPointLocator() # could try using vtk.vtkStaticPointLocator() if need to optimize
-                        self.pointsLocator.SetDataSet(self._parameterNode.GetNodeReference("CenterlineModel").GetPolyData())
-                        self.pointsLocator.BuildLocator()
+        if (self.guiSectionChanged("Centerline", parameterNode.GetNodeReferenceID("CenterlineModel"), parameterNode.GetNodeReferenceID("OpenSurface_ROIBox"))
+            and parameterNode.GetNodeReference("CenterlineModel")):
+            if not parameterNode.GetNodeReference("OpenSurface_ROIBox"):
+                self.initializeROIBox()
            
             self.ui.longBinSizeSpinBox.enabled = True
             self.ui.noCircBinSpinBox.enabled = True
@@ -286,59 +320,73 @@ class CFDModelPostprocessingWidget(ScriptedLoadableModuleWidget, VTKObservationM
             self.ui.computeCenterlineFor2DMapButton.enabled = True
 
             # hide endpointsnodes
-            endPointsNode.GetDisplayNode().SetVisibility(0)
+            if endPointsNode:
+                endPointsNode.GetDisplayNode().SetVisibility(0)
 
         # set clip ROI button state
-        if self._parameterNode.GetNodeReference("OpenSurface_ROIBox"):
-            # enable clipping button
-            self.ui.applyClipButton.enabled = True
-            
-        if self._parameterNode.GetNodeReference("ROISurfaceModel"):
-            # enable reset button
-            self.ui.resetClipButton.enabled = True
-            self.ui.saveClippedModelButton.enabled = True
-            # enable 2d map computation
-            self.ui.endPointsROIMarkupsSelector.enabled = True
-            self.ui.endPointsROIMarkupsPlaceWidget.enabled = True
-            self.ui.autoDetectEndPointsROIButton.enabled = True
-            self.ui.computeCenterlineFor2DMapButton.enabled = True
-            # hide original surface model
-            surfaceNode.GetDisplayNode().SetVisibility(0) 
+        if self.guiSectionChanged("Clip", parameterNode.GetNodeReferenceID("OpenSurface_ROIBox"), parameterNode.GetNodeReferenceID("ROISurfaceModel")):
+            if parameterNode.GetNodeReference("OpenSurface_ROIBox"):
+                # enable clipping button
+                self.ui.applyClipButton.enabled = True
+
+            if parameterNode.GetNodeReference("ROISurfaceModel"):
+                # enable reset button
+                self.ui.resetClipButton.enabled = True
+                self.ui.saveClippedModelButton.enabled = True
+                # enable 2d map computation
+                self.ui.endPointsROIMarkupsSelector.enabled = True
+                self.ui.endPointsROIMarkupsPlaceWidget.enabled = True
+                self.ui.autoDetectEndPointsROIButton.enabled = True
+                self.ui.computeCenterlineFor2DMapButton.enabled = True
+                # hide original surface model
+                if surfaceNode:
+                    surfaceNode.GetDisplayNode().SetVisibility(0)
         
         # display inlet boundaries for ROI model
-        ROIEndPointsNode = self._parameterNode.GetNodeReference("ROIEndPoints")
-        if ROIEndPointsNode:
+        ROIEndPointsNode = parameterNode.GetNodeReference("ROIEndPoints")
+        if self.guiSectionChanged("ROIInlet", parameterNode.GetNodeReferenceID("ROIEndPoints")) and ROIEndPointsNode:
             self.updateROIInletRadioButtons(ROIEndPointsNode)
             
             # enable inlet radiobuttons groupbox
             self.ui.selectROIInletGroupBox.enabled = True
 
             # hide centerline of original model
-            centerlineModel = self._parameterNode.GetNodeReference("CenterlineModel")
+            centerlineModel = parameterNode.GetNodeReference("CenterlineModel")
             if centerlineModel:
                 centerlineModel.GetDisplayNode().SetVisibility(0)
 
           
             # Hide ROI Box
-            ROIBoxNode = self._parameterNode.GetNodeReference("OpenSurface_ROIBox")
+            ROIBoxNode = parameterNode.GetNodeReference("OpenSurface_ROIBox")
             if ROIBoxNode:
                 ROIBoxNode.SetDisplayVisibility(0)
 
         # display groupids selection for 2D map 
-        if self._parameterNode.GetNodeReference('CenterlineFor2DMapGroupIds'):
+        if self.guiSectionChanged("GroupIds", parameterNode.GetNodeReferenceID('CenterlineFor2DMapGroupIds')) and parameterNode.GetNodeReference('CenterlineFor2DMapGroupIds'):
             self.ui.selectIdsFor2DMapGroupBox.enabled = True
 
-        if self._parameterNode.GetNodeReference("SurfacePatchingModel"):
+        # new maps: switch to the maps layout once
+        surfacePatchingNode = parameterNode.GetNodeReference("SurfacePatchingModel")
+        if self.guiSectionChanged("Maps", parameterNode.GetNodeReferenceID("SurfacePatchingModel")) and surfacePatchingNode:
             self.ui.scalarSelectionComboBox.enabled = True
-            self.updateScalarSelectionComboBox()
             # set the layout
             self.setupMapsLayout()
             # enable save button
             self.ui.saveMapsButton.enabled = True
 
+        if self.guiSectionChanged("Scalar", parameterNode.GetNodeReferenceID("SurfacePatchingModel"), parameterNode.GetParameter("SelectedScalarForMapping")) and surfacePatchingNode:
+            self.updateScalarSelectionComboBox()
+
         # All the GUI updates are done
         self._updatingGUIFromParameterNode = False
 
+    def guiSectionChanged(self, section, *values):
+        """ True if the parameters/node references of the GUI section changed since its last update, the values are stored """
+        if self._guiSectionValues.get(section) == values:
+            return False
+        self._guiSectionValues[section] = values
+        return True
+
     def updateParameterNodeFromGUI(self, caller=None, event=None):
         """
         This method is called when the user makes any change in the GUI.
@@ -360,6 +408,10 @@ class CFDModelPostprocessingWidget(ScriptedLoadableModuleWidget, VTKObservationM
         self._parameterNode.SetParameter("LongitudinalPatchSize",str(self.ui.longBinSizeSpinBox.value))
         self._parameterNode.SetParameter("CircularNumberOfPatches",str(self.ui.noCircBinSpinBox.value))
         self._parameterNode.SetParameter("SelectedScalarForMapping", self.ui.scalarSelectionComboBox.currentText)
+        self._parameterNode.SetParameter("ParallelBranchProcessing", "true" if self.ui.parallelBranchProcessingCheckBox.checked else "false")
+        self._parameterNode.SetParameter("CompactExport", "true" if self.ui.compactExportCheckBox.checked else "false")
+        self._parameterNode.SetParameter("AdaptiveRefinement", "true" if self.ui.adaptiveRefinementCheckBox.checked else "false")
+        self._parameterNode.SetParameter("SaveCompression", self.ui.saveCompressionComboBox.currentText)
         self._parameterNode.EndModify(wasModified)
 
     def onLoadButton(self):
@@ -374,48 +426,11 @@ class CFDModelPostprocessingWidget(ScriptedLoadableModuleWidget, VTKObservationM
         with slicer.util.tryWithErrorDisplay("Failed to load file", waitCursor=True):
 
             filePath = self.ui.filePathLineEdit.currentPath
-           
-            fileExt = os.path.splitext(filePath)[1]
-            print(fileExt)
-            # load file using  different approaches based on the file extension
-            if fileExt in ['.tec','.dat']:
-                # try load file with vtk tecplot reader
-                reader = vtk.vtkTecplotReader()
-                reader.SetFileName(filePath)
-                # multiblock to polydata
-                geomFilter = vtk.vtkCompositeDataGeometryFilter()
-                geomFilter.SetInputConnection(reader.GetOutputPort())
-                
-                transform = vtk.vtkTransform()  
-
-                if self._parameterNode.GetParameter("UseScaleFactor") == "true":
-                    # scale to mm and convert LPS (used in file) to RAS (used internally by 3Dslicer), i.e. negate the x and y coordinates
-                    if self._parameterNode.GetParameter("LPSToRAS") == "true":
-                        transform.Scale(-scaleFactor, -scaleFactor, scaleFactor) 
-                    else:
-                        transform.Scale(scaleFactor,scaleFactor,scaleFactor)
-                else:
-                    transform.Scale(1.0,1.0,1.0)
-                transformFilter = vtk.vtkTransformFilter()
-                transformFilter.SetInputConnection(geomFilter.GetOutputPort())
-                transformFilter.SetTransform(transform)
-                #transformFilter.Update()    
-        
-                # clean surface
-                cleaner = vtk.vtkCleanPolyData()
-                cleaner.SetInputConnection(transformFilter.GetOutputPort())
-                cleaner.Update()
-                    
-                surfacePolyData = cleaner.GetOutput()
-        
-                # polydata to node
-                surfaceNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLModelNode', 'SurfaceModelNode')
-                surfaceNode.SetAndObserveMesh(surfacePolyData)  
-                if not surfaceNode.GetDisplayNode():
-                    surfaceNode.CreateDefaultDisplayNodes()  
+            # scale to mm and convert LPS to RAS only if the scale factor is used
+            if self._parameterNode.GetParameter("UseScaleFactor") == "true":
+                surfaceNode = self.logic.loadSurface(filePath, scaleFactor, self._parameterNode.GetParameter("LPSToRAS") == "true")
             else:
-                # try loading file using slicer data loader
-                surfaceNode = slicer.util.loadModel(filePath) 
+                surfaceNode = self.logic.loadSurface(filePath)
 
             # save to parameter node
             self._parameterNode.SetNodeReferenceID("SurfaceModel",surfaceNode.GetID())
@@ -458,14 +473,7 @@ class CFDModelPostprocessingWidget(ScriptedLoadableModuleWidget, VTKObservationM
     def getPreprocessedPolyData(self, surfaceModelNode):
         """ Preprocess the surface polydata for centerline computation. Code based on ExtractCenterlineWidget and 
         ExtractCenterlineLogic"""
-        extractCenterlineLogic = slicer.modules.extractcenterline.widgetRepresentation().self().logic
-        
-        targetNumberOfPoints = 5000 # default
-        decimationAggressiveness = 4.0 # default
-        subdivideInputSurface = False # default
-        preprocessedPolyData = extractCenterlineLogic.preprocess(surfaceModelNode.GetPolyData(), targetNumberOfPoints, decimationAggressiveness, subdivideInputSurface)
-        
-        return preprocessedPolyData
+        return self.logic.preprocessSurface(surfaceModelNode.GetPolyData())
     
     def onAutoDetectEndPointsButton(self):
         surfaceModelNode = self._parameterNode.GetNodeReference("SurfaceModel")
@@ -618,30 +626,12 @@ class CFDModelPostprocessingWidget(ScriptedLoadableModuleWidget, VTKObservationM
         """
         Automatically detect mesh endpoints, code based on ExtractCenterlineWidget and ExtractCenterlineLogic
         """
-        extractCenterlineLogic = slicer.modules.extractcenterline.widgetRepresentation().self().logic
-
         qt.QApplication.setOverrideCursor(qt.Qt.WaitCursor)
         try:
-            slicer.util.showStatusMessage("Preprocessing...")
-            slicer.app.processEvents()  # force update
-            preprocessedPolyData = self.getPreprocessedPolyData(surfaceModelNode)
-            endPointsNode.RemoveAllControlPoints()
-        
             slicer.util.showStatusMessage("Extract network...")
             slicer.app.processEvents()  # force update
-            networkPolyData = extractCenterlineLogic.extractNetwork(preprocessedPolyData, endPointsNode)
-
-            endpointPositions = extractCenterlineLogic.getEndPoints(networkPolyData, startPointPosition=None)
-
+            self.logic.autoDetectEndPoints(surfaceModelNode.GetPolyData(), endPointsNode)
             endPointsNode.GetDisplayNode().PointLabelsVisibilityOff()
-            for position in endpointPositions:
-                endPointsNode.AddControlPoint(vtk.vtkVector3d(position))
-
-            # Mark the first node as unselected, which means that it is the start point
-            # (by default points are selected and there are more endpoints and only one start point,
-            # therefore indicating start point by non-selected stat requires less clicking)
-            if endPointsNode.GetNumberOfControlPoints() > 0:
-                endPointsNode.SetNthControlPointSelected(0, False)
 
         except Exception as e:
           slicer.util.errorDisplay("Failed to detect end points: "+str(e))
@@ -656,17 +646,8 @@ class CFDModelPostprocessingWidget(ScriptedLoadableModuleWidget, VTKObservationM
         surfaceNode = self._parameterNode.GetNodeReference("SurfaceModel")
         endPointsNode = self._parameterNode.GetNodeReference("EndPoints")
 
-        # compute centerline
-        ExtractCenterlineLogic = slicer.modules.extractcenterline.widgetRepresentation().self().logic
-        ClipBranchesLogic = slicer.modules.clipbranches.widgetRepresentation().self().logic
-
-        # preprocess polydata to improve centerline computation
-        preprocessedPolyData = self.getPreprocessedPolyData(surfaceNode)
-        curveSamplingDistance = 1.0 # default
-        centerlinePolyData, _ = ExtractCenterlineLogic.extractCenterline(preprocessedPolyData,endPointsNode,curveSamplingDistance)
-        
-        # split centerlines into branches
-        centerlinePolyData = ClipBranchesLogic.computeCenterlineBranches(centerlinePolyData)
+        # compute centerline, split into branches
+        centerlinePolyData = self.logic.computeCenterline(surfaceNode.GetPolyData(), endPointsNode)
         
         # to node
         centerlineModelNode = self._parameterNode.GetNodeReference("CenterlineModel")
@@ -686,42 +667,20 @@ class CFDModelPostprocessingWidget(ScriptedLoadableModuleWidget, VTKObservationM
     def initializeROIBox(self):
         # initialize the ROI box at index 0
         print("InitializeROIBox")
-        openSurfaceLogic = slicer.modules.opensurface.widgetRepresentation().self().logic
         try:
-            # check if centerlinegeometry has already been computed, if not, compute it once
+            # the ROI frames are computed once per centerline, the centerline node is not modified
             centerlineModelNode = self._parameterNode.GetNodeReference("CenterlineModel")
-            if not centerlineModelNode.HasPointScalarName("FrenetTangent"):
-                centerlineGeometryPolyData = openSurfaceLogic.computeCenterlineGeometry(centerlineModelNode.GetPolyData())
-                centerlineModelNode.SetAndObserveMesh(centerlineGeometryPolyData)
-
-            # compute plane normal to centerline
-            plane_idx = 0
-            planeNode = openSurfaceLogic.createPlaneNormalToCenterline(centerlineModelNode.GetPolyData(), plane_idx, "OpenSurface_SlicePlane")
-            planeNode.SetHideFromEditors(1)
 
-            # create ROI BOX markups node
+            # create ROI BOX markups node normal to the centerline at index 0
             roiNode = self._parameterNode.GetNodeReference("OpenSurface_ROIBox")
             if not roiNode:
-                roiNode = openSurfaceLogic.createROIBox(planeNode.GetCenter(),planeNode.GetSize()[0],planeNode.GetSize()[0],planeNode.GetSize()[0],"OpenSurface_ROIBox")
+                roiNode = self.logic.placeClipROIBox(centerlineModelNode.GetPolyData(), 0)
                 roiNode.GetDisplayNode().SetPointLabelsVisibility(False)
                 roiNode.GetDisplayNode().SetPropertiesLabelVisibility(False)
                 # add to parameter node
                 self._parameterNode.SetNodeReferenceID("OpenSurface_ROIBox", roiNode.GetID())
-            # get the roibox's planes
-            roiPlanes = vtk.vtkPlanes()
-            roiNode.GetPlanes(roiPlanes)
-
-            # convert one of the roi planes to markupplane for registration
-            roiPlane0 = roiPlanes.GetPlane(0)
-            planeROINode = openSurfaceLogic.createPlaneFromOriginAndNormal(roiPlane0.GetOrigin(),roiPlane0.GetNormal(),planeNode.GetSize()[0],"OpenSurface_ROIPlane")
-            planeROINode.SetHideFromEditors(1)
-
-            #align the roi to the plane normal to the centerline using the roi plane in the aligning process
-            openSurfaceLogic.alignPlanes(planeNode,planeROINode,roiNode)
-
-            # remove nodes that are no longer necessary
-            slicer.mrmlScene.RemoveNode(planeNode)
-            slicer.mrmlScene.RemoveNode(planeROINode)
+            else:
+                self.logic.placeClipROIBox(centerlineModelNode.GetPolyData(), 0, roiNode)
 
             # setup crosshair to get position on centerline model. Position can be selected by moving the mouse while holding down the shift key (only Slicer 5.2.2 and below). 
             # Code based on script repository
@@ -751,21 +710,38 @@ class CFDModelPostprocessingWidget(ScriptedLoadableModuleWidget, VTKObservationM
             self.moveROIBox = False
 
     def onMouseMoved(self,observer, eventid):
-        centerlineModelNode = self._parameterNode.GetNodeReference("CenterlineModel")
+        if not self.moveROIBox:
+            return
+        # only store the latest cursor position, the ROI box is updated by the timer
         crosshairNode = slicer.util.getNode("Crosshair")
         ras=[0,0,0]
         crosshairNode.GetCursorPositionRAS(ras)
-        closestPointId = self.pointsLocator.FindClosestPoint(ras)
-        ras = centerlineModelNode.GetPolyData().GetPoint(closestPointId)
+        self.roiCursorPosition = ras
+        if not self.roiUpdateTimer.isActive():
+            self.roiUpdateTimer.start()
 
-        if self.moveROIBox:
+    def onROIUpdateTimer(self):
+        if self.roiCursorPosition is None:
+            return
+        if self.roiUpdateInProgress:
+            # try again when the running update is finished
+            self.roiUpdateTimer.start()
+            return
+        ras = self.roiCursorPosition
+        self.roiCursorPosition = None
+        self.roiUpdateInProgress = True
+        try:
+            # the locator of the centerline is rebuilt when the centerline is modified or replaced
+            import OpenSurface
+            centerlineModelNode = self._parameterNode.GetNodeReference("CenterlineModel")
+            closestPointId = OpenSurface.CenterlinePointLocator.get(centerlineModelNode.GetPolyData()).findClosestPoint(ras)
             # redraw ROIbox for clipping
             self.updateROIBox(closestPointId)
+        finally:
+            self.roiUpdateInProgress = False
 
 
     def updateROIBox(self, pointIndex):
-        openSurfaceLogic = slicer.modules.opensurface.widgetRepresentation().self().logic
-
         # only update the ROI box if the pointIndex has changed
         slicePlaneLocation = int(self._parameterNode.GetParameter("SlicePlaneLocation"))
         if slicePlaneLocation == pointIndex:
@@ -776,66 +752,56 @@ class CFDModelPostprocessingWidget(ScriptedLoadableModuleWidget, VTKObservationM
 
         with slicer.util.tryWithErrorDisplay("Failed to compute results.", waitCursor=True):
 
-            # check if centerlinegeometry has already been computed, if not, compute it once
             centerlineModelNode = self._parameterNode.GetNodeReference("CenterlineModel")
-            if not centerlineModelNode.HasPointScalarName("FrenetTangent"):
-                centerlineGeometryPolyData = openSurfaceLogic.computeCenterlineGeometry(centerlineModelNode.GetPolyData())
-                centerlineModelNode.SetAndObserveMesh(centerlineGeometryPolyData)
-
-            # Todo: move this to logic class
             roiNode = self._parameterNode.GetNodeReference("OpenSurface_ROIBox")
-
-            planeNode = openSurfaceLogic.createPlaneNormalToCenterline(centerlineModelNode.GetPolyData(), pointIndex, "OpenSurface_SlicePlane")
-            planeNode.SetHideFromEditors(1)
-
-            # get the roibox's planes
-            roiPlanes = vtk.vtkPlanes()
-            roiNode.GetPlanes(roiPlanes)
-
-            # convert one of the roi planes to markupplane  for registration
-            roiPlane0 = roiPlanes.GetPlane(0)
-            planeROINode = openSurfaceLogic.createPlaneFromOriginAndNormal(roiPlane0.GetOrigin(),roiPlane0.GetNormal(),planeNode.GetSize()[0],"OpenSurface_ROIPlane")
-            planeROINode.SetHideFromEditors(1)
-
-            #align the roi to the plane normal to the centerline using the roi plane in the aligning process
-            openSurfaceLogic.alignPlanes(planeNode,planeROINode,roiNode)
-
-            # resize ROIbox
-            roiNode.SetSize(planeNode.GetSize()[0],planeNode.GetSize()[0],planeNode.GetSize()[0])
-
-            # remove nodes that are no longer necessary
-            slicer.mrmlScene.RemoveNode(planeNode)
-            slicer.mrmlScene.RemoveNode(planeROINode)
+            self.logic.placeClipROIBox(centerlineModelNode.GetPolyData(), pointIndex, roiNode)
   
     def onApplyClipButton(self):
         """
         Clip the surface with the ROI box
         """
+        import OpenSurface
         openSurfaceLogic = slicer.modules.opensurface.widgetRepresentation().self().logic
         with slicer.util.tryWithErrorDisplay("Failed to compute results.", waitCursor=True):
 
-            # clip the model using the markupsROINode. Use the dynamic modeler module's ROI cut tool fo this.
-            
+            # successive clips are applied to the clipped model, the clips are stored in an undo/redo history
+            surfaceModelNode = self._parameterNode.GetNodeReference("SurfaceModel")
+            if self.clipHistory is None or self.clipHistory.sourcePolyData is not surfaceModelNode.GetPolyData():
+                self.clipHistory = OpenSurface.ClipHistory(surfaceModelNode.GetPolyData())
+
+            # clip the model using the markupsROINode
             roiNode = self._parameterNode.GetNodeReference("OpenSurface_ROIBox")
-            ROIModelNode = self._parameterNode.GetNodeReference("ROISurfaceModel")
-            if not ROIModelNode:
-                ROIModelNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLModelNode', 'open_model')
-                self._parameterNode.SetNodeReferenceID("ROISurfaceModel",ROIModelNode.GetID())
-                # first time to clip, set the modelNode to start with
-                inputModelNode = self._parameterNode.GetNodeReference("SurfaceModel")
-            else: inputModelNode =ROIModelNode
-               
-            openSurfaceLogic.clipROIFromModel(inputModelNode,roiNode,ROIModelNode)
-            # display outputnode and hide inputnode
-            if inputModelNode is not ROIModelNode:
-                #  print("hide inputnode")
-                inputModelNode.SetDisplayVisibility(0)
-
-            ROIModelNode.SetDisplayVisibility(1)
-            ROIModelNode.GetDisplayNode().SetOpacity(0.6)
-            ROIModelNode.GetDisplayNode().SetColor(0.5,0.9,0.88)
+            clippedPolyData = openSurfaceLogic.clipROIFromPolyData(self.clipHistory.getCurrentPolyData(), roiNode)
+            self.showClippedModel(self.clipHistory.push(clippedPolyData))
 
-           
+    def onUndoClipButton(self):
+        with slicer.util.tryWithErrorDisplay("Failed to undo the clip.", waitCursor=True):
+            if self.clipHistory:
+                self.showClippedModel(self.clipHistory.undo())
+
+    def onRedoClipButton(self):
+        with slicer.util.tryWithErrorDisplay("Failed to redo the clip.", waitCursor=True):
+            if self.clipHistory:
+                self.showClippedModel(self.clipHistory.redo())
+
+    def showClippedModel(self, polyData):
+        """ show the clipped polydata in the ROI surface model and hide the input model """
+        ROIModelNode = self._parameterNode.GetNodeReference("ROISurfaceModel")
+        if not ROIModelNode:
+            ROIModelNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLModelNode', 'open_model')
+            self._parameterNode.SetNodeReferenceID("ROISurfaceModel",ROIModelNode.GetID())
+        ROIModelNode.SetAndObserveMesh(polyData)
+        if not ROIModelNode.GetDisplayNode():
+            ROIModelNode.CreateDefaultDisplayNodes()
+
+        # display outputnode and hide inputnode
+        self._parameterNode.GetNodeReference("SurfaceModel").SetDisplayVisibility(0)
+        ROIModelNode.SetDisplayVisibility(1)
+        ROIModelNode.GetDisplayNode().SetOpacity(0.6)
+        ROIModelNode.GetDisplayNode().SetColor(0.5,0.9,0.88)
+
+        self.ui.undoClipButton.enabled = self.clipHistory.canUndo()
+        self.ui.redoClipButton.enabled = self.clipHistory.canRedo()
 
     def onResetClipButton(self):
         """reset the clipped model to the input model"""
@@ -843,6 +809,10 @@ class CFDModelPostprocessingWidget(ScriptedLoadableModuleWidget, VTKObservationM
         ROIModelNode = self._parameterNode.GetNodeReference("ROISurfaceModel")
         if ROIModelNode:
             slicer.mrmlScene.RemoveNode(ROIModelNode)
+        # the clip history starts again at the next clip
+        self.clipHistory = None
+        self.ui.undoClipButton.enabled = False
+        self.ui.redoClipButton.enabled = False
         # set the visibility of the original model
         originalModelNode =self._parameterNode.GetNodeReference("SurfaceModel")
         originalModelNode.SetDisplayVisibility(1)
@@ -852,19 +822,13 @@ class CFDModelPostprocessingWidget(ScriptedLoadableModuleWidget, VTKObservationM
         filePath_NoExt = os.path.splitext(filePath)[0]
         outFilePath = ''.join((filePath_NoExt,'_ROI.vtp'))
         ROIModelNode = self._parameterNode.GetNodeReference("ROISurfaceModel")
-        slicer.util.saveNode(ROIModelNode,  outFilePath)
+        self.saveInBackground(ROIModelNode.GetPolyData(), outFilePath)
 
         # enable the centerline computation in the next section for map computation
     
     def onComputeCenterlineFor2DMapButton(self):
         """ Compute centerline for selected model for 2D maps"""
 
-        from vtk.numpy_interface import dataset_adapter as dsa
-
-        # access logic from other modules
-        ExtractCenterlineLogic = slicer.modules.extractcenterline.widgetRepresentation().self().logic
-        ClipBranchesLogic = slicer.modules.clipbranches.widgetRepresentation().self().logic
-
         # Hide ROI box 
         ROIModelNode = self._parameterNode.GetNodeReference("ROISurfaceModel")
         if ROIModelNode:
@@ -884,27 +848,12 @@ class CFDModelPostprocessingWidget(ScriptedLoadableModuleWidget, VTKObservationM
             slicer.util.errorDisplay("No endpoints detected for clipped surface model. Please make sure to compute endpoints before proceeding")
             return
         
-        # compute centerline
-        # preprocess polydata to improve centerline computation
-        preprocessedPolyData = self.getPreprocessedPolyData(surfaceModelNode)
-        curveSamplingDistance = 1.0 # default
-        centerlinePolyData, _ = ExtractCenterlineLogic.extractCenterline(preprocessedPolyData,endPointsNode,curveSamplingDistance)
+        # compute centerline with attributes, branches and bifurcation reference systems
+        (centerlineOffsetAttrPolyData, bifurcationRefSysPolyData) = self.logic.computeCenterlineForMap(surfaceModelNode.GetPolyData(), endPointsNode)
         
         # hide the models from the previous step
         surfaceModelNode.SetDisplayVisibility(0)
         endPointsNode.SetDisplayVisibility(0)
-
-        # compute centerline attributes (abscissa, angular metric)
-        centerlineAttributesPolyData = self.logic.computeCenterlineAttributes(centerlinePolyData)
-        
-        # split centerlines into branches
-        centerlineSplitPolyData = ClipBranchesLogic.computeCenterlineBranches(centerlineAttributesPolyData)
-        
-        # compute bifurcation reference system along the centerline
-        bifurcationRefSysPolyData = self.logic.computeBifurcationReferenceSystems(centerlineSplitPolyData)
-        
-        # offset centerline attributes to bifurcation ref system
-        centerlineOffsetAttrPolyData = self.logic.computeCenterlineOffsetAttributes(centerlineSplitPolyData,bifurcationRefSysPolyData)
   
         # to node
         newCenterlineNode = self._parameterNode.GetNodeReference("CenterlineForMap")
@@ -916,17 +865,10 @@ class CFDModelPostprocessingWidget(ScriptedLoadableModuleWidget, VTKObservationM
             newCenterlineNode.CreateDefaultDisplayNodes()   
         newCenterlineNode.SetDisplayVisibility(1) 
 
-        # refine surface for mapping and patching (reduces holes in mapped surface)
-        surfaceSubdividedPolyData = self.logic.subdivideSurface(surfaceModelNode.GetPolyData()) 
-         
-        # split the surface into its constituent branches
-        surfaceSplitPolyData = self.logic.splitSurface(surfaceSubdividedPolyData,centerlineOffsetAttrPolyData)
-        
-        # compute branch metrics (Abscissametric and Angular metric)
-        surfaceMetricsPolyData = self.logic.computeBranchMetrics(surfaceSplitPolyData, centerlineOffsetAttrPolyData)
-        
-        # metrics mapping to branches
-        surfaceMappingPolyData = self.logic.computeBranchMapping(surfaceMetricsPolyData,centerlineOffsetAttrPolyData,bifurcationRefSysPolyData)
+        # refine and split the surface, compute branch metrics and map the metrics to the branches
+        parallel = self._parameterNode.GetParameter("ParallelBranchProcessing") == "true"
+        adaptiveRefinement = self._parameterNode.GetParameter("AdaptiveRefinement") == "true"
+        surfaceMappingPolyData = self.logic.computeSurfaceMapping(surfaceModelNode.GetPolyData(),centerlineOffsetAttrPolyData,bifurcationRefSysPolyData,parallel,adaptiveRefinement)
         
         # To node for display
         surfaceMappingNode = self._parameterNode.GetNodeReference("SurfaceMappingModel")
@@ -941,17 +883,9 @@ class CFDModelPostprocessingWidget(ScriptedLoadableModuleWidget, VTKObservationM
         surfaceMappingNode.GetDisplayNode().SetActiveScalar('GroupIds',vtk.vtkAssignAttribute.POINT_DATA)
         surfaceMappingNode.GetDisplayNode().SetOpacity(0.4)
 
-        # display group ids
-        # compute centers of the cells for each group Id
-        cellCenters = vtk.vtkCellCenters()
-        cellCenters.SetInputData(centerlineOffsetAttrPolyData)
-        cellCenters.Update()
-        
-        wrapper = dsa.WrapDataObject(cellCenters.GetOutput())
-        points = wrapper.Points
-        groupIdsData= wrapper.PointData['GroupIds']
-        # only keep unique groupids
-        (groupIdsDataUnique, groupIdsDataUniqueIdx) = np.unique(groupIdsData, return_index = True)
+        # display group ids at the center of each group
+        centerlineData = self.logic.centerlineToNumpy(centerlineOffsetAttrPolyData)
+        groupIdsDataUnique = centerlineData.groupIds
         
         # to markups node
         groupIdsMarkupsNode = self._parameterNode.GetNodeReference('CenterlineFor2DMapGroupIds')
@@ -962,9 +896,9 @@ class CFDModelPostprocessingWidget(ScriptedLoadableModuleWidget, VTKObservationM
             # remove all control points
             groupIdsMarkupsNode.RemoveAllControlPoints()
 
-        for i in range(points.shape[0]):
-            n = groupIdsMarkupsNode.AddControlPoint(points[i,:])
-            groupIdsMarkupsNode.SetNthControlPointLabel(n,f'{groupIdsData[i]}')
+        for groupId in groupIdsDataUnique:
+            n = groupIdsMarkupsNode.AddControlPoint(centerlineData.getGroupCenter(groupId))
+            groupIdsMarkupsNode.SetNthControlPointLabel(n,f'{groupId}')
 
 
         # display checkboxes to let user choose which groupIds to keep for the 2D maps
@@ -1021,8 +955,21 @@ class CFDModelPostprocessingWidget(ScriptedLoadableModuleWidget, VTKObservationM
         longitudinalPatchSize = float(self._parameterNode.GetParameter("LongitudinalPatchSize"))
         circularNumberOfPatches = int(self._parameterNode.GetParameter("CircularNumberOfPatches"))
 
-        # patching of surface mesh for the whole geometry
-        (surfacePatchingPolyData,surfacePatched2DPolyData) = self.logic.computeBranchPatching(surfaceMappingNode.GetPolyData(),longitudinalPatchSize,circularNumberOfPatches)
+        # get the group ids of the selected branches
+        selectedGroupIdsList= [int(cb.text) for cb in self.groupIdsCheckBoxList if cb.isChecked()]
+        parallel = self._parameterNode.GetParameter("ParallelBranchProcessing") == "true"
+
+        # patching of surface mesh for the whole geometry, mapping and patching of the selected branches
+        try:
+            maps = self.logic.computeMaps(surfaceMappingNode.GetPolyData(),centerlineSplitPolyData,selectedGroupIdsList,longitudinalPatchSize,circularNumberOfPatches,parallel)
+        except Exception as e:
+            slicer.util.errorDisplay(f"Failed to compute mapping for branches. Error: {str(e)}")
+            return
+        surfacePatchingPolyData = maps['SurfacePatching']
+        surfaceBranchMappingPolyData = maps['BranchMapping']
+        surfaceBranchPatchingPolyData = maps['BranchPatching']
+        surfaceBranchPatchedPolyData = maps['BranchPatched']
+        surfaceBranchFlattenedPolyData = maps['BranchFlattened']
 
         # to node for display
         surfacePatchingNode = self._parameterNode.GetNodeReference("SurfacePatchingModel")
@@ -1033,16 +980,11 @@ class CFDModelPostprocessingWidget(ScriptedLoadableModuleWidget, VTKObservationM
             surfacePatchingNode.CreateDefaultDisplayNodes()     
         # hide from view
         surfacePatchingNode.SetDisplayVisibility(0)
-        # get the group ids of the selected branches
-        selectedGroupIdsList= [int(cb.text) for cb in self.groupIdsCheckBoxList if cb.isChecked()]
         # get the group ids of the different branches
         # save array to parameter node
         self._parameterNode.SetParameter("selectedBranchIds",' '.join(cb.text for cb in self.groupIdsCheckBoxList if cb.isChecked()))
         
-      
-        # compute mapping for selected branches
-        surfaceBranchMappingPolyData = self.logic.splitSurface(surfaceMappingNode.GetPolyData(),centerlineSplitPolyData,groupIds=selectedGroupIdsList)
-        # to node
+        # mapping for selected branches to node
         surfaceBranchMappingNode = self._parameterNode.GetNodeReference('BranchMappingModel')
         if not surfaceBranchMappingNode:
             surfaceBranchMappingNode= slicer.mrmlScene.AddNewNodeByClass('vtkMRMLModelNode', 'BranchMappingModel')
@@ -1053,13 +995,7 @@ class CFDModelPostprocessingWidget(ScriptedLoadableModuleWidget, VTKObservationM
             surfaceBranchMappingNode.CreateDefaultDisplayNodes()
        
 
-        # patching of surface mesh and attributes
-        try:
-            (surfaceBranchPatchingPolyData, surfaceBranchPatchedPolyData) = self.logic.computeBranchPatching(surfaceBranchMappingPolyData, longitudinalPatchSize,circularNumberOfPatches)
-        except Exception as e:
-            slicer.util.errorDisplay(f"Failed to compute mapping for branches. Error: {str(e)}. Continuing with next branch")
-        
-        # to node
+        # patching of selected branches to node
         surfaceBranchPatchingNode = self._parameterNode.GetNodeReference('BranchPatchingModel')
         if not surfaceBranchPatchingNode:
             surfaceBranchPatchingNode= slicer.mrmlScene.AddNewNodeByClass('vtkMRMLModelNode', 'BranchPatchingModel')
@@ -1070,6 +1006,16 @@ class CFDModelPostprocessingWidget(ScriptedLoadableModuleWidget, VTKObservationM
         # save node to parameter node
         self._parameterNode.SetNodeReferenceID('BranchPatchingModel',surfaceBranchPatchingNode.GetID())
 
+        # flattened surface of the selected branches to node, hidden from view
+        surfaceBranchFlattenedNode = self._parameterNode.GetNodeReference('BranchFlattenedModel')
+        if not surfaceBranchFlattenedNode:
+            surfaceBranchFlattenedNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLModelNode', 'BranchFlattenedModel')
+            self._parameterNode.SetNodeReferenceID('BranchFlattenedModel',surfaceBranchFlattenedNode.GetID())
+        surfaceBranchFlattenedNode.SetAndObserveMesh(surfaceBranchFlattenedPolyData)
+        if not surfaceBranchFlattenedNode.GetDisplayNode():
+            surfaceBranchFlattenedNode.CreateDefaultDisplayNodes()
+        surfaceBranchFlattenedNode.SetDisplayVisibility(0)
+
         # store patched data in volumenode
         vol2DName = f'Branch_2DPatchedModel'
         surface2DPatchingNode = self._parameterNode.GetNodeReference(vol2DName)
@@ -1079,6 +1025,9 @@ class CFDModelPostprocessingWidget(ScriptedLoadableModuleWidget, VTKObservationM
         # save node to parameter node
         self._parameterNode.SetNodeReferenceID(vol2DName,surface2DPatchingNode.GetID())
 
+        # precompute the 2D maps of all variables, so switching the displayed scalar does not need to extract them again
+        self.logic.computeVariableMaps(surface2DPatchingNode.GetImageData())
+
 
         # save to parameter node (save this node last as it is used to update the GUI, which requires the 2D map computations for the branches to 
         # be saved to the parameter node already)
@@ -1222,11 +1171,11 @@ class CFDModelPostprocessingWidget(ScriptedLoadableModuleWidget, VTKObservationM
 
         vol2DName = 'Branch_2DPatchedModel'
         surface2DPatchedNode = self._parameterNode.GetNodeReference(vol2DName)
-        # get out the imagedata
-        imgdata = surface2DPatchedNode.GetImageData()
-        # create 2D map of selected scalar
-        branch2DMap= self.logic.extractVariableMap(imgdata,activeScalar)
-            
+        # get the 2D map of selected scalar from the maps precomputed after patching
+        branch2DMap = self.logic.getVariableMap(surface2DPatchedNode.GetImageData(),activeScalar)
+        if branch2DMap is None:
+            return
+
         # store to node
         map2DName = 'Branch_2D_Map'
         map2DNode = self._parameterNode.GetNodeReference(map2DName)
@@ -1234,7 +1183,17 @@ class CFDModelPostprocessingWidget(ScriptedLoadableModuleWidget, VTKObservationM
             map2DNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode",map2DName)
             # to parameter node
             self._parameterNode.SetNodeReferenceID(map2DName,map2DNode.GetID())
-                
+
+        # if the map is already displayed, only swap the scalars of the volume node for the selected map
+        if self.logic.swapVolumeScalars(map2DNode, branch2DMap):
+            cldNode = slicer.modules.colors.logic().GetColorLegendDisplayNode(map2DNode)
+            if cldNode:
+                cldNode.SetTitleText(activeScalar)
+            # toggle displaynode scalar range for display to force opdate of color legend range
+            map2DNode.GetDisplayNode().SetScalarRangeFlag(0) # manual range
+            map2DNode.GetDisplayNode().SetScalarRangeFlag(1) # auto/data scalar range
+            return
+
         # show 2D color map
         slicer.util.updateVolumeFromArray(map2DNode, branch2DMap)
             
@@ -1271,31 +1230,42 @@ class CFDModelPostprocessingWidget(ScriptedLoadableModuleWidget, VTKObservationM
         filePath = self.ui.filePathLineEdit.currentPath
         filePath_NoExt = os.path.splitext(filePath)[0]
 
+        if self._parameterNode.GetParameter("CompactExport") == "true":
+            self.saveMapsCompact(f'{filePath_NoExt}_maps.npz')
+            return
+
         # save the complete 3D geometry with mapped and patched data
         surfaceMappingNode = self._parameterNode.GetNodeReference("SurfaceMappingModel")
         outFilePath = f'{filePath_NoExt}_mapping.vtp'
-        slicer.util.saveNode(surfaceMappingNode,  outFilePath)
+        self.saveInBackground(surfaceMappingNode.GetPolyData(), outFilePath)
 
         surfacePatchingNode = self._parameterNode.GetNodeReference("SurfacePatchingModel")
         outFilePath = f'{filePath_NoExt}_patching.vtp'
-        slicer.util.saveNode(surfacePatchingNode,  outFilePath)
+        self.saveInBackground(surfacePatchingNode.GetPolyData(), outFilePath)
         
         # save the 3D geometry for the selected branches with mapped data
         surfaceBranchPatchingNode = self._parameterNode.GetNodeReference("BranchPatchingModel")
         outFilePath = f'{filePath_NoExt}_branchpatching.vtp'
-        slicer.util.saveNode(surfaceBranchPatchingNode,  outFilePath)
+        self.saveInBackground(surfaceBranchPatchingNode.GetPolyData(), outFilePath)
 
         surfaceBranchMappingNode = self._parameterNode.GetNodeReference("BranchMappingModel")
         outFilePath = f'{filePath_NoExt}_branchmapping.vtp'
-        slicer.util.saveNode(surfaceBranchMappingNode,  outFilePath)
+        self.saveInBackground(surfaceBranchMappingNode.GetPolyData(), outFilePath)
+
+        # save the full resolution flattened surface of the selected branches
+        surfaceBranchFlattenedNode = self._parameterNode.GetNodeReference("BranchFlattenedModel")
+        if surfaceBranchFlattenedNode:
+            outFilePath = f'{filePath_NoExt}_branchflattened.vtp'
+            self.saveInBackground(surfaceBranchFlattenedNode.GetPolyData(), outFilePath)
     
         # save results for selected scalar to file
         #save 2D wss maps to .csv, prox at the bottom, dist at the top
         selectedScalarName = self._parameterNode.GetParameter('SelectedScalarForMapping')
         map2DNode = self._parameterNode.GetNodeReference('Branch_2D_Map')
-        branch2DMap = np.squeeze(slicer.util.arrayFromVolume(map2DNode))
+        branch2DMap = np.fliplr(np.flipud(np.squeeze(slicer.util.arrayFromVolume(map2DNode)))).copy()
         outFilePath = f'{filePath_NoExt}_Branch_{selectedScalarName}_2DMap.csv'
-        np.savetxt(outFilePath, np.fliplr(np.flipud(branch2DMap)), delimiter=",",fmt='%1.3f')
+        self.saveQueue.submit(outFilePath, lambda outFilePath=outFilePath: np.savetxt(outFilePath, branch2DMap, delimiter=",",fmt='%1.3f'))
+        self.saveQueueTimer.start()
 
         # save screen captures to file
         outFilePath = f'{filePath_NoExt}_Branch_{selectedScalarName}_2DMap.png'
@@ -1304,6 +1274,47 @@ class CFDModelPostprocessingWidget(ScriptedLoadableModuleWidget, VTKObservationM
         cap = ScreenCapture.ScreenCaptureLogic()
         cap.captureImageFromView(view, outFilePath)
             
+    def saveMapsCompact(self, outFilePath):
+        """ save the maps of all variables, the patch tensor and the metadata to one compressed .npz file """
+        surface2DPatchedNode = self._parameterNode.GetNodeReference('Branch_2DPatchedModel')
+        surfaceBranchPatchingNode = self._parameterNode.GetNodeReference("BranchPatchingModel")
+        
+        metadata = {'longitudinalPatchSize': float(self._parameterNode.GetParameter("LongitudinalPatchSize")),
+                    'circularNumberOfPatches': int(self._parameterNode.GetParameter("CircularNumberOfPatches")),
+                    'selectedBranchIds': [int(groupId) for groupId in self._parameterNode.GetParameter("selectedBranchIds").split()],
+                    'inlet': None, 'inletPosition': None}
+        endPointsNode = self._parameterNode.GetNodeReference("ROIEndPoints")
+        if endPointsNode:
+            metadata['inlet'] = self.logic.getInletIndex(endPointsNode)
+            if metadata['inlet'] is not None:
+                metadata['inletPosition'] = list(endPointsNode.GetNthControlPointPositionWorld(metadata['inlet']))
+
+        with slicer.util.tryWithErrorDisplay("Failed to save maps.", waitCursor=True):
+            self.logic.exportMapsCompact(outFilePath, surface2DPatchedNode.GetImageData(), surfaceBranchPatchingNode.GetPolyData(), metadata, self.saveQueue)
+            self.saveQueueTimer.start()
+
+    def saveInBackground(self, dataObject, outFilePath):
+        """ save a snapshot of the polydata (or imagedata) in the background, with the selected compression """
+        self.saveQueue.compressor = self._parameterNode.GetParameter("SaveCompression")
+        self.saveQueue.submitDataObject(dataObject, outFilePath)
+        self.saveQueueTimer.start()
+        slicer.util.showStatusMessage(f"Saving {self.saveQueue.getNumberOfPendingSaves()} file(s) in the background...")
+
+    def onSaveQueueTimer(self):
+        """ report the saves that finished in the background """
+        for (outFilePath, error) in self.saveQueue.pollResults():
+            if error:
+                slicer.util.errorDisplay(f"Failed to save {outFilePath}. Error: {error}")
+            else:
+                logging.info(f"Saved {outFilePath}")
+        numberOfPendingSaves = self.saveQueue.getNumberOfPendingSaves()
+        if numberOfPendingSaves:
+            slicer.util.showStatusMessage(f"Saving {numberOfPendingSaves} file(s) in the background...")
+        else:
+            self.saveQueueTimer.stop()
+            slicer.util.showStatusMessage("Saving done", 3000)
+
+#
 # CFDModelPostprocessingLogic
 #
 
@@ -1344,6 +1355,11 @@ class CFDModelPostprocessingLogic(ScriptedLoadableModuleLogic):
         self.circularPatchNumberArrayName = 'Sector'
         self.patchAreaArrayName = 'PatchArea'
 
+        # cache of the precomputed 2D maps of all variables, per patched image. 
+        # Bounded to the most recently used images to limit memory use
+        self.variableMapCache = collections.OrderedDict()
+        self.variableMapCacheSize = 4
+
     def setDefaultParameters(self, parameterNode):
         """
         Initialize parameter node with default settings.
@@ -1367,7 +1383,386 @@ class CFDModelPostprocessingLogic(ScriptedLoadableModuleLogic):
             parameterNode.SetParameter("BranchIds","")   
         if not parameterNode.GetParameter("SelectedScalarForMapping"):
             parameterNode.SetParameter("SelectedScalarForMapping","")
+        if not parameterNode.GetParameter("ParallelBranchProcessing"):
+            parameterNode.SetParameter("ParallelBranchProcessing","false")
+        if not parameterNode.GetParameter("CompactExport"):
+            parameterNode.SetParameter("CompactExport","false")
+        if not parameterNode.GetParameter("AdaptiveRefinement"):
+            parameterNode.SetParameter("AdaptiveRefinement","false")
+        if not parameterNode.GetParameter("SaveCompression"):
+            parameterNode.SetParameter("SaveCompression","ZLib")
             
+    def loadSurface(self, filePath, scaleFactor=None, lpsToRas=False):
+        """ load a surface file into a model node. Tecplot files are read with the vtk tecplot reader, scaled with scaleFactor 
+        (and converted from LPS to RAS if lpsToRas is set), other files are loaded with the slicer data loader
+        """
+        fileExt = os.path.splitext(filePath)[1]
+        # load file using  different approaches based on the file extension
+        if fileExt not in ['.tec','.dat']:
+            # try loading file using slicer data loader
+            return slicer.util.loadModel(filePath)
+
+        # try load file with vtk tecplot reader
+        reader = vtk.vtkTecplotReader()
+        reader.SetFileName(filePath)
+        # multiblock to polydata
+        geomFilter = vtk.vtkCompositeDataGeometryFilter()
+        geomFilter.SetInputConnection(reader.GetOutputPort())
+        
+        transform = vtk.vtkTransform()  
+        if scaleFactor:
+            # scale to mm and convert LPS (used in file) to RAS (used internally by 3Dslicer), i.e. negate the x and y coordinates
+            if lpsToRas:
+                transform.Scale(-scaleFactor, -scaleFactor, scaleFactor) 
+            else:
+                transform.Scale(scaleFactor,scaleFactor,scaleFactor)
+        else:
+            transform.Scale(1.0,1.0,1.0)
+        transformFilter = vtk.vtkTransformFilter()
+        transformFilter.SetInputConnection(geomFilter.GetOutputPort())
+        transformFilter.SetTransform(transform)
+
+        # clean surface
+        cleaner = vtk.vtkCleanPolyData()
+        cleaner.SetInputConnection(transformFilter.GetOutputPort())
+        cleaner.Update()
+
+        # polydata to node
+        surfaceNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLModelNode', 'SurfaceModelNode')
+        surfaceNode.SetAndObserveMesh(cleaner.GetOutput())  
+        if not surfaceNode.GetDisplayNode():
+            surfaceNode.CreateDefaultDisplayNodes()  
+
+        return surfaceNode
+
+    def preprocessSurface(self, surfacePolyData):
+        """ Preprocess the surface polydata for centerline computation. Code based on ExtractCenterlineLogic"""
+        import ExtractCenterline
+        extractCenterlineLogic = ExtractCenterline.ExtractCenterlineLogic()
+
+        targetNumberOfPoints = 5000 # default
+        decimationAggressiveness = 4.0 # default
+        subdivideInputSurface = False # default
+        return extractCenterlineLogic.preprocess(surfacePolyData, targetNumberOfPoints, decimationAggressiveness, subdivideInputSurface)
+
+    def autoDetectEndPoints(self, surfacePolyData, endPointsNode):
+        """ Automatically detect the endpoints of the surface and store them in endPointsNode, 
+        code based on ExtractCenterlineWidget and ExtractCenterlineLogic
+        """
+        import ExtractCenterline
+        extractCenterlineLogic = ExtractCenterline.ExtractCenterlineLogic()
+
+        preprocessedPolyData = self.preprocessSurface(surfacePolyData)
+        endPointsNode.RemoveAllControlPoints()
+        networkPolyData = extractCenterlineLogic.extractNetwork(preprocessedPolyData, endPointsNode)
+        endpointPositions = extractCenterlineLogic.getEndPoints(networkPolyData, startPointPosition=None)
+        for position in endpointPositions:
+            endPointsNode.AddControlPoint(vtk.vtkVector3d(position))
+
+        # Mark the first node as unselected, which means that it is the start point
+        # (by default points are selected and there are more endpoints and only one start point,
+        # therefore indicating start point by non-selected stat requires less clicking)
+        if endPointsNode.GetNumberOfControlPoints() > 0:
+            endPointsNode.SetNthControlPointSelected(0, False)
+
+        return endPointsNode
+
+    def setInletEndPoint(self, endPointsNode, inletIndex):
+        """ mark the endpoint at inletIndex as the inlet (start point), i.e. the only unselected control point """
+        slicer.modules.markups.logic().SetAllControlPointsSelected(endPointsNode,True)
+        endPointsNode.SetNthControlPointSelected(inletIndex,False)
+
+    def createEndPointsNode(self, nodeName, positions=None, inletIndex=0):
+        """ create an endpoints markups node from a list of positions, the endpoint at inletIndex is marked as the inlet. 
+        If positions is None, an empty node is returned
+        """
+        endPointsNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLMarkupsFiducialNode", nodeName)
+        endPointsNode.CreateDefaultDisplayNodes()
+        if positions is not None:
+            for position in positions:
+                endPointsNode.AddControlPoint(vtk.vtkVector3d(position))
+            self.setInletEndPoint(endPointsNode, inletIndex)
+        return endPointsNode
+
+    def computeCenterline(self, surfacePolyData, endPointsNode):
+        """ compute the centerline of the surface between the endpoints and split it into branches """
+        import ExtractCenterline
+        import ClipBranches
+        extractCenterlineLogic = ExtractCenterline.ExtractCenterlineLogic()
+
+        # preprocess polydata to improve centerline computation
+        preprocessedPolyData = self.preprocessSurface(surfacePolyData)
+        curveSamplingDistance = 1.0 # default
+        centerlinePolyData, _ = extractCenterlineLogic.extractCenterline(preprocessedPolyData,endPointsNode,curveSamplingDistance)
+
+        # split centerlines into branches
+        return ClipBranches.ClipBranchesLogic().computeCenterlineBranches(centerlinePolyData)
+
+    def placeClipROIBox(self, centerlinePolyData, pointIndex, roiNode=None):
+        """ place a ROI box normal to the centerline at pointIndex, the same way as the ROI box placed interactively in the widget.
+        Creates the ROI box if roiNode is None. The ROI frames of the centerline are computed (once) if needed
+        """
+        import OpenSurface
+        openSurfaceLogic = OpenSurface.OpenSurfaceLogic()
+
+        (roiFrames, roiSizes) = openSurfaceLogic.computeROIFrames(centerlinePolyData)
+        roiSize = roiSizes[pointIndex]
+        if not roiNode:
+            roiNode = openSurfaceLogic.createROIBox(roiFrames[pointIndex,:3,3],roiSize,roiSize,roiSize,"OpenSurface_ROIBox")
+        openSurfaceLogic.setROIFrame(roiNode, roiFrames[pointIndex], roiSize)
+
+        return roiNode
+
+    def clipSurfaceAtCenterlinePoints(self, surfaceModelNode, centerlinePolyData, cutPositions, outputModelNode):
+        """ clip the surface with a ROI box at each of the cut positions along the centerline. 
+        cutPositions are centerline point indices or (x,y,z) coordinates, which are snapped to the closest centerline point
+        """
+        import OpenSurface
+        openSurfaceLogic = OpenSurface.OpenSurfaceLogic()
+
+        # no ROI nodes are created, all boxes are clipped in one pass
+        openedPolyData = openSurfaceLogic.openSurface(surfaceModelNode.GetPolyData(), centerlinePolyData, cutPositions)
+        outputModelNode.SetAndObserveMesh(openedPolyData)
+        if not outputModelNode.GetDisplayNode():
+            outputModelNode.CreateDefaultDisplayNodes()
+
+        return outputModelNode
+
+    def computeCenterlineForMap(self, surfacePolyData, endPointsNode):
+        """ compute the centerline for the 2D maps, with centerline attributes, branches and offset to the bifurcation reference systems.
+        returns the centerline and the bifurcation reference systems
+        """
+        import ExtractCenterline
+        import ClipBranches
+        extractCenterlineLogic = ExtractCenterline.ExtractCenterlineLogic()
+
+        # compute centerline
+        # preprocess polydata to improve centerline computation
+        preprocessedPolyData = self.preprocessSurface(surfacePolyData)
+        curveSamplingDistance = 1.0 # default
+        centerlinePolyData, _ = extractCenterlineLogic.extractCenterline(preprocessedPolyData,endPointsNode,curveSamplingDistance)
+
+        # compute centerline attributes (abscissa, angular metric)
+        centerlineAttributesPolyData = self.computeCenterlineAttributes(centerlinePolyData)
+        
+        # split centerlines into branches
+        centerlineSplitPolyData = ClipBranches.ClipBranchesLogic().computeCenterlineBranches(centerlineAttributesPolyData)
+        
+        # compute bifurcation reference system along the centerline
+        bifurcationRefSysPolyData = self.computeBifurcationReferenceSystems(centerlineSplitPolyData)
+        
+        # offset centerline attributes to bifurcation ref system
+        centerlineOffsetAttrPolyData = self.computeCenterlineOffsetAttributes(centerlineSplitPolyData,bifurcationRefSysPolyData)
+
+        return (centerlineOffsetAttrPolyData, bifurcationRefSysPolyData)
+
+    def computeSurfaceMapping(self, surfacePolyData, centerlinePolyData, referenceSystems, parallel=False, adaptiveRefinement=False):
+        """ refine and split the surface into branches, compute the branch metrics and map them to the branches.
+        With adaptiveRefinement, only coarse triangles (relative to the local radius) and triangles near the branch boundaries are refined
+        """
+        # refine surface for mapping and patching (reduces holes in mapped surface)
+        if adaptiveRefinement:
+            surfaceSubdividedPolyData = self.adaptiveSubdivideSurface(surfacePolyData, centerlinePolyData)
+        else:
+            surfaceSubdividedPolyData = self.subdivideSurface(surfacePolyData) 
+         
+        # split the surface into its constituent branches
+        surfaceSplitPolyData = self.splitSurface(surfaceSubdividedPolyData,centerlinePolyData)
+        
+        # compute branch metrics (Abscissametric and Angular metric)
+        surfaceMetricsPolyData = self.computeBranchMetrics(surfaceSplitPolyData, centerlinePolyData)
+        
+        # metrics mapping to branches
+        if parallel:
+            return self.computeBranchMappingParallel(surfaceMetricsPolyData,centerlinePolyData,referenceSystems)
+        return self.computeBranchMapping(surfaceMetricsPolyData,centerlinePolyData,referenceSystems)
+
+    def computeMaps(self, surfaceMappingPolyData, centerlinePolyData, groupIds, longitudinalPatchSize, circularNumberOfPatches, parallel=False):
+        """ patching of the whole mapped surface, and mapping and patching of the selected branches (groupIds). 
+        returns a dictionary with the patched surface ('SurfacePatching'), the mapped and patched branches ('BranchMapping', 'BranchPatching') 
+        the 2D patched data of the branches ('BranchPatched') and the flattened surface of the branches ('BranchFlattened')
+        """
+        if parallel:
+            computeBranchPatching = self.computeBranchPatchingParallel
+        else:
+            computeBranchPatching = self.computeBranchPatching
+
+        maps = dict()
+        # patching of surface mesh for the whole geometry, the patched data of the whole geometry is not used
+        if parallel:
+            (maps['SurfacePatching'], _) = computeBranchPatching(surfaceMappingPolyData,longitudinalPatchSize,circularNumberOfPatches,computePatchedData=False)
+        else:
+            (maps['SurfacePatching'], _) = computeBranchPatching(surfaceMappingPolyData,longitudinalPatchSize,circularNumberOfPatches)
+        # compute mapping for selected branches
+        maps['BranchMapping'] = self.splitSurface(surfaceMappingPolyData,centerlinePolyData,groupIds=groupIds)
+        # patching of surface mesh and attributes
+        (maps['BranchPatching'], maps['BranchPatched']) = computeBranchPatching(maps['BranchMapping'],longitudinalPatchSize,circularNumberOfPatches)
+        # full resolution flattened surface of the selected branches
+        maps['BranchFlattened'] = self.flattenMappedSurface(maps['BranchMapping'])
+
+        return maps
+
+    def writePolyData(self, polyData, filePath):
+        """ write polydata to a .vtp file in LPS, the same as the models saved from the widget """
+        from CFDModelPostprocessingLib import AsyncSaveQueue
+        AsyncSaveQueue.writeModel(polyData, filePath)
+
+    def processCase(self, caseParameters, outputDirectory):
+        """ run the complete postprocessing pipeline for one case without the GUI.
+        caseParameters is a dictionary (see CFDModelPostprocessingLib/BatchPostprocessing.py for the keys), the results are written to outputDirectory.
+        All nodes created in the scene are removed afterwards. Returns the list of written files
+        """
+        caseId = caseParameters['id']
+        scaleFactor = caseParameters.get('scaleFactor')
+        longitudinalPatchSize = float(caseParameters.get('longitudinalPatchSize', 1.0))
+        circularNumberOfPatches = int(caseParameters.get('circularNumberOfPatches', 8))
+        parallel = bool(caseParameters.get('parallel', False))
+        os.makedirs(outputDirectory, exist_ok=True)
+        outFilePrefix = os.path.join(outputDirectory, caseId)
+        outFilePaths = []
+
+        nodes = []
+        try:
+            # load surface
+            surfaceNode = self.loadSurface(caseParameters['file'], float(scaleFactor) if scaleFactor else None, bool(caseParameters.get('lpsToRas', False)))
+            nodes.append(surfaceNode)
+
+            # clip the surface with ROI boxes at the cut positions along the centerline
+            cutPositions = caseParameters.get('roiCutPositions') or []
+            if cutPositions:
+                endPointsNode = self.createEndPointsNode("CenterlineEndPoints", caseParameters.get('endPoints'), int(caseParameters.get('inlet', 0)))
+                nodes.append(endPointsNode)
+                if caseParameters.get('endPoints') is None:
+                    self.autoDetectEndPoints(surfaceNode.GetPolyData(), endPointsNode)
+                    self.setInletEndPoint(endPointsNode, int(caseParameters.get('inlet', 0)))
+                centerlinePolyData = self.computeCenterline(surfaceNode.GetPolyData(), endPointsNode)
+                ROIModelNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLModelNode', 'open_model')
+                nodes.append(ROIModelNode)
+                self.clipSurfaceAtCenterlinePoints(surfaceNode, centerlinePolyData, cutPositions, ROIModelNode)
+                outFilePaths.append(f'{outFilePrefix}_ROI.vtp')
+                self.writePolyData(ROIModelNode.GetPolyData(), outFilePaths[-1])
+                surfaceNode = ROIModelNode
+
+            # endpoints of the (clipped) surface for the centerline for the 2D maps
+            roiEndPoints = caseParameters.get('roiEndPoints', caseParameters.get('endPoints') if not cutPositions else None)
+            roiInlet = int(caseParameters.get('roiInlet', caseParameters.get('inlet', 0)))
+            roiEndPointsNode = self.createEndPointsNode("CenterlineROIEndPoints", roiEndPoints, roiInlet)
+            nodes.append(roiEndPointsNode)
+            if roiEndPoints is None:
+                self.autoDetectEndPoints(surfaceNode.GetPolyData(), roiEndPointsNode)
+                self.setInletEndPoint(roiEndPointsNode, roiInlet)
+
+            # centerline and mapping
+            (centerlinePolyData, bifurcationRefSysPolyData) = self.computeCenterlineForMap(surfaceNode.GetPolyData(), roiEndPointsNode)
+            surfaceMappingPolyData = self.computeSurfaceMapping(surfaceNode.GetPolyData(), centerlinePolyData, bifurcationRefSysPolyData, parallel,
+                                                                bool(caseParameters.get('adaptiveRefinement', False)))
+
+            # patching, all branches are used if no group ids are given
+            groupIds = caseParameters.get('groupIds')
+            if not groupIds:
+                groupIds = self.centerlineToNumpy(centerlinePolyData).groupIds.tolist()
+            maps = self.computeMaps(surfaceMappingPolyData, centerlinePolyData, [int(groupId) for groupId in groupIds],
+                                    longitudinalPatchSize, circularNumberOfPatches, parallel)
+
+            if caseParameters.get('compactExport'):
+                # all maps in one file instead of the .vtp and .csv files
+                metadata = {'longitudinalPatchSize': longitudinalPatchSize, 'circularNumberOfPatches': circularNumberOfPatches,
+                            'selectedBranchIds': [int(groupId) for groupId in groupIds], 'inlet': self.getInletIndex(roiEndPointsNode),
+                            'inletPosition': list(roiEndPointsNode.GetNthControlPointPositionWorld(self.getInletIndex(roiEndPointsNode)))}
+                outFilePaths.append(f'{outFilePrefix}_maps.npz')
+                self.exportMapsCompact(outFilePaths[-1], maps['BranchPatched'], maps['BranchPatching'], metadata)
+            else:
+                # save results, same files as the save maps button of the widget
+                for (polyData, suffix) in [(surfaceMappingPolyData, 'mapping'), (maps['SurfacePatching'], 'patching'),
+                                           (maps['BranchPatching'], 'branchpatching'), (maps['BranchMapping'], 'branchmapping'),
+                                           (maps['BranchFlattened'], 'branchflattened')]:
+                    outFilePaths.append(f'{outFilePrefix}_{suffix}.vtp')
+                    self.writePolyData(polyData, outFilePaths[-1])
+
+                #save 2D maps to .csv, prox at the bottom, dist at the top
+                (variableNames, variableMaps) = self.computeVariableMaps(maps['BranchPatched'])
+                scalars = caseParameters.get('scalars') or variableNames
+                for scalarName in scalars:
+                    if scalarName not in variableNames:
+                        logging.warning(f"{caseId}: scalar {scalarName} not found in the patched data")
+                        continue
+                    outFilePaths.append(f'{outFilePrefix}_Branch_{scalarName}_2DMap.csv')
+                    np.savetxt(outFilePaths[-1], np.fliplr(np.flipud(variableMaps[variableNames.index(scalarName)])), delimiter=",",fmt='%1.3f')
+        finally:
+            for node in nodes:
+                slicer.mrmlScene.RemoveNode(node)
+            # the cached maps are not needed anymore for this case
+            self.variableMapCache.clear()
+
+        return outFilePaths
+
+    def getInletIndex(self, endPointsNode):
+        """ index of the inlet endpoint, i.e. the unselected control point. Returns None if there is no inlet """
+        for i in range(endPointsNode.GetNumberOfControlPoints()):
+            if not endPointsNode.GetNthControlPointSelected(i):
+                return i
+        return None
+
+    def getPatchTensor(self, patchingPolyData):
+        """ (GroupIds, Slab, Sector, PatchArea) of each patch of the patched surface, as an array of shape (number of patches, 4) """
+        from vtk.util import numpy_support
+
+        cellData = patchingPolyData.GetCellData()
+        columns = []
+        for arrayName in [self.groupIdsArrayName, self.longitudinalPatchNumberArrayName, self.circularPatchNumberArrayName, self.patchAreaArrayName]:
+            if not cellData.HasArray(arrayName):
+                raise ValueError(f"Patched surface has no {arrayName} cell data")
+            columns.append(numpy_support.vtk_to_numpy(cellData.GetArray(arrayName)))
+        return np.column_stack(columns).astype(np.float32)
+
+    def exportMapsCompact(self, filePath, patched2DImage, patchingPolyData, metadata, saveQueue=None):
+        """ save the 2D maps of all variables, the patch tensor and the metadata to one compressed .npz file
+        (see CFDModelPostprocessingLib/CompactExport.py to read it). If a save queue is given, the file is written in the background
+        """
+        from CFDModelPostprocessingLib import CompactExport
+
+        (variableNames, variableMaps) = self.computeVariableMaps(patched2DImage)
+        patchTensor = self.getPatchTensor(patchingPolyData)
+        if saveQueue:
+            saveQueue.submit(filePath, lambda: CompactExport.writeCompactMaps(filePath, variableNames, variableMaps, patchTensor, metadata))
+        else:
+            CompactExport.writeCompactMaps(filePath, variableNames, variableMaps, patchTensor, metadata)
+
+    def computeCohortStatistics(self, mapFilePaths, outputDirectory, excludedCaseIds=(), gridShape=None, quantiles=None):
+        """ streaming mean, std and quantile maps of the 2D maps (csv files saved with the save maps button) of a cohort.
+        The state is kept in outputDirectory, so maps can be added and cases excluded or included later without reprocessing all maps.
+        returns the CohortStatistics object
+        """
+        from CFDModelPostprocessingLib import CohortStatistics
+
+        stateFilePath = os.path.join(outputDirectory, 'cohort_statistics.npz')
+        if os.path.exists(stateFilePath):
+            statistics = CohortStatistics.CohortStatistics.load(stateFilePath)
+        else:
+            statistics = CohortStatistics.CohortStatistics(gridShape or CohortStatistics.DEFAULT_GRID_SHAPE, 
+                                                           quantiles or CohortStatistics.DEFAULT_QUANTILES, os.path.join(outputDirectory, 'cache'))
+
+        # add new maps one at a time, excluded cases are cached so they can be included later
+        for mapFilePath in mapFilePaths:
+            statistics.checkVariable(CohortStatistics.variableFromFilePath(mapFilePath))
+            caseId = CohortStatistics.caseIdFromFilePath(mapFilePath)
+            if caseId not in statistics.caseIds and not os.path.exists(statistics.cacheFilePath(caseId)):
+                statistics.addCase(caseId, CohortStatistics.readMapCSV(mapFilePath))
+                
+        # update case inclusion from the cached maps
+        cachedCaseIds = [CohortStatistics.caseIdFromFilePath(mapFilePath) for mapFilePath in mapFilePaths]
+        for caseId in cachedCaseIds:
+            if caseId in excludedCaseIds and caseId in statistics.caseIds:
+                statistics.removeCase(caseId)
+            elif caseId not in excludedCaseIds and caseId not in statistics.caseIds:
+                statistics.addCase(caseId)
+        statistics.excludedCaseIds = list(excludedCaseIds)
+
+        statistics.writeMaps(outputDirectory)
+        statistics.save(stateFilePath)
+
+        return statistics
+
     def computeBifurcationReferenceSystems(self,centerlinePolyData):
         """ compute bifurcation reference systems. Based on vmtkbifurcationreferencesystems pyscript"""
         import vtkvmtkComputationalGeometryPython as vtkvmtkComputationalGeometry
@@ -1450,63 +1845,152 @@ class CFDModelPostprocessingLogic(ScriptedLoadableModuleLogic):
         
     def computeBranchMapping(self, surfacePolyData, centerlinePolyData,referenceSystems):
         """ compute branch mapping, based on vmtkbrancmapping pyscript"""
-        import vtkvmtkComputationalGeometryPython as vtkvmtkComputationalGeometry
-        import vtkvmtkDifferentialGeometryPython as vtkvmtkDifferentialGeometry
-                
-        boundaryMetricFilter = vtkvmtkComputationalGeometry.vtkvmtkPolyDataReferenceSystemBoundaryMetricFilter()
-        boundaryMetricFilter.SetInputData(surfacePolyData)
-        boundaryMetricFilter.SetBoundaryMetricArrayName(self.boundaryMetricArrayName)
-        boundaryMetricFilter.SetGroupIdsArrayName(self.groupIdsArrayName)
-        boundaryMetricFilter.SetCenterlines(centerlinePolyData)
-        boundaryMetricFilter.SetCenterlineAbscissasArrayName(self.abscissaArrayName)
-        boundaryMetricFilter.SetCenterlineRadiusArrayName(self.radiusArrayName)
-        boundaryMetricFilter.SetCenterlineGroupIdsArrayName(self.groupIdsArrayName)
-        boundaryMetricFilter.SetCenterlineTractIdsArrayName(self.tractIdsArrayName)
-        boundaryMetricFilter.SetCenterlineIdsArrayName(self.centerlineIdsArrayName)
-        boundaryMetricFilter.SetReferenceSystems(referenceSystems)
-        boundaryMetricFilter.SetReferenceSystemGroupIdsArrayName(self.groupIdsArrayName)
-        boundaryMetricFilter.Update()
-
-        harmonicMappingFilter = vtkvmtkDifferentialGeometry.vtkvmtkPolyDataMultipleCylinderHarmonicMappingFilter()
-        harmonicMappingFilter.SetInputConnection(boundaryMetricFilter.GetOutputPort())
-        harmonicMappingFilter.SetHarmonicMappingArrayName(self.harmonicMappingArrayName)
-        harmonicMappingFilter.SetGroupIdsArrayName(self.groupIdsArrayName)
-        harmonicMappingFilter.Update()
+        from CFDModelPostprocessingLib import BranchProcessing
 
-        
-        stretchFilter = vtkvmtkComputationalGeometry.vtkvmtkPolyDataStretchMappingFilter()
-        stretchFilter.SetInputConnection(harmonicMappingFilter.GetOutputPort())
-        stretchFilter.SetStretchedMappingArrayName(self.stretchedMappingArrayName)
-        stretchFilter.SetHarmonicMappingArrayName(self.harmonicMappingArrayName)
-        stretchFilter.SetGroupIdsArrayName(self.groupIdsArrayName)
-        stretchFilter.SetMetricArrayName(self.abscissaMetricArrayName)
-        stretchFilter.SetBoundaryMetricArrayName(self.boundaryMetricArrayName)
-        stretchFilter.UseBoundaryMetricOn()
-        stretchFilter.Update()
-
-        return stretchFilter.GetOutput()
+        return BranchProcessing.computeBranchMapping(surfacePolyData, centerlinePolyData, referenceSystems, self.getArrayNames())
         
     def computeBranchPatching(self,surfacePolyData,longitudinalPatchSize, circularNumberOfPatches):
         """ compute patching of surface and attributes, based on vmtkbranchmapping pyscript """
-        
-        import vtkvmtkComputationalGeometryPython as vtkvmtkComputationalGeometry
-        
-        patchSize = [longitudinalPatchSize, 1.0/float(circularNumberOfPatches)]
-        
-        patchingFilter = vtkvmtkComputationalGeometry.vtkvmtkPolyDataPatchingFilter()
-        patchingFilter.SetInputData(surfacePolyData)
-        patchingFilter.SetCircularPatching(1)
-        patchingFilter.SetUseConnectivity(1)
-        patchingFilter.SetLongitudinalMappingArrayName(self.longitudinalMappingArrayName)
-        patchingFilter.SetCircularMappingArrayName(self.circularMappingArrayName)
-        patchingFilter.SetLongitudinalPatchNumberArrayName(self.longitudinalPatchNumberArrayName)
-        patchingFilter.SetCircularPatchNumberArrayName(self.circularPatchNumberArrayName)
-        patchingFilter.SetPatchAreaArrayName(self.patchAreaArrayName)
-        patchingFilter.SetGroupIdsArrayName(self.groupIdsArrayName)
-        patchingFilter.SetPatchSize(patchSize)
-        patchingFilter.Update()
-
-        return (patchingFilter.GetOutput(), patchingFilter.GetPatchedData())
+        from CFDModelPostprocessingLib import BranchProcessing
+
+        return BranchProcessing.computeBranchPatching(surfacePolyData, longitudinalPatchSize, circularNumberOfPatches, self.getArrayNames())
+
+    def getArrayNames(self):
+        """ dictionary of the array names used in the computations, to pass them to BranchProcessing """
+        return {name: value for (name, value) in vars(self).items() if name.endswith('ArrayName')}
+
+    def splitSurfaceByGroupIds(self,surfacePolyData):
+        """ split a surface with GroupIds point data (e.g. output of splitSurface) into one surface per branch.
+        returns a list of (groupId, branchPolyData) sorted by groupId
+        """
+        from vtk.numpy_interface import dataset_adapter as dsa
+
+        groupIds = np.unique(dsa.WrapDataObject(surfacePolyData).PointData[self.groupIdsArrayName])
+        branches = []
+        for groupId in groupIds:
+            threshold = vtk.vtkThreshold()
+            threshold.SetInputData(surfacePolyData)
+            threshold.SetInputArrayToProcess(0, 0, 0, vtk.vtkDataObject.FIELD_ASSOCIATION_POINTS, self.groupIdsArrayName)
+            threshold.SetLowerThreshold(groupId-0.5)
+            threshold.SetUpperThreshold(groupId+0.5)
+            threshold.SetThresholdFunction(vtk.vtkThreshold.THRESHOLD_BETWEEN)
+            threshold.AllScalarsOn()
+            geometryFilter = vtk.vtkGeometryFilter()
+            geometryFilter.SetInputConnection(threshold.GetOutputPort())
+            geometryFilter.Update()
+            branches.append((int(groupId), geometryFilter.GetOutput()))
+
+        return branches
+
+    def runWorkerProcesses(self, workerFunction, workerArgumentsList, numberOfProcesses=None):
+        """ run workerFunction for each tuple of arguments in a pool of PythonSlicer processes.
+        The worker function must be importable without the Slicer application (see CFDModelPostprocessingLib).
+        returns the results in the order of the arguments
+        """
+        import concurrent.futures
+        import multiprocessing
+        import shutil
+
+        pythonSlicerExecutable = shutil.which('PythonSlicer')
+        if not pythonSlicerExecutable:
+            pythonSlicerExecutable = os.path.join(slicer.app.slicerHome, 'bin', 'PythonSlicer.exe' if os.name == 'nt' else 'PythonSlicer')
+        # the embedded python interpreter of Slicer cannot be used to start new processes, use PythonSlicer instead. 
+        # The workers get the sys.path of this process, so vmtk can be imported
+        context = multiprocessing.get_context('spawn')
+        context.set_executable(pythonSlicerExecutable)
+
+        if not numberOfProcesses:
+            numberOfProcesses = os.cpu_count() or 1
+        numberOfProcesses = max(1, min(numberOfProcesses, len(workerArgumentsList)))
+
+        with concurrent.futures.ProcessPoolExecutor(max_workers=numberOfProcesses, mp_context=context) as executor:
+            futures = [executor.submit(workerFunction, *workerArguments) for workerArguments in workerArgumentsList]
+            return [future.result() for future in futures]
+
+    def computeBranchMappingParallel(self, surfacePolyData, centerlinePolyData, referenceSystems, numberOfProcesses=None):
+        """ compute the branch mapping (see computeBranchMapping) for each branch (GroupId) in a separate process and merge the 
+        mapped branches into one surface. 
+        """
+        from CFDModelPostprocessingLib import BranchProcessing
+
+        branches = self.splitSurfaceByGroupIds(surfacePolyData)
+        centerlineString = BranchProcessing.dataObjectToString(centerlinePolyData)
+        referenceSystemsString = BranchProcessing.dataObjectToString(referenceSystems)
+        arrayNames = self.getArrayNames()
+        workerArgumentsList = [(BranchProcessing.dataObjectToString(branchPolyData), centerlineString, referenceSystemsString, arrayNames) 
+                               for (groupId, branchPolyData) in branches]
+        results = self.runWorkerProcesses(BranchProcessing.mapBranchWorker, workerArgumentsList, numberOfProcesses)
+
+        appendFilter = vtk.vtkAppendPolyData()
+        for result in results:
+            appendFilter.AddInputData(BranchProcessing.dataObjectFromString(result))
+        appendFilter.Update()
+
+        return appendFilter.GetOutput()
+
+    def computeBranchPatchingParallel(self, surfacePolyData, longitudinalPatchSize, circularNumberOfPatches, numberOfProcesses=None, computePatchedData=True):
+        """ compute the patching (see computeBranchPatching) for each branch (GroupId) in a separate process. 
+        returns the merged patched surface and the merged patched image data (None if computePatchedData is False)
+        """
+        from CFDModelPostprocessingLib import BranchProcessing
+
+        branches = self.splitSurfaceByGroupIds(surfacePolyData)
+        arrayNames = self.getArrayNames()
+        workerArgumentsList = [(BranchProcessing.dataObjectToString(branchPolyData), longitudinalPatchSize, circularNumberOfPatches, arrayNames, computePatchedData) 
+                               for (groupId, branchPolyData) in branches]
+        results = self.runWorkerProcesses(BranchProcessing.patchBranchWorker, workerArgumentsList, numberOfProcesses)
+
+        appendFilter = vtk.vtkAppendPolyData()
+        patchedImages = []
+        for (patchingString, patchedString) in results:
+            appendFilter.AddInputData(BranchProcessing.dataObjectFromString(patchingString))
+            if computePatchedData:
+                patchedImages.append(BranchProcessing.dataObjectFromString(patchedString, imageData=True))
+        appendFilter.Update()
+
+        return (appendFilter.GetOutput(), self.mergePatchedImages(patchedImages) if computePatchedData else None)
+
+    def mergePatchedImages(self, patchedImages):
+        """ merge the patched image data of single branches into one image with one slice (k) per branch, in the order of the list.
+        Each branch is placed at its own patch indices (given by the origin of its image), as in the patched data of the whole 
+        surface, and the patches that a branch does not have are zero
+        """
+        from vtk.util import numpy_support
+
+        dimensionsList = [patchedImage.GetDimensions() for patchedImage in patchedImages]
+        spacing = np.array(patchedImages[0].GetSpacing())
+        origins = np.array([patchedImage.GetOrigin() for patchedImage in patchedImages])
+        mergedOrigin = origins.min(axis=0)
+        # index offset (i,j) of each branch in the merged image
+        offsetsList = [tuple(int(offset) for offset in np.round((origin - mergedOrigin)[:2]/np.where(spacing[:2] != 0, spacing[:2], 1.0)))
+                       for origin in origins]
+        mergedDimensions = (max(offset[0] + d[0] for (offset, d) in zip(offsetsList, dimensionsList)),
+                            max(offset[1] + d[1] for (offset, d) in zip(offsetsList, dimensionsList)),
+                            sum(d[2] for d in dimensionsList))
+        mergedImage = vtk.vtkImageData()
+        mergedImage.SetDimensions(mergedDimensions)
+        mergedImage.SetOrigin(mergedOrigin[0], mergedOrigin[1], patchedImages[0].GetOrigin()[2])
+        mergedImage.SetSpacing(patchedImages[0].GetSpacing())
+
+        # only keep the arrays that are present for all branches
+        pointData = patchedImages[0].GetPointData()
+        arrayNames = [pointData.GetArrayName(i) for i in range(pointData.GetNumberOfArrays())]
+        arrayNames = [name for name in arrayNames if all(patchedImage.GetPointData().HasArray(name) for patchedImage in patchedImages)]
+        for arrayName in arrayNames:
+            numberOfComponents = pointData.GetArray(arrayName).GetNumberOfComponents()
+            dataType = numpy_support.vtk_to_numpy(pointData.GetArray(arrayName)).dtype
+            # numpy array indexed [k,j,i,component], as the vtk image data
+            mergedArray = np.zeros(tuple(reversed(mergedDimensions)) + (numberOfComponents,), dtype=dataType)
+            k = 0
+            for (patchedImage, dimensions, (i, j)) in zip(patchedImages, dimensionsList, offsetsList):
+                branchArray = numpy_support.vtk_to_numpy(patchedImage.GetPointData().GetArray(arrayName))
+                mergedArray[k:k+dimensions[2], j:j+dimensions[1], i:i+dimensions[0], :] = branchArray.reshape(tuple(reversed(dimensions)) + (numberOfComponents,))
+                k += dimensions[2]
+            vtkArray = numpy_support.numpy_to_vtk(mergedArray.reshape(-1, numberOfComponents), deep=True)
+            vtkArray.SetName(arrayName)
+            mergedImage.GetPointData().AddArray(vtkArray)
+
+        return mergedImage
 
     def computeCenterlineOffsetAttributes(self,centerlinePolyData,referenceSystems):
         import vtkvmtkComputationalGeometryPython as vtkvmtkComputationalGeometry
@@ -1527,26 +2011,64 @@ class CFDModelPostprocessingLogic(ScriptedLoadableModuleLogic):
 
         return offsetFilter.GetOutput()
 
-    def flattenMappedSurface(mappedSurfacePolyData):
-        # code based on discussion at http:
-    
-        # requires surface mapped with vmtkBranchMapping 
-        # as we need the AngularMetric and the StretchedMapping arrays
-        numberofpoints = mappedSurfacePolyData.GetNumberOfPoints()
-        points = vtk.vtkPoints()
-        points.SetNumberOfPoints(numberofpoints)    
+    def flattenMappedSurface(self,mappedSurfacePolyData,branchSpacing=1.0):
+        """ flattened 2D surface with the point coordinates (AngularMetric, StretchedMapping, 0), keeping all point and cell data.
+        requires surface mapped with vmtkBranchMapping, as we need the AngularMetric and the StretchedMapping arrays.
+        Each branch (GroupIds) is placed next to the previous one along x, separated by branchSpacing. Cells crossing the 
+        angular seam (-pi/pi) are removed as they would span the whole width of the branch.
+        """
+        from vtk.util import numpy_support
 
-        for i in range(numberofpoints):
-        
-            pointx =mapped_surface.GetPointData().GetArray(self.angularMetricArrayName).GetValue(i)
-            pointy = mapped_surface.GetPointData().GetArray(self.stretchedMappingArrayName).GetValue(i)
-            pointz = 0.0
-            point = (pointx, pointy, pointz)
-            points.SetPoint(i,point)
+        pointData = mappedSurfacePolyData.GetPointData()
+        angularMetric = numpy_support.vtk_to_numpy(pointData.GetArray(self.angularMetricArrayName))
+        stretchedMapping = numpy_support.vtk_to_numpy(pointData.GetArray(self.stretchedMappingArrayName))
+        flattenedPoints = np.zeros((angularMetric.shape[0], 3))
+        flattenedPoints[:,0] = angularMetric
+        flattenedPoints[:,1] = stretchedMapping
+
+        # offset the branches along x
+        if pointData.HasArray(self.groupIdsArrayName):
+            groupIds = numpy_support.vtk_to_numpy(pointData.GetArray(self.groupIdsArrayName))
+            (_, branchIndices) = np.unique(groupIds, return_inverse=True)
+            flattenedPoints[:,0] += branchIndices.ravel()*(2*np.pi + branchSpacing)
 
+        points = vtk.vtkPoints()
+        points.SetData(numpy_support.numpy_to_vtk(flattenedPoints, deep=True))
         output = vtk.vtkPolyData()
-        output.DeepCopy(mappedSurfacePolyData)
         output.SetPoints(points)
+        output.GetPointData().ShallowCopy(pointData)
+
+        # find the cells crossing the angular seam
+        polys = mappedSurfacePolyData.GetPolys()
+        offsets = numpy_support.vtk_to_numpy(polys.GetOffsetsArray())
+        connectivity = numpy_support.vtk_to_numpy(polys.GetConnectivityArray())
+        seamCells = np.zeros(polys.GetNumberOfCells(), dtype=bool)
+        if connectivity.size:
+            cellAngles = angularMetric[connectivity]
+            seamCells = (np.maximum.reduceat(cellAngles, offsets[:-1]) - np.minimum.reduceat(cellAngles, offsets[:-1])) > np.pi
+        
+        if not seamCells.any():
+            output.SetPolys(polys)
+            output.GetCellData().ShallowCopy(mappedSurfacePolyData.GetCellData())
+            return output
+
+        # keep the other cells, and their cell data
+        keptCells = np.nonzero(~seamCells)[0]
+        cellSizes = np.diff(offsets)[keptCells]
+        keptOffsets = np.concatenate([[0], np.cumsum(cellSizes)])
+        keptConnectivity = connectivity[np.repeat(offsets[keptCells] - keptOffsets[:-1], cellSizes) + np.arange(keptOffsets[-1])]
+        keptPolys = vtk.vtkCellArray()
+        keptPolys.SetData(numpy_support.numpy_to_vtk(keptOffsets, deep=True, array_type=vtk.VTK_ID_TYPE), 
+                          numpy_support.numpy_to_vtk(keptConnectivity, deep=True, array_type=vtk.VTK_ID_TYPE))
+        output.SetPolys(keptPolys)
+        cellData = mappedSurfacePolyData.GetCellData()
+        for i in range(cellData.GetNumberOfArrays()):
+            array = cellData.GetArray(i)
+            if not array:
+                continue
+            keptArray = numpy_support.numpy_to_vtk(numpy_support.vtk_to_numpy(array)[keptCells], deep=True, array_type=array.GetDataType())
+            keptArray.SetName(array.GetName())
+            output.GetCellData().AddArray(keptArray)
 
         return output 
 
@@ -1559,6 +2081,60 @@ class CFDModelPostprocessingLogic(ScriptedLoadableModuleLogic):
        
         return patchVariableData 
     
+    def computeVariableMaps(self,patched2DImage):
+        """ extract the 2D maps of all variables in the patched image at once and store them in a contiguous float32 stack.
+        returns the list of variable names and the stack of maps, the maps are kept in a cache so this is only computed once per patched image
+        """
+        cacheKey = (patched2DImage.GetAddressAsString('vtkImageData'), patched2DImage.GetMTime())
+        if cacheKey in self.variableMapCache:
+            self.variableMapCache.move_to_end(cacheKey)
+            return self.variableMapCache[cacheKey]
+
+        pointData = patched2DImage.GetPointData()
+        variableNames = [pointData.GetArrayName(i) for i in range(pointData.GetNumberOfArrays()) 
+                         if pointData.GetArray(i) and pointData.GetArray(i).GetNumberOfComponents() == 1]
+        variableMaps = None
+        for (i, variableName) in enumerate(variableNames):
+            variableMap = self.extractVariableMap(patched2DImage,variableName)
+            if variableMaps is None:
+                variableMaps = np.empty((len(variableNames),) + variableMap.shape, dtype=np.float32)
+            variableMaps[i] = variableMap
+
+        self.variableMapCache[cacheKey] = (variableNames, variableMaps)
+        # remove least recently used maps
+        while len(self.variableMapCache) > self.variableMapCacheSize:
+            self.variableMapCache.popitem(last=False)
+
+        return (variableNames, variableMaps)
+
+    def getVariableMap(self,patched2DImage,variableName):
+        """ get the 2D map of a variable from the precomputed maps. Returns a view into the cached stack, or None if the variable is not present """
+        (variableNames, variableMaps) = self.computeVariableMaps(patched2DImage)
+        if variableName not in variableNames:
+            return None
+        return variableMaps[variableNames.index(variableName)]
+
+    def swapVolumeScalars(self,volumeNode,variableMap):
+        """ replace the scalars of the volume node by the (cached) variable map without copying the data. 
+        returns False if the volume node has no image data of the same dimensions, in which case the volume has to be updated from the array
+        """
+        from vtk.util import numpy_support
+
+        imageData = volumeNode.GetImageData() if volumeNode else None
+        if not imageData or not imageData.GetPointData().GetScalars():
+            return False
+        dimensions = imageData.GetDimensions()
+        if dimensions[:variableMap.ndim] != tuple(reversed(variableMap.shape)) or imageData.GetNumberOfPoints() != variableMap.size:
+            return False
+
+        # the vtk array keeps a reference to the cached map, so it stays valid when the map is removed from the cache
+        scalars = numpy_support.numpy_to_vtk(variableMap.ravel(), deep=False, array_type=vtk.VTK_FLOAT)
+        scalars.SetName(imageData.GetPointData().GetScalars().GetName())
+        imageData.GetPointData().SetScalars(scalars)
+        slicer.util.arrayFromVolumeModified(volumeNode)
+
+        return True
+
     def extractCenterlineGroup(self,centerlinePolyData,groupId):
         """ extract single centerline based on groupID
             returns dictionary with points and pointIds
@@ -1566,14 +2142,19 @@ class CFDModelPostprocessingLogic(ScriptedLoadableModuleLogic):
     
         clData = self.centerlineToNumpy(centerlinePolyData)
         # get the points corresponding to the groupId
-        groupIdIdx = np.where(clData['CellData']['GroupIds']==groupId)[0][0]
-        pointIds = clData['CellData']['CellPointIds'][groupIdIdx]
-        points = clData['Points'][pointIds]
+        pointIds = clData.getGroupPointIds(groupId)
         centerlineData = dict()
         centerlineData['PointIds'] = pointIds
-        centerlineData['Points'] = points
+        centerlineData['Points'] = clData.points[pointIds]
     
         return centerlineData
+
+    def centerlineToNumpy(self, centerlinePolyData):
+        """ columnar (numpy) centerline data: points, CSR cell offsets, point and cell arrays and lookups by group and point.
+        see ClipBranches.CenterlineData
+        """
+        import ClipBranches
+        return ClipBranches.CenterlineData.get(centerlinePolyData)
     
     def computeCenterlineAttributes(self, centerlinePolyData):
         """ compute centerline attributes such as AbscissaMetric,AngularMetric 
@@ -1595,6 +2176,121 @@ class CFDModelPostprocessingLogic(ScriptedLoadableModuleLogic):
         subdivisionFilter.Update()
 
         return subdivisionFilter.GetOutput()
+
+    def adaptiveSubdivideSurface(self, surfacePolyData, centerlinePolyData, edgeLengthRadiusRatio=0.25, refineGroupBoundaries=True):
+        """ subdivide only the triangles with an edge longer than edgeLengthRadiusRatio times the local centerline radius and, 
+        if refineGroupBoundaries is set, the triangles near the group (branch) boundaries, where holes show up in the mapping.
+        Marked triangles are split in 4 (red), their neighbours in 2 (green) to keep the mesh conforming. 
+        Point data is interpolated linearly at the new points, cell data is copied from the parent triangles.
+        """
+        import OpenSurface
+        from vtk.util import numpy_support
+
+        triangleFilter = vtk.vtkTriangleFilter()
+        triangleFilter.SetInputData(surfacePolyData)
+        triangleFilter.PassVertsOff()
+        triangleFilter.PassLinesOff()
+        triangleFilter.Update()
+        surface = triangleFilter.GetOutput()
+
+        points = numpy_support.vtk_to_numpy(surface.GetPoints().GetData())
+        triangles = numpy_support.vtk_to_numpy(surface.GetPolys().GetConnectivityArray()).reshape(-1,3)
+        numberOfPoints = points.shape[0]
+
+        # unique edges, edgeIds[i,k] is the edge between vertex k and k+1 of triangle i
+        triangleEdges = np.sort(triangles[:,[[0,1],[1,2],[2,0]]], axis=2).reshape(-1,2)
+        (edges, edgeIds) = np.unique(triangleEdges, axis=0, return_inverse=True)
+        edgeIds = edgeIds.reshape(-1,3)
+
+        # local radius and group of the closest centerline point of each surface point
+        centerlineData = self.centerlineToNumpy(centerlinePolyData)
+        closestPointIds = OpenSurface.CenterlinePointLocator.get(centerlinePolyData).findClosestPoints(points)
+        pointRadius = centerlineData.pointData[self.radiusArrayName][closestPointIds]
+
+        # mark triangles to refine
+        edgeLengths = np.linalg.norm(points[edges[:,0]] - points[edges[:,1]], axis=1)
+        edgeRadius = np.minimum(pointRadius[edges[:,0]], pointRadius[edges[:,1]])
+        markedTriangles = np.any((edgeLengths > edgeLengthRadiusRatio*edgeRadius)[edgeIds], axis=1)
+        if refineGroupBoundaries and self.groupIdsArrayName in centerlineData.cellData:
+            pointGroupIds = centerlineData.cellData[self.groupIdsArrayName][centerlineData.pointCellIds[closestPointIds]]
+            triangleGroupIds = pointGroupIds[triangles]
+            markedTriangles |= (triangleGroupIds[:,0] != triangleGroupIds[:,1]) | (triangleGroupIds[:,0] != triangleGroupIds[:,2])
+
+        # split the edges of the marked triangles, triangles with 2 split edges are refined as well (closure)
+        splitEdges = np.zeros(edges.shape[0], dtype=bool)
+        splitEdges[edgeIds[markedTriangles]] = True
+        while True:
+            numberOfSplitEdges = np.sum(splitEdges[edgeIds], axis=1)
+            closure = (numberOfSplitEdges == 2)
+            if not closure.any():
+                break
+            splitEdges[edgeIds[closure]] = True
+
+        if not splitEdges.any():
+            return surface
+
+        # new points at the middle of the split edges
+        splitEdgeIds = np.nonzero(splitEdges)[0]
+        midPointIds = np.full(edges.shape[0], -1, dtype=np.int64)
+        midPointIds[splitEdgeIds] = numberOfPoints + np.arange(splitEdgeIds.shape[0])
+        (edgeStart, edgeEnd) = (edges[splitEdgeIds,0], edges[splitEdgeIds,1])
+
+        # red triangles: split into 4
+        red = (numberOfSplitEdges == 3)
+        (a, b, c) = triangles[red].T
+        (mab, mbc, mca) = midPointIds[edgeIds[red]].T
+        redTriangles = np.stack([np.stack([a,mab,mca],1), np.stack([mab,b,mbc],1), np.stack([mca,mbc,c],1), np.stack([mab,mbc,mca],1)], axis=1).reshape(-1,3)
+        redParents = np.repeat(np.nonzero(red)[0], 4)
+
+        # green triangles: split into 2, rotate the triangle so the split edge is between the first two vertices
+        green = np.nonzero(numberOfSplitEdges == 1)[0]
+        splitEdgeIndex = np.argmax(splitEdges[edgeIds[green]], axis=1)
+        rotation = (splitEdgeIndex[:,None] + np.arange(3)[None,:]) % 3
+        (v0, v1, v2) = np.take_along_axis(triangles[green], rotation, axis=1).T
+        m = midPointIds[edgeIds[green, splitEdgeIndex]]
+        greenTriangles = np.stack([np.stack([v0,m,v2],1), np.stack([m,v1,v2],1)], axis=1).reshape(-1,3)
+        greenParents = np.repeat(green, 2)
+
+        unchanged = np.nonzero(numberOfSplitEdges == 0)[0]
+        newTriangles = np.concatenate([triangles[unchanged], redTriangles, greenTriangles])
+        parents = np.concatenate([unchanged, redParents, greenParents])
+
+        # output
+        output = vtk.vtkPolyData()
+        newPoints = vtk.vtkPoints()
+        newPoints.SetData(numpy_support.numpy_to_vtk(np.concatenate([points, 0.5*(points[edgeStart] + points[edgeEnd])]), deep=True))
+        output.SetPoints(newPoints)
+        polys = vtk.vtkCellArray()
+        polys.SetData(numpy_support.numpy_to_vtk(np.arange(0, 3*newTriangles.shape[0]+1, 3), deep=True, array_type=vtk.VTK_ID_TYPE),
+                      numpy_support.numpy_to_vtk(newTriangles.ravel(), deep=True, array_type=vtk.VTK_ID_TYPE))
+        output.SetPolys(polys)
+
+        # interpolate point data at the new points (integer arrays such as ids are copied from the first point of the edge)
+        pointData = surface.GetPointData()
+        for i in range(pointData.GetNumberOfArrays()):
+            array = pointData.GetArray(i)
+            if not array:
+                continue
+            values = numpy_support.vtk_to_numpy(array)
+            if np.issubdtype(values.dtype, np.floating):
+                newValues = 0.5*(values[edgeStart] + values[edgeEnd])
+            else:
+                newValues = values[edgeStart]
+            newArray = numpy_support.numpy_to_vtk(np.concatenate([values, newValues]), deep=True, array_type=array.GetDataType())
+            newArray.SetName(array.GetName())
+            output.GetPointData().AddArray(newArray)
+
+        # copy the cell data of the parent triangles
+        cellData = surface.GetCellData()
+        for i in range(cellData.GetNumberOfArrays()):
+            array = cellData.GetArray(i)
+            if not array:
+                continue
+            newArray = numpy_support.numpy_to_vtk(numpy_support.vtk_to_numpy(array)[parents], deep=True, array_type=array.GetDataType())
+            newArray.SetName(array.GetName())
+            output.GetCellData().AddArray(newArray)
+
+        return output
 #
 # CFDModelPostprocessingTest
 #
@@ -1616,6 +2312,9 @@ class CFDModelPostprocessingTest(ScriptedLoadableModuleTest):
         """
         self.setUp()
         self.test_CFDModelPostprocessing1()
+        self.setUp()
+        self.test_ParallelPatching()
+        self.test_CohortStatistics()
 
     def test_CFDModelPostprocessing1(self):
         """ Ideally you should have several levels of tests.  At the lowest level
@@ -1662,3 +2361,96 @@ class CFDModelPostprocessingTest(ScriptedLoadableModuleTest):
         self.assertEqual(outputScalarRange[1], inputScalarRange[1])
 
         self.delayDisplay('Test passed')
+
+    def test_ParallelPatching(self):
+        """ the patched data of the parallel patching (one process per branch) should be the same as the patched data 
+        of the whole surface
+        """
+        from vtk.util import numpy_support
+        self.delayDisplay("Starting the parallel patching test")
+        logic = CFDModelPostprocessingLogic()
+
+        # two mapped branches that start at a different abscissa
+        appendFilter = vtk.vtkAppendPolyData()
+        for (groupId, start, length) in [(0, 0.0, 10.0), (1, 4.0, 7.0)]:
+            cylinder = vtk.vtkCylinderSource()
+            cylinder.SetRadius(1.0)
+            cylinder.SetHeight(length)
+            cylinder.SetCenter(0.0, start + length/2, 0.0)
+            cylinder.SetResolution(32)
+            cylinder.CappingOff()
+            triangleFilter = vtk.vtkTriangleFilter()
+            triangleFilter.SetInputConnection(cylinder.GetOutputPort())
+            subdivisionFilter = vtk.vtkLinearSubdivisionFilter()
+            subdivisionFilter.SetInputConnection(triangleFilter.GetOutputPort())
+            subdivisionFilter.SetNumberOfSubdivisions(3)
+            subdivisionFilter.Update()
+            branchPolyData = subdivisionFilter.GetOutput()
+            points = numpy_support.vtk_to_numpy(branchPolyData.GetPoints().GetData())
+            for (arrayName, values) in [(logic.groupIdsArrayName, np.full(points.shape[0], groupId)),
+                                        (logic.longitudinalMappingArrayName, points[:,1]),
+                                        (logic.circularMappingArrayName, np.arctan2(points[:,2], points[:,0])),
+                                        ('WSS', points[:,1] + 100*groupId)]:
+                vtkArray = numpy_support.numpy_to_vtk(np.asarray(values, dtype=float), deep=True)
+                vtkArray.SetName(arrayName)
+                branchPolyData.GetPointData().AddArray(vtkArray)
+            appendFilter.AddInputData(branchPolyData)
+        appendFilter.Update()
+        surfacePolyData = appendFilter.GetOutput()
+
+        (_, serialPatchedData) = logic.computeBranchPatching(surfacePolyData, 1.0, 8)
+        (_, parallelPatchedData) = logic.computeBranchPatchingParallel(surfacePolyData, 1.0, 8)
+        self.assertEqual(serialPatchedData.GetDimensions(), parallelPatchedData.GetDimensions())
+        np.testing.assert_allclose(serialPatchedData.GetOrigin(), parallelPatchedData.GetOrigin())
+        for arrayName in ['WSS', logic.patchAreaArrayName]:
+            np.testing.assert_allclose(numpy_support.vtk_to_numpy(serialPatchedData.GetPointData().GetArray(arrayName)),
+                                       numpy_support.vtk_to_numpy(parallelPatchedData.GetPointData().GetArray(arrayName)))
+
+        self.delayDisplay('Test passed')
+
+    def test_CohortStatistics(self):
+        """ streaming cohort statistics against numpy: Welford mean and variance when cases are added and removed, 
+        P2 quantile estimates, and the state after a save/load round trip
+        """
+        import tempfile
+        from CFDModelPostprocessingLib import CohortStatistics
+        self.delayDisplay("Starting the cohort statistics test")
+
+        gridShape = (6, 5)
+        rng = np.random.default_rng(0)
+        maps = {f'case{i:03d}': rng.normal(10.0, 2.0, gridShape) for i in range(200)}
+        with tempfile.TemporaryDirectory() as outputDirectory:
+            statistics = CohortStatistics.CohortStatistics(gridShape, (0.25, 0.5, 0.75), os.path.join(outputDirectory, 'cache'))
+            for (caseId, map2D) in maps.items():
+                statistics.addCase(caseId, map2D)
+            # the statistics are computed from the cached float32 maps
+            stack = np.array([statistics.getResampledMap(caseId) for caseId in maps], dtype=np.float64)
+
+            # Welford mean and variance, also after removing cases
+            np.testing.assert_allclose(statistics.mean(), stack.mean(axis=0), rtol=1e-10)
+            np.testing.assert_allclose(statistics.variance(), stack.var(axis=0, ddof=1), rtol=1e-8)
+            removedCaseIds = list(maps)[:50]
+            for caseId in removedCaseIds:
+                statistics.removeCase(caseId)
+            np.testing.assert_allclose(statistics.mean(), stack[50:].mean(axis=0), rtol=1e-10)
+            np.testing.assert_allclose(statistics.variance(), stack[50:].var(axis=0, ddof=1), rtol=1e-8)
+
+            # P2 estimates are close to the exact quantiles of the included maps
+            np.testing.assert_allclose(statistics.quantileMaps(), np.percentile(stack[50:], [25, 50, 75], axis=0), atol=0.5)
+
+            # save/load round trip
+            stateFilePath = os.path.join(outputDirectory, 'cohort_statistics.npz')
+            statistics.save(stateFilePath)
+            loadedStatistics = CohortStatistics.CohortStatistics.load(stateFilePath)
+            self.assertEqual(loadedStatistics.caseIds, statistics.caseIds)
+            np.testing.assert_allclose(loadedStatistics.mean(), statistics.mean())
+            np.testing.assert_allclose(loadedStatistics.variance(), statistics.variance())
+            np.testing.assert_allclose(loadedStatistics.quantileMaps(), statistics.quantileMaps())
+
+            # maps of another variable are rejected
+            statistics.checkVariable(CohortStatistics.variableFromFilePath('case000_Branch_WSS_2DMap.csv'))
+            self.assertEqual(CohortStatistics.caseIdFromFilePath('case000_Branch_WSS_2DMap.csv'), 'case000')
+            with self.assertRaises(ValueError):
+                statistics.checkVariable(CohortStatistics.variableFromFilePath('case000_Branch_OSI_2DMap.csv'))
+
+        self.delayDisplay('Test passed')
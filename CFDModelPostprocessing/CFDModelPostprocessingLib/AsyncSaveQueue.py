@@ -0,0 +1,130 @@
+import queue
+import threading
+
+import vtk
+
+#
+# Background saving of results. The data is snapshotted (shallow copy) when a save is submitted, converted and written on a 
+# worker thread, the GUI polls the finished saves with pollResults. Models are written in LPS like slicer.util.saveNode.
+#
+
+COMPRESSORS = ['None', 'ZLib', 'LZ4', 'LZMA']
+
+def convertPolyDataToLPS(polyData):
+    """ copy of the (RAS) polydata in LPS coordinates, with the coordinate system in the field data ("SPACE"), 
+    the same way the model storage node of Slicer writes models, so the files are read back in the right place
+    """
+    rasToLps = vtk.vtkTransform()
+    rasToLps.Scale(-1.0, -1.0, 1.0)
+    transformFilter = vtk.vtkTransformFilter()
+    transformFilter.SetInputData(polyData)
+    transformFilter.SetTransform(rasToLps)
+    transformFilter.Update()
+    lpsPolyData = vtk.vtkPolyData()
+    lpsPolyData.ShallowCopy(transformFilter.GetOutput())
+
+    # the field data is shared with the input, do not modify it
+    fieldData = vtk.vtkFieldData()
+    fieldData.DeepCopy(polyData.GetFieldData())
+    coordinateSystem = vtk.vtkStringArray()
+    coordinateSystem.SetName('SPACE')
+    coordinateSystem.InsertNextValue('LPS')
+    fieldData.RemoveArray('SPACE')
+    fieldData.AddArray(coordinateSystem)
+    lpsPolyData.SetFieldData(fieldData)
+    return lpsPolyData
+
+def snapshotDataObject(dataObject):
+    """ shallow copy of polydata or imagedata, which is not affected when the nodes are updated with new data while 
+    it is being written
+    """
+    snapshot = dataObject.NewInstance()
+    snapshot.ShallowCopy(dataObject)
+    return snapshot
+
+def writeDataObject(dataObject, filePath, compressor='ZLib', compressionLevel=5):
+    """ write polydata (.vtp) or imagedata (.vti) with the xml writers, as is (see convertPolyDataToLPS for models) """
+    if dataObject.IsA('vtkImageData'):
+        writer = vtk.vtkXMLImageDataWriter()
+    else:
+        writer = vtk.vtkXMLPolyDataWriter()
+    writer.SetFileName(filePath)
+    writer.SetInputData(dataObject)
+    writer.SetDataModeToAppended()
+    if compressor == 'None':
+        writer.SetCompressorTypeToNone()
+    else:
+        getattr(writer, f'SetCompressorTypeTo{compressor}')()
+        writer.SetCompressionLevel(compressionLevel)
+    if not writer.Write():
+        raise IOError(f"Failed to write {filePath}")
+
+def writeModel(polyData, filePath, compressor='ZLib', compressionLevel=5):
+    """ write a (RAS) model to a .vtp file in LPS, like slicer.util.saveNode """
+    writeDataObject(convertPolyDataToLPS(polyData), filePath, compressor, compressionLevel)
+
+class AsyncSaveQueue:
+    """ queue of saves that are executed one after another on a worker thread """
+
+    def __init__(self):
+        self.compressor = 'ZLib'
+        self.compressionLevel = 5
+        self.tasks = queue.Queue()
+        self.results = queue.Queue()
+        self.numberOfPendingSaves = 0
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def submitDataObject(self, dataObject, filePath):
+        """ save a snapshot of polydata (in LPS) or imagedata to filePath """
+        snapshot = snapshotDataObject(dataObject)
+        (compressor, compressionLevel) = (self.compressor, self.compressionLevel)
+        # the models are converted to LPS on the worker thread
+        write = writeModel if snapshot.IsA('vtkPolyData') else writeDataObject
+        self.submit(filePath, lambda: write(snapshot, filePath, compressor, compressionLevel))
+
+    def submit(self, filePath, saveFunction):
+        """ call saveFunction on the worker thread. saveFunction should only use data that is not modified afterwards """
+        with self.lock:
+            self.numberOfPendingSaves += 1
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, name='AsyncSaveQueue', daemon=True)
+                self.thread.start()
+        self.tasks.put((filePath, saveFunction))
+
+    def run(self):
+        while True:
+            task = self.tasks.get()
+            if task is None:
+                return
+            (filePath, saveFunction) = task
+            try:
+                saveFunction()
+                error = None
+            except Exception as e:
+                error = str(e)
+            # the result is queued before the save is counted as finished, so it is polled before the timer stops
+            with self.lock:
+                self.results.put((filePath, error))
+                self.numberOfPendingSaves -= 1
+
+    def pollResults(self):
+        """ list of (filePath, error) of the saves that finished since the last call, error is None on success """
+        finishedSaves = []
+        while True:
+            try:
+                finishedSaves.append(self.results.get_nowait())
+            except queue.Empty:
+                return finishedSaves
+
+    def getNumberOfPendingSaves(self):
+        with self.lock:
+            return self.numberOfPendingSaves
+
+    def shutdown(self, wait=True):
+        """ stop the worker thread after the pending saves are written """
+        if self.thread is not None and self.thread.is_alive():
+            self.tasks.put(None)
+            if wait:
+                self.thread.join()
+        self.thread = None
@@ -0,0 +1,255 @@
+"""
+Headless batch postprocessing of a cohort of CFD models with CFDModelPostprocessingLogic.
+
+The cases are described in a manifest (JSON, or YAML if PyYAML is available), either a list of cases or a dictionary with
+an optional "defaults" section and a "cases" list. Each case is a dictionary with the keys:
+    id                      case name, used as prefix of the output files (default: file name without extension)
+    file                    surface file (.vtp, .vtk, .stl, tecplot .tec/.dat)
+    scaleFactor             scale factor of the tecplot files, e.g. 1000 for m to mm (default: no scaling)
+    lpsToRas                convert the tecplot coordinates from LPS to RAS (only used with scaleFactor)
+    endPoints               list of [x,y,z] endpoints of the surface (default: detected automatically)
+    inlet                   index of the inlet in endPoints (default 0)
+    roiCutPositions         list of centerline point indices or [x,y,z] positions at which the surface is clipped with a ROI box
+    roiEndPoints, roiInlet  endpoints and inlet of the clipped surface (default: detected automatically)
+    groupIds                group ids of the branches for the 2D maps (default: all branches)
+    longitudinalPatchSize   (default 1.0)
+    circularNumberOfPatches (default 8)
+    scalars                 names of the scalars saved as 2D maps (default: all)
+    parallel                map and patch the branches of a case in parallel worker processes
+    adaptiveRefinement      only refine coarse triangles and the triangles near branch boundaries before mapping
+    compactExport           save all 2D maps in one compressed .npz file instead of the .vtp files and one csv file per scalar
+
+Run the driver with python (or PythonSlicer) to distribute the cases over a pool of Slicer processes:
+    python BatchPostprocessing.py --slicer /path/to/Slicer --manifest cohort.json --output results --workers 4
+
+Each case is processed by
+    Slicer --no-main-window --python-script BatchPostprocessing.py --case-manifest results/case/case.json --output results/case
+
+The progress of all cases is stored in progress.json in the output directory. Cases that are done are skipped when the
+driver is run again, so an interrupted run can be resumed; use --retry-failed to also rerun the failed cases.
+"""
+
+import argparse
+import concurrent.futures
+import datetime
+import json
+import os
+import subprocess
+import sys
+import threading
+
+PROGRESS_FILE_NAME = 'progress.json'
+STATUS_FILE_NAME = 'status.json'
+LOG_FILE_NAME = 'log.txt'
+
+#
+# manifest
+#
+
+def readManifestFile(filePath):
+    """ read a JSON or YAML manifest file """
+    with open(filePath) as f:
+        if os.path.splitext(filePath)[1].lower() in ['.yaml', '.yml']:
+            import yaml
+            return yaml.safe_load(f)
+        return json.load(f)
+
+def loadManifest(manifestPaths):
+    """ read the cases from one or more manifest files or directories with manifest files (one case per file).
+    returns a list of case dictionaries with the defaults applied
+    """
+    filePaths = []
+    for manifestPath in manifestPaths:
+        if os.path.isdir(manifestPath):
+            filePaths += sorted(os.path.join(manifestPath, fileName) for fileName in os.listdir(manifestPath)
+                                if os.path.splitext(fileName)[1].lower() in ['.json', '.yaml', '.yml'])
+        else:
+            filePaths.append(manifestPath)
+
+    cases = []
+    for filePath in filePaths:
+        manifest = readManifestFile(filePath)
+        defaults = {}
+        if isinstance(manifest, dict):
+            defaults = manifest.get('defaults', {})
+            manifestCases = manifest.get('cases', [manifest] if 'file' in manifest else [])
+        else:
+            manifestCases = manifest
+        manifestDirectory = os.path.dirname(os.path.abspath(filePath))
+        for manifestCase in manifestCases:
+            case = dict(defaults)
+            case.update(manifestCase)
+            # file paths are relative to the manifest
+            case['file'] = os.path.join(manifestDirectory, case['file'])
+            if not case.get('id'):
+                case['id'] = os.path.splitext(os.path.basename(case['file']))[0]
+            cases.append(case)
+
+    caseIds = [case['id'] for case in cases]
+    duplicateIds = {caseId for caseId in caseIds if caseIds.count(caseId) > 1}
+    if duplicateIds:
+        raise ValueError(f"Duplicate case ids in manifest: {', '.join(sorted(duplicateIds))}")
+
+    return cases
+
+#
+# progress, only written by the driver
+#
+
+def writeJson(filePath, data):
+    """ write json atomically, so an interrupted run never leaves a partially written file """
+    tmpFilePath = filePath + '.tmp'
+    with open(tmpFilePath, 'w') as f:
+        json.dump(data, f, indent=2)
+    os.replace(tmpFilePath, filePath)
+
+def loadProgress(outputDirectory):
+    filePath = os.path.join(outputDirectory, PROGRESS_FILE_NAME)
+    if not os.path.exists(filePath):
+        return {}
+    with open(filePath) as f:
+        return json.load(f)
+
+def readCaseStatus(caseDirectory):
+    filePath = os.path.join(caseDirectory, STATUS_FILE_NAME)
+    if not os.path.exists(filePath):
+        return None
+    with open(filePath) as f:
+        return json.load(f)
+
+#
+# driver
+#
+
+def findSlicerExecutable():
+    import shutil
+    for name in ['Slicer', 'Slicer.exe']:
+        slicerPath = shutil.which(name)
+        if slicerPath:
+            return slicerPath
+    return None
+
+def runCase(slicerPath, case, outputDirectory, timeout=None):
+    """ process a single case in a new Slicer process. returns the case status """
+    caseDirectory = os.path.join(outputDirectory, case['id'])
+    os.makedirs(caseDirectory, exist_ok=True)
+    caseManifestPath = os.path.join(caseDirectory, 'case.json')
+    writeJson(caseManifestPath, case)
+    # remove the status of a previous run
+    statusFilePath = os.path.join(caseDirectory, STATUS_FILE_NAME)
+    if os.path.exists(statusFilePath):
+        os.remove(statusFilePath)
+
+    command = [slicerPath, '--no-splash', '--no-main-window', '--python-script', os.path.abspath(__file__),
+               '--case-manifest', caseManifestPath, '--output', caseDirectory]
+    startTime = datetime.datetime.now()
+    with open(os.path.join(caseDirectory, LOG_FILE_NAME), 'w') as logFile:
+        try:
+            returnCode = subprocess.call(command, stdout=logFile, stderr=subprocess.STDOUT, timeout=timeout)
+        except subprocess.TimeoutExpired:
+            returnCode = None
+
+    status = readCaseStatus(caseDirectory) or {}
+    if returnCode is None:
+        status.update({'status': 'failed', 'error': f'timeout after {timeout} s'})
+    elif status.get('status') != 'done':
+        status.setdefault('error', f'Slicer exited with code {returnCode}, see {LOG_FILE_NAME}')
+        status['status'] = 'failed'
+    status['duration'] = (datetime.datetime.now() - startTime).total_seconds()
+    return status
+
+def runBatch(slicerPath, cases, outputDirectory, numberOfWorkers=1, retryFailed=False, timeout=None):
+    """ process the cases in a pool of Slicer processes. Cases that are done according to the progress file are skipped.
+    returns the progress dictionary (case id -> status)
+    """
+    os.makedirs(outputDirectory, exist_ok=True)
+    progress = loadProgress(outputDirectory)
+    progressFilePath = os.path.join(outputDirectory, PROGRESS_FILE_NAME)
+    progressLock = threading.Lock()
+
+    skippedStatus = ['done', 'failed'] if not retryFailed else ['done']
+    pendingCases = [case for case in cases if progress.get(case['id'], {}).get('status') not in skippedStatus]
+    print(f"{len(cases) - len(pendingCases)} of {len(cases)} cases already processed, {len(pendingCases)} to go")
+
+    def onCaseDone(case, status):
+        with progressLock:
+            progress[case['id']] = status
+            writeJson(progressFilePath, progress)
+            numberOfDone = sum(1 for caseStatus in progress.values() if caseStatus.get('status') == 'done')
+        message = status['status'] if status['status'] == 'done' else f"{status['status']}: {status.get('error')}"
+        print(f"[{numberOfDone}/{len(cases)}] {case['id']} {message} ({status['duration']:.0f} s)", flush=True)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, numberOfWorkers)) as executor:
+        futures = {executor.submit(runCase, slicerPath, case, outputDirectory, timeout): case for case in pendingCases}
+        for future in concurrent.futures.as_completed(futures):
+            case = futures[future]
+            try:
+                status = future.result()
+            except Exception as e:
+                status = {'status': 'failed', 'error': str(e), 'duration': 0.0}
+            onCaseDone(case, status)
+
+    return progress
+
+#
+# case processing, runs inside Slicer
+#
+
+def processCase(caseManifestPath, caseDirectory):
+    """ process a single case with CFDModelPostprocessingLogic and write the case status. returns the exit code """
+    import traceback
+    import CFDModelPostprocessing
+
+    with open(caseManifestPath) as f:
+        case = json.load(f)
+    try:
+        logic = CFDModelPostprocessing.CFDModelPostprocessingLogic()
+        outFilePaths = logic.processCase(case, caseDirectory)
+        status = {'status': 'done', 'files': [os.path.basename(outFilePath) for outFilePath in outFilePaths]}
+        exitCode = 0
+    except Exception as e:
+        traceback.print_exc()
+        status = {'status': 'failed', 'error': str(e)}
+        exitCode = 1
+    writeJson(os.path.join(caseDirectory, STATUS_FILE_NAME), status)
+    return exitCode
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Batch postprocessing of CFD models")
+    parser.add_argument('--manifest', nargs='+', help="manifest files or directories with manifest files")
+    parser.add_argument('--output', required=True, help="output directory")
+    parser.add_argument('--slicer', default=None, help="Slicer executable (default: Slicer on the PATH)")
+    parser.add_argument('--workers', type=int, default=max(1, (os.cpu_count() or 2) // 2), help="number of Slicer processes")
+    parser.add_argument('--timeout', type=float, default=None, help="maximum processing time of a case in seconds")
+    parser.add_argument('--retry-failed', action='store_true', help="rerun the cases that failed in a previous run")
+    parser.add_argument('--case-manifest', default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.case_manifest:
+        # single case, run by the driver inside Slicer
+        return processCase(args.case_manifest, args.output)
+
+    if not args.manifest:
+        parser.error("--manifest is required")
+    slicerPath = args.slicer or findSlicerExecutable()
+    if not slicerPath:
+        parser.error("Slicer executable not found, please specify it with --slicer")
+
+    cases = loadManifest(args.manifest)
+    progress = runBatch(slicerPath, cases, args.output, args.workers, args.retry_failed, args.timeout)
+    numberOfFailed = sum(1 for case in cases if progress.get(case['id'], {}).get('status') != 'done')
+    if numberOfFailed:
+        print(f"{numberOfFailed} of {len(cases)} cases failed, see {os.path.join(args.output, PROGRESS_FILE_NAME)}")
+    return 1 if numberOfFailed else 0
+
+if __name__ == '__main__':
+    try:
+        import slicer
+    except ImportError:
+        slicer = None
+    exitCode = main(sys.argv[1:])
+    if slicer is not None and hasattr(slicer, 'app'):
+        # running inside Slicer (--python-script), exit the application
+        slicer.util.exit(exitCode)
+    else:
+        sys.exit(exitCode)
@@ -0,0 +1,114 @@
+import vtk
+
+#
+# Branch mapping and patching of a surface. These functions only depend on vtk and vmtk, so they can also be run
+# in worker processes (PythonSlicer) to map and patch the branches of a surface in parallel.
+#
+
+def computeBranchMapping(surfacePolyData, centerlinePolyData, referenceSystems, arrayNames):
+    """ compute branch mapping, based on vmtkbrancmapping pyscript
+    :param arrayNames: dictionary with the array names used by CFDModelPostprocessingLogic
+    """
+    import vtkvmtkComputationalGeometryPython as vtkvmtkComputationalGeometry
+    import vtkvmtkDifferentialGeometryPython as vtkvmtkDifferentialGeometry
+
+    boundaryMetricFilter = vtkvmtkComputationalGeometry.vtkvmtkPolyDataReferenceSystemBoundaryMetricFilter()
+    boundaryMetricFilter.SetInputData(surfacePolyData)
+    boundaryMetricFilter.SetBoundaryMetricArrayName(arrayNames['boundaryMetricArrayName'])
+    boundaryMetricFilter.SetGroupIdsArrayName(arrayNames['groupIdsArrayName'])
+    boundaryMetricFilter.SetCenterlines(centerlinePolyData)
+    boundaryMetricFilter.SetCenterlineAbscissasArrayName(arrayNames['abscissaArrayName'])
+    boundaryMetricFilter.SetCenterlineRadiusArrayName(arrayNames['radiusArrayName'])
+    boundaryMetricFilter.SetCenterlineGroupIdsArrayName(arrayNames['groupIdsArrayName'])
+    boundaryMetricFilter.SetCenterlineTractIdsArrayName(arrayNames['tractIdsArrayName'])
+    boundaryMetricFilter.SetCenterlineIdsArrayName(arrayNames['centerlineIdsArrayName'])
+    boundaryMetricFilter.SetReferenceSystems(referenceSystems)
+    boundaryMetricFilter.SetReferenceSystemGroupIdsArrayName(arrayNames['groupIdsArrayName'])
+    boundaryMetricFilter.Update()
+
+    harmonicMappingFilter = vtkvmtkDifferentialGeometry.vtkvmtkPolyDataMultipleCylinderHarmonicMappingFilter()
+    harmonicMappingFilter.SetInputConnection(boundaryMetricFilter.GetOutputPort())
+    harmonicMappingFilter.SetHarmonicMappingArrayName(arrayNames['harmonicMappingArrayName'])
+    harmonicMappingFilter.SetGroupIdsArrayName(arrayNames['groupIdsArrayName'])
+    harmonicMappingFilter.Update()
+
+    stretchFilter = vtkvmtkComputationalGeometry.vtkvmtkPolyDataStretchMappingFilter()
+    stretchFilter.SetInputConnection(harmonicMappingFilter.GetOutputPort())
+    stretchFilter.SetStretchedMappingArrayName(arrayNames['stretchedMappingArrayName'])
+    stretchFilter.SetHarmonicMappingArrayName(arrayNames['harmonicMappingArrayName'])
+    stretchFilter.SetGroupIdsArrayName(arrayNames['groupIdsArrayName'])
+    stretchFilter.SetMetricArrayName(arrayNames['abscissaMetricArrayName'])
+    stretchFilter.SetBoundaryMetricArrayName(arrayNames['boundaryMetricArrayName'])
+    stretchFilter.UseBoundaryMetricOn()
+    stretchFilter.Update()
+
+    return stretchFilter.GetOutput()
+
+def computeBranchPatching(surfacePolyData, longitudinalPatchSize, circularNumberOfPatches, arrayNames):
+    """ compute patching of surface and attributes, based on vmtkbranchmapping pyscript
+    :param arrayNames: dictionary with the array names used by CFDModelPostprocessingLogic
+    """
+    import vtkvmtkComputationalGeometryPython as vtkvmtkComputationalGeometry
+
+    patchSize = [longitudinalPatchSize, 1.0/float(circularNumberOfPatches)]
+
+    patchingFilter = vtkvmtkComputationalGeometry.vtkvmtkPolyDataPatchingFilter()
+    patchingFilter.SetInputData(surfacePolyData)
+    patchingFilter.SetCircularPatching(1)
+    patchingFilter.SetUseConnectivity(1)
+    patchingFilter.SetLongitudinalMappingArrayName(arrayNames['longitudinalMappingArrayName'])
+    patchingFilter.SetCircularMappingArrayName(arrayNames['circularMappingArrayName'])
+    patchingFilter.SetLongitudinalPatchNumberArrayName(arrayNames['longitudinalPatchNumberArrayName'])
+    patchingFilter.SetCircularPatchNumberArrayName(arrayNames['circularPatchNumberArrayName'])
+    patchingFilter.SetPatchAreaArrayName(arrayNames['patchAreaArrayName'])
+    patchingFilter.SetGroupIdsArrayName(arrayNames['groupIdsArrayName'])
+    patchingFilter.SetPatchSize(patchSize)
+    patchingFilter.Update()
+
+    return (patchingFilter.GetOutput(), patchingFilter.GetPatchedData())
+
+#
+# serialization of vtk data to pass it to and from worker processes
+#
+
+def dataObjectToString(dataObject):
+    """ serialize polydata or imagedata to a (base64 encoded) xml string """
+    if dataObject.IsA('vtkImageData'):
+        writer = vtk.vtkXMLImageDataWriter()
+    else:
+        writer = vtk.vtkXMLPolyDataWriter()
+    writer.SetInputData(dataObject)
+    writer.SetDataModeToBinary()
+    writer.SetCompressorTypeToNone()
+    writer.WriteToOutputStringOn()
+    writer.Write()
+    return writer.GetOutputString()
+
+def dataObjectFromString(dataString, imageData=False):
+    """ deserialize polydata (or imagedata) written with dataObjectToString """
+    if imageData:
+        reader = vtk.vtkXMLImageDataReader()
+    else:
+        reader = vtk.vtkXMLPolyDataReader()
+    reader.ReadFromInputStringOn()
+    reader.SetInputString(dataString)
+    reader.Update()
+    return reader.GetOutput()
+
+#
+# worker process entry points, arguments and results are serialized vtk data
+#
+
+def mapBranchWorker(surfaceString, centerlineString, referenceSystemsString, arrayNames):
+    """ compute the branch mapping of a single branch in a worker process """
+    mappedPolyData = computeBranchMapping(dataObjectFromString(surfaceString), dataObjectFromString(centerlineString),
+                                          dataObjectFromString(referenceSystemsString), arrayNames)
+    return dataObjectToString(mappedPolyData)
+
+def patchBranchWorker(surfaceString, longitudinalPatchSize, circularNumberOfPatches, arrayNames, returnPatchedData=True):
+    """ compute the patching of a single branch in a worker process. The patched image data is only returned (serialized) 
+    if returnPatchedData is True, otherwise None is returned in its place
+    """
+    (patchingPolyData, patchedImageData) = computeBranchPatching(dataObjectFromString(surfaceString),
+                                                                 longitudinalPatchSize, circularNumberOfPatches, arrayNames)
+    return (dataObjectToString(patchingPolyData), dataObjectToString(patchedImageData) if returnPatchedData else None)
@@ -0,0 +1,333 @@
+"""
+Streaming statistics of the 2D branch maps of a cohort.
+
+Each case's 2D map (longitudinal x angular, as saved by the save maps button) is resampled to a common normalized grid and
+added to running statistics: Welford mean/variance and P2 quantile estimates (Jain and Chlamtac, 1985) per grid point.
+Memory use only depends on the grid size, not on the number of cases.
+
+The resampled maps are stored in a cache directory (one small .npy file per case), so cases can be excluded or included
+again without reprocessing them: the mean and variance are updated exactly, the quantile estimates are rebuilt by
+streaming over the cached maps of the included cases. An output directory holds the maps of one variable, which is taken
+from the map file names (case012_Branch_WSS_2DMap.csv is the WSS map of case012).
+
+Command line usage (python or PythonSlicer):
+    python CohortStatistics.py --maps results/*_Branch_WSS_2DMap.csv --output cohort --exclude case012
+"""
+
+import argparse
+import json
+import os
+import re
+
+import numpy as np
+
+DEFAULT_GRID_SHAPE = (100, 64)
+DEFAULT_QUANTILES = (0.05, 0.25, 0.5, 0.75, 0.95)
+
+def readMapCSV(filePath):
+    """ read a 2D map saved as csv """
+    return np.loadtxt(filePath, delimiter=',', dtype=np.float64, ndmin=2)
+
+def resampleMap(map2D, gridShape):
+    """ bilinear resampling of a 2D map (longitudinal x angular) to gridShape on normalized [0,1] coordinates.
+    The angular direction is periodic.
+    """
+    map2D = np.asarray(map2D, dtype=np.float64)
+    if map2D.ndim != 2:
+        raise ValueError(f"Expected a 2D map, got an array of shape {map2D.shape}")
+
+    # longitudinal direction, clamped at the ends
+    rows = map2D.shape[0]
+    f = np.clip((np.arange(gridShape[0]) + 0.5) * rows / gridShape[0] - 0.5, 0, rows - 1)
+    i0 = np.floor(f).astype(int)
+    i1 = np.minimum(i0 + 1, rows - 1)
+    w = (f - i0)[:, None]
+    resampled = (1 - w) * map2D[i0, :] + w * map2D[i1, :]
+
+    # angular direction, periodic
+    columns = map2D.shape[1]
+    f = (np.arange(gridShape[1]) + 0.5) * columns / gridShape[1] - 0.5
+    j0 = np.floor(f).astype(int)
+    w = f - j0
+    j1 = (j0 + 1) % columns
+    j0 = j0 % columns
+
+    return (1 - w) * resampled[:, j0] + w * resampled[:, j1]
+
+class P2Quantiles:
+    """ P2 estimates of several quantiles, for every point of a grid at once. NaN values are ignored """
+
+    def __init__(self, quantiles, shape):
+        self.quantiles = np.asarray(quantiles, dtype=np.float64)
+        self.shape = tuple(shape)
+        numberOfPoints = int(np.prod(self.shape))
+        numberOfQuantiles = len(self.quantiles)
+
+        self.count = np.zeros(numberOfPoints, dtype=np.int64)
+        # marker heights (the first 5 observations until initialized), positions and desired positions
+        self.heights = np.full((numberOfQuantiles, 5, numberOfPoints), np.nan)
+        self.positions = np.tile(np.arange(1, 6, dtype=np.float64)[None, :, None], (numberOfQuantiles, 1, numberOfPoints))
+        p = self.quantiles[:, None]
+        self.increments = np.stack([np.zeros_like(p), p / 2, p, (1 + p) / 2, np.ones_like(p)], axis=1)
+        self.desiredPositions = np.broadcast_to(1 + 4 * self.increments, self.positions.shape).copy()
+
+    def update(self, values):
+        values = np.asarray(values, dtype=np.float64).ravel()
+        valid = ~np.isnan(values)
+
+        # store the first 5 observations
+        idx = np.nonzero(valid & (self.count < 5))[0]
+        self.heights[:, self.count[idx], idx] = values[idx]
+
+        idx = np.nonzero(valid & (self.count >= 5))[0]
+        if idx.size:
+            self.updateMarkers(idx, values[idx])
+
+        self.count[valid] += 1
+        # initialize the markers with the sorted first 5 observations
+        idx = np.nonzero(valid & (self.count == 5))[0]
+        self.heights[:, :, idx] = np.sort(self.heights[:, :, idx], axis=1)
+
+    def updateMarkers(self, idx, x):
+        q = self.heights[:, :, idx]
+        n = self.positions[:, :, idx]
+        nd = self.desiredPositions[:, :, idx]
+
+        # cell of the new observation, extend the extreme markers
+        q[:, 0] = np.minimum(q[:, 0], x)
+        q[:, 4] = np.maximum(q[:, 4], x)
+        k = np.sum(q[:, 1:4] <= x, axis=1)
+        n += np.arange(5)[None, :, None] > k[:, None, :]
+        nd += self.increments
+
+        # adjust the heights of the middle markers
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for i in range(1, 4):
+                d = nd[:, i] - n[:, i]
+                move = ((d >= 1) & (n[:, i + 1] - n[:, i] > 1)) | ((d <= -1) & (n[:, i - 1] - n[:, i] < -1))
+                s = np.sign(d)
+                parabolic = q[:, i] + s / (n[:, i + 1] - n[:, i - 1]) * (
+                    (n[:, i] - n[:, i - 1] + s) * (q[:, i + 1] - q[:, i]) / (n[:, i + 1] - n[:, i])
+                    + (n[:, i + 1] - n[:, i] - s) * (q[:, i] - q[:, i - 1]) / (n[:, i] - n[:, i - 1]))
+                qNeighbour = np.where(s > 0, q[:, i + 1], q[:, i - 1])
+                nNeighbour = np.where(s > 0, n[:, i + 1], n[:, i - 1])
+                linear = q[:, i] + s * (qNeighbour - q[:, i]) / (nNeighbour - n[:, i])
+                newHeight = np.where((q[:, i - 1] < parabolic) & (parabolic < q[:, i + 1]), parabolic, linear)
+                q[:, i] = np.where(move, newHeight, q[:, i])
+                n[:, i] += np.where(move, s, 0)
+
+        self.heights[:, :, idx] = q
+        self.positions[:, :, idx] = n
+        self.desiredPositions[:, :, idx] = nd
+
+    def result(self):
+        """ quantile estimates, array of shape (number of quantiles,) + shape. NaN where there are no observations """
+        result = self.heights[:, 2].copy()
+        # exact quantiles of the stored observations for points with less than 5 observations
+        idx = np.nonzero((self.count > 0) & (self.count < 5))[0]
+        for (i, quantile) in enumerate(self.quantiles):
+            result[i, idx] = np.nanquantile(self.heights[i][:, idx], quantile, axis=0)
+        result[:, self.count == 0] = np.nan
+        return result.reshape((len(self.quantiles),) + self.shape)
+
+class CohortStatistics:
+    """ running mean, standard deviation and quantile maps of the 2D maps of a cohort """
+
+    def __init__(self, gridShape=DEFAULT_GRID_SHAPE, quantiles=DEFAULT_QUANTILES, cacheDirectory=None, variableName=None):
+        self.gridShape = tuple(int(s) for s in gridShape)
+        self.quantiles = tuple(float(q) for q in quantiles)
+        self.cacheDirectory = cacheDirectory
+        # variable of the maps (e.g. WSS), the cache and the statistics only contain maps of one variable
+        self.variableName = variableName
+        if cacheDirectory:
+            os.makedirs(cacheDirectory, exist_ok=True)
+
+        self.caseIds = []
+        # cases excluded by the user, they are not added again when their maps are given
+        self.excludedCaseIds = []
+        self.count = np.zeros(self.gridShape, dtype=np.int64)
+        self.runningMean = np.zeros(self.gridShape)
+        self.runningM2 = np.zeros(self.gridShape)
+        self.quantileEstimator = P2Quantiles(self.quantiles, self.gridShape)
+        self.quantilesValid = True
+
+    def checkVariable(self, variableName):
+        """ make sure maps of variableName can be added. The first known variable is kept, maps of another variable raise ValueError """
+        if variableName is None:
+            return
+        if self.variableName is None:
+            self.variableName = variableName
+        elif variableName != self.variableName:
+            raise ValueError(f"Maps of {variableName} can not be added to the statistics of {self.variableName}")
+
+    def cacheFilePath(self, caseId):
+        return os.path.join(self.cacheDirectory, f'{caseId}.npy')
+
+    def getResampledMap(self, caseId):
+        """ the resampled map of a case from the cache """
+        if not self.cacheDirectory or not os.path.exists(self.cacheFilePath(caseId)):
+            raise ValueError(f"No cached map for case {caseId}")
+        return np.load(self.cacheFilePath(caseId))
+
+    def cacheMap(self, caseId, map2D):
+        """ resample the 2D map of a case and store it in the cache. returns the resampled map """
+        # statistics are computed from the cached float32 map, so removing the case later is exact
+        resampledMap = resampleMap(map2D, self.gridShape).astype(np.float32)
+        if self.cacheDirectory:
+            np.save(self.cacheFilePath(caseId), resampledMap)
+        return resampledMap
+
+    def addCase(self, caseId, map2D=None):
+        """ add the 2D map of a case to the statistics. If map2D is None, the case is included again from the cache """
+        if caseId in self.caseIds:
+            raise ValueError(f"Case {caseId} is already included")
+        if map2D is None:
+            resampledMap = self.getResampledMap(caseId)
+        else:
+            resampledMap = self.cacheMap(caseId, map2D)
+        resampledMap = resampledMap.astype(np.float64)
+
+        valid = ~np.isnan(resampledMap)
+        self.count += valid
+        delta = np.where(valid, resampledMap - self.runningMean, 0)
+        self.runningMean += np.where(valid, delta / np.maximum(self.count, 1), 0)
+        self.runningM2 += np.where(valid, delta * (resampledMap - self.runningMean), 0)
+        if self.quantilesValid:
+            self.quantileEstimator.update(resampledMap)
+        self.caseIds.append(caseId)
+
+    def removeCase(self, caseId):
+        """ exclude a case from the statistics, the map of the case is read from the cache """
+        if caseId not in self.caseIds:
+            raise ValueError(f"Case {caseId} is not included")
+        resampledMap = self.getResampledMap(caseId).astype(np.float64)
+
+        valid = ~np.isnan(resampledMap)
+        self.count -= valid
+        delta = np.where(valid, resampledMap - self.runningMean, 0)
+        self.runningMean -= np.where(valid & (self.count > 0), delta / np.maximum(self.count, 1), 0)
+        self.runningM2 -= np.where(valid & (self.count > 0), delta * (resampledMap - self.runningMean), 0)
+        # reset the points without observations to avoid accumulating round-off errors
+        self.runningMean[self.count == 0] = 0
+        self.runningM2[self.count == 0] = 0
+        self.caseIds.remove(caseId)
+        # quantile estimates can not be updated, they are rebuilt when needed
+        self.quantilesValid = False
+
+    def mean(self):
+        return np.where(self.count > 0, self.runningMean, np.nan)
+
+    def variance(self):
+        """ sample variance """
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(self.count > 1, np.maximum(self.runningM2, 0) / (self.count - 1), np.nan)
+
+    def std(self):
+        return np.sqrt(self.variance())
+
+    def quantileMaps(self):
+        """ quantile maps, array of shape (number of quantiles,) + gridShape """
+        if not self.quantilesValid:
+            # rebuild the estimates from the cached maps of the included cases, one map at a time
+            self.quantileEstimator = P2Quantiles(self.quantiles, self.gridShape)
+            for caseId in self.caseIds:
+                self.quantileEstimator.update(self.getResampledMap(caseId))
+            self.quantilesValid = True
+        return self.quantileEstimator.result()
+
+    def save(self, filePath):
+        """ save the state, so cases can be added or removed later """
+        estimator = self.quantileEstimator
+        np.savez(filePath, gridShape=self.gridShape, quantiles=self.quantiles, count=self.count,
+                 runningMean=self.runningMean, runningM2=self.runningM2, quantilesValid=self.quantilesValid,
+                 quantileCount=estimator.count, heights=estimator.heights, positions=estimator.positions,
+                 desiredPositions=estimator.desiredPositions,
+                 metadata=json.dumps({'caseIds': self.caseIds, 'excludedCaseIds': self.excludedCaseIds,
+                                     'cacheDirectory': self.cacheDirectory, 'variableName': self.variableName}))
+
+    @classmethod
+    def load(cls, filePath):
+        with np.load(filePath) as data:
+            metadata = json.loads(str(data['metadata']))
+            statistics = cls(data['gridShape'], data['quantiles'], metadata['cacheDirectory'], metadata.get('variableName'))
+            statistics.caseIds = metadata['caseIds']
+            statistics.excludedCaseIds = metadata.get('excludedCaseIds', [])
+            statistics.count = data['count']
+            statistics.runningMean = data['runningMean']
+            statistics.runningM2 = data['runningM2']
+            statistics.quantilesValid = bool(data['quantilesValid'])
+            estimator = statistics.quantileEstimator
+            estimator.count = data['quantileCount']
+            estimator.heights = data['heights']
+            estimator.positions = data['positions']
+            estimator.desiredPositions = data['desiredPositions']
+        return statistics
+
+    def writeMaps(self, outputDirectory, prefix='cohort'):
+        """ write the mean, std and quantile maps to csv files. returns the list of written files """
+        os.makedirs(outputDirectory, exist_ok=True)
+        maps = [('mean', self.mean()), ('std', self.std())]
+        maps += [(f'p{100 * q:g}', quantileMap) for (q, quantileMap) in zip(self.quantiles, self.quantileMaps())]
+        outFilePaths = []
+        for (name, statisticMap) in maps:
+            outFilePaths.append(os.path.join(outputDirectory, f'{prefix}_{name}.csv'))
+            np.savetxt(outFilePaths[-1], statisticMap, delimiter=',', fmt='%.6g')
+        return outFilePaths
+
+def caseIdFromFilePath(filePath):
+    """ case id from the file name of a 2D map, e.g. case012 for case012_Branch_WSS_2DMap.csv """
+    fileName = os.path.splitext(os.path.basename(filePath))[0]
+    return re.sub(r'_Branch_.+_2DMap$', '', fileName)
+
+def variableFromFilePath(filePath):
+    """ variable from the file name of a 2D map, e.g. WSS for case012_Branch_WSS_2DMap.csv. None if it is not in the name """
+    match = re.search(r'_Branch_(.+)_2DMap$', os.path.splitext(os.path.basename(filePath))[0])
+    return match.group(1) if match else None
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Cohort statistics of 2D branch maps")
+    parser.add_argument('--maps', nargs='*', default=[], help="2D map csv files to add")
+    parser.add_argument('--output', required=True, help="output directory, contains the state and the cached maps")
+    parser.add_argument('--exclude', nargs='*', default=[], help="case ids to exclude")
+    parser.add_argument('--include', nargs='*', default=[], help="previously excluded case ids to include again")
+    parser.add_argument('--grid', nargs=2, type=int, default=DEFAULT_GRID_SHAPE, help="longitudinal and angular grid size")
+    parser.add_argument('--quantiles', nargs='*', type=float, default=DEFAULT_QUANTILES)
+    args = parser.parse_args(argv)
+
+    stateFilePath = os.path.join(args.output, 'cohort_statistics.npz')
+    if os.path.exists(stateFilePath):
+        statistics = CohortStatistics.load(stateFilePath)
+    else:
+        statistics = CohortStatistics(args.grid, args.quantiles, os.path.join(args.output, 'cache'))
+
+    for caseId in args.exclude:
+        if caseId not in statistics.excludedCaseIds:
+            statistics.excludedCaseIds.append(caseId)
+    for caseId in args.include:
+        if caseId in statistics.excludedCaseIds:
+            statistics.excludedCaseIds.remove(caseId)
+
+    for filePath in args.maps:
+        statistics.checkVariable(variableFromFilePath(filePath))
+        caseId = caseIdFromFilePath(filePath)
+        if caseId in statistics.caseIds:
+            continue
+        if caseId in statistics.excludedCaseIds:
+            # excluded cases are only cached, so they can be included later
+            if not os.path.exists(statistics.cacheFilePath(caseId)):
+                statistics.cacheMap(caseId, readMapCSV(filePath))
+        else:
+            statistics.addCase(caseId, readMapCSV(filePath))
+    for caseId in statistics.excludedCaseIds:
+        if caseId in statistics.caseIds:
+            statistics.removeCase(caseId)
+    for caseId in args.include:
+        if caseId not in statistics.caseIds:
+            statistics.addCase(caseId)
+
+    statistics.writeMaps(args.output)
+    statistics.save(stateFilePath)
+    print(f"{len(statistics.caseIds)} cases included")
+
+if __name__ == '__main__':
+    main()
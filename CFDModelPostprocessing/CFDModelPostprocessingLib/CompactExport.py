@@ -0,0 +1,35 @@
+import json
+
+import numpy as np
+
+#
+# Compact export of the 2D maps of a case: one compressed .npz file with the maps of all variables (float32),
+# the patch tensor (GroupIds, Slab, Sector, PatchArea per patch) and the metadata. Only depends on numpy,
+# so the files can be read without Slicer.
+#
+
+PATCH_TENSOR_COLUMNS = ('GroupIds', 'Slab', 'Sector', 'PatchArea')
+
+def writeCompactMaps(filePath, variableNames, variableMaps, patchTensor, metadata):
+    """ write the maps to a compressed .npz file
+    :param variableMaps: array of shape (number of variables, ...) with the 2D maps, in the order of variableNames
+    :param patchTensor: array of shape (number of patches, 4), columns as in PATCH_TENSOR_COLUMNS
+    :param metadata: json serializable dictionary
+    """
+    np.savez_compressed(filePath,
+                        variableNames=np.array(variableNames, dtype=str),
+                        maps=np.asarray(variableMaps, dtype=np.float32),
+                        patchTensor=np.asarray(patchTensor, dtype=np.float32),
+                        patchTensorColumns=np.array(PATCH_TENSOR_COLUMNS, dtype=str),
+                        metadata=json.dumps(metadata))
+
+def readCompactMaps(filePath):
+    """ read a file written with writeCompactMaps.
+    returns a dictionary with 'maps' (variable name -> 2D map), 'patchTensor', 'patchTensorColumns' and 'metadata'
+    """
+    with np.load(filePath) as data:
+        variableMaps = data['maps']
+        return {'maps': dict(zip(data['variableNames'].tolist(), variableMaps)),
+                'patchTensor': data['patchTensor'],
+                'patchTensorColumns': data['patchTensorColumns'].tolist(),
+                'metadata': json.loads(str(data['metadata']))}
@@ -0,0 +1 @@
+# helper modules of CFDModelPostprocessing that do not depend on the Slicer application
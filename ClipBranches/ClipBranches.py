@@ -3,6 +3,8 @@ import unittest
 import logging
 import vtk, qt, ctk, slicer
 import math
+import collections
+import numpy as np
 from slicer.ScriptedLoadableModule import *
 from slicer.util import VTKObservationMixin
 
@@ -281,6 +283,143 @@ class ClipBranchesWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
       traceback.print_exc()
 
 
+#
+# PolyDataCache
+#
+
+class PolyDataCache:
+  """ Least recently used cache of objects computed from a polydata (e.g. CenterlineData). An entry is valid as long as
+  the polydata is not modified, it is computed again otherwise.
+  """
+
+  def __init__(self, size=8):
+    # address -> (polydata, mtime, object)
+    self.entries = collections.OrderedDict()
+    self.size = size
+
+  def get(self, polyData, compute):
+    """ object computed by compute(polyData), only called again if the polydata was modified since the last call """
+    key = polyData.GetAddressAsString('vtkPolyData')
+    entry = self.entries.get(key)
+    if entry and entry[0] is polyData and entry[1] == polyData.GetMTime():
+      self.entries.move_to_end(key)
+      return entry[2]
+    value = compute(polyData)
+    self.entries[key] = (polyData, polyData.GetMTime(), value)
+    while len(self.entries) > self.size:
+      self.entries.popitem(last=False)
+    return value
+
+  def clear(self):
+    self.entries.clear()
+
+#
+# CenterlineData
+#
+
+class CenterlineData:
+  """ Columnar representation of a centerline polydata, shared by the modules that need centerline points, cells or attributes:
+  contiguous points, CSR offsets/connectivity of the cells (lines) and typed point and cell arrays. The arrays are numpy views
+  of the vtk arrays (no copies), so the centerline polydata should not be modified while its CenterlineData is used.
+  Use CenterlineData.get to reuse the data of a centerline that was already converted.
+  """
+  pointArrayNames = ['Radius', 'Abscissas', 'AbscissaMetric', 'AngularMetric', 'FrenetTangent', 'FrenetNormal', 'FrenetBinormal', 'ParallelTransportNormals']
+  cellArrayNames = ['GroupIds', 'CenterlineIds', 'TractIds', 'Blanking']
+
+  # recently converted centerlines
+  cache = PolyDataCache(8)
+
+  @classmethod
+  def get(cls, centerlinePolyData):
+    """ CenterlineData of the polydata, converted only once as long as the polydata is not modified """
+    return cls.cache.get(centerlinePolyData, cls)
+
+  def __init__(self, centerlinePolyData):
+    from vtk.util import numpy_support
+
+    if centerlinePolyData.GetPoints():
+      self.points = numpy_support.vtk_to_numpy(centerlinePolyData.GetPoints().GetData())
+    else:
+      self.points = np.zeros((0,3))
+    lines = centerlinePolyData.GetLines()
+    self.offsets = numpy_support.vtk_to_numpy(lines.GetOffsetsArray())
+    self.connectivity = numpy_support.vtk_to_numpy(lines.GetConnectivityArray())
+    if self.offsets.size == 0:
+      self.offsets = np.zeros(1, dtype=np.int64)
+
+    self.pointData = {}
+    for arrayName in self.pointArrayNames:
+      array = centerlinePolyData.GetPointData().GetArray(arrayName)
+      if array:
+        self.pointData[arrayName] = numpy_support.vtk_to_numpy(array)
+    self.cellData = {}
+    for arrayName in self.cellArrayNames:
+      array = centerlinePolyData.GetCellData().GetArray(arrayName)
+      if array:
+        self.cellData[arrayName] = numpy_support.vtk_to_numpy(array)
+
+    # cell of each point (the first cell that contains the point, -1 for points that are not in a cell)
+    # and the position of the point in the connectivity of that cell
+    cellOfEntry = np.repeat(np.arange(self.numberOfCells), np.diff(self.offsets))
+    (connectedPointIds, firstEntries) = np.unique(self.connectivity, return_index=True)
+    self.pointCellIds = np.full(self.points.shape[0], -1, dtype=np.int64)
+    self.pointCellIds[connectedPointIds] = cellOfEntry[firstEntries]
+    self.pointEntries = np.full(self.points.shape[0], -1, dtype=np.int64)
+    self.pointEntries[connectedPointIds] = firstEntries
+
+    # cells of each group, in CSR format
+    self.groupIds = np.zeros(0, dtype=np.int64)
+    self.groupCellIds = np.zeros(0, dtype=np.int64)
+    self.groupOffsets = np.zeros(1, dtype=np.int64)
+    self.groupIndex = {}
+    if 'GroupIds' in self.cellData:
+      self.groupCellIds = np.argsort(self.cellData['GroupIds'], kind='stable')
+      (self.groupIds, groupStarts) = np.unique(self.cellData['GroupIds'][self.groupCellIds], return_index=True)
+      self.groupOffsets = np.append(groupStarts, self.groupCellIds.shape[0])
+      self.groupIndex = {int(groupId): i for (i, groupId) in enumerate(self.groupIds)}
+
+    # quantities derived from the centerline by other modules (e.g. ROI frames), dropped together with this data
+    self.derived = {}
+
+  @property
+  def numberOfCells(self):
+    return self.offsets.shape[0] - 1
+
+  def getCellPointIds(self, cellId):
+    return self.connectivity[self.offsets[cellId]:self.offsets[cellId+1]]
+
+  def getCellPoints(self, cellId):
+    return self.points[self.getCellPointIds(cellId)]
+
+  def getGroupCellIds(self, groupId):
+    """ ids of the cells with the group id, empty if the group does not exist """
+    i = self.groupIndex.get(int(groupId))
+    if i is None:
+      return self.groupCellIds[:0]
+    return self.groupCellIds[self.groupOffsets[i]:self.groupOffsets[i+1]]
+
+  def getGroupPointIds(self, groupId):
+    """ point ids of the (first) cell of the group """
+    cellIds = self.getGroupCellIds(groupId)
+    if cellIds.shape[0] == 0:
+      raise ValueError(f"Centerline has no group {groupId}")
+    return self.getCellPointIds(cellIds[0])
+
+  def getGroupCenter(self, groupId):
+    """ middle point of the (first) cell of the group, e.g. to place a label """
+    pointIds = self.getGroupPointIds(groupId)
+    return self.points[pointIds[pointIds.shape[0]//2]]
+
+  def getPointCellId(self, pointId):
+    return self.pointCellIds[pointId]
+
+  def getPointGroupId(self, pointId):
+    return self.cellData['GroupIds'][self.pointCellIds[pointId]]
+
+  def getPointFrame(self, pointId):
+    """ Frenet tangent, normal and binormal at the point """
+    return (self.pointData['FrenetTangent'][pointId], self.pointData['FrenetNormal'][pointId], self.pointData['FrenetBinormal'][pointId])
+
 #
 # ClipBranchesLogic
 #
@@ -305,6 +444,8 @@ class ClipBranchesLogic(ScriptedLoadableModuleLogic):
     self.groupIdsArrayName = 'GroupIds'
     self.centerlineIdsArrayName = 'CenterlineIds'
     self.tractIdsArrayName = 'TractIds'
+    # tolerance (fraction of the bounding box diagonal) to merge the points at the seams between clipped groups
+    self.seamMergeTolerance = 1e-6
     
   def setDefaultParameters(self, parameterNode):
     """
@@ -322,11 +463,15 @@ class ClipBranchesLogic(ScriptedLoadableModuleLogic):
         logging.error("Surface can only be loaded from model or segmentation node")
         return None
         
+  def getCenterlineData(self, centerlinePolyData):
+    """ columnar centerline data, converted once per centerline polydata """
+    return CenterlineData.get(centerlinePolyData)
+
   def getCenterlineGroup(self,centerlinePolyData,idx):
-    groupid = centerlinePolyData.GetCellData().GetArray('GroupIds').GetValue(idx)
-    line = centerlinePolyData.GetCell(idx)
-    pts = line.GetPoints()
-    pt = pts.GetPoint(line.GetNumberOfPoints()//2)
+    centerlineData = self.getCenterlineData(centerlinePolyData)
+    groupid = int(centerlineData.cellData[self.groupIdsArrayName][idx])
+    pointIds = centerlineData.getCellPointIds(idx)
+    pt = tuple(centerlineData.points[pointIds[pointIds.shape[0]//2]])
     return (groupid, pt)
         
   
@@ -381,6 +526,31 @@ class ClipBranchesLogic(ScriptedLoadableModuleLogic):
     except ImportError:
         raise ImportError("VMTK library is not found")
     
+    # the surface is clipped into its groups once per surface and centerline, clipping another set of branches 
+    # only extracts other cells
+    (groupsPolyData, cellGroupIds) = self.getSurfaceGroups(surfacePolyData, centerlinePolyData)
+    outputSurfacePolyData = self.extractGroups(groupsPolyData, cellGroupIds, branchClipList, remove=True)
+    
+    stopTime = time.time()
+    logging.info('Processing completed in {0:.2f} seconds'.format(stopTime-startTime))
+    
+    return outputSurfacePolyData
+
+  def getSurfaceGroups(self, surfacePolyData, centerlinePolyData):
+    """ surface clipped into the groups (branches) of the centerline and the group id of each cell. 
+    The centerline groups clipper is run once for all groups, the result is reused as long as the surface and centerline 
+    are not modified. Only the groups of the last surface are kept with the centerline. returns (polydata, group ids array)
+    """
+    centerlineData = CenterlineData.get(centerlinePolyData)
+    if 'SurfaceGroups' not in centerlineData.derived:
+      centerlineData.derived['SurfaceGroups'] = PolyDataCache(1)
+    return centerlineData.derived['SurfaceGroups'].get(surfacePolyData, lambda surface: self.computeSurfaceGroups(surface, centerlinePolyData))
+
+  def computeSurfaceGroups(self, surfacePolyData, centerlinePolyData):
+    """ see getSurfaceGroups """
+    import vtkvmtkComputationalGeometryPython as vtkvmtkComputationalGeometry
+    from vtk.util import numpy_support
+
     branchExtractor = vtkvmtkComputationalGeometry.vtkvmtkCenterlineBranchExtractor()
     branchExtractor.SetInputData(centerlinePolyData)
     branchExtractor.SetBlankingArrayName(self.blankingArrayName)
@@ -390,37 +560,89 @@ class ClipBranchesLogic(ScriptedLoadableModuleLogic):
     branchExtractor.SetTractIdsArrayName(self.tractIdsArrayName)
     branchExtractor.Update()
     centerlines = branchExtractor.GetOutput()
-    
-    # there seems to be a bug in vtkvmtkPolyDatacenterlineGroupsClipper where you can only clip one branch at a time, when you try to clip multiple branches at once, nothing happens. THerefore clip the branches one by one in a loop.
-    surface = surfacePolyData
-    for i in branchClipList:
-      surfaceClipper = vtkvmtkComputationalGeometry.vtkvmtkPolyDataCenterlineGroupsClipper()
-      surfaceClipper.SetInputData(surface)
-      surfaceClipper.SetCenterlines(centerlines)
-      surfaceClipper.SetCenterlineGroupIdsArrayName(self.groupIdsArrayName)
-      surfaceClipper.SetGroupIdsArrayName(self.groupIdsArrayName)
-      surfaceClipper.SetCenterlineRadiusArrayName(self.radiusArrayName)
-      surfaceClipper.SetBlankingArrayName(self.blankingArrayName)
-      surfaceClipper.SetGenerateClippedOutput(1)
-      groupIds = vtk.vtkIdList()
-      groupIds.InsertNextId(i)
-      surfaceClipper.SetCenterlineGroupIds(groupIds)
-      surfaceClipper.SetClipAllCenterlineGroupIds(0)
-      #surfaceClipper.GenerateClippedOutputOff()
-      # clip all branches
-      #surfaceClipper.SetClipAllCenterlineGroupIds(1)
-      surfaceClipper.Update()
-      
-      surface = surfaceClipper.GetClippedOutput()
-    
+
+    # clipping a single group at a time has to be repeated for every branch, clip all groups at once instead
+    surfaceClipper = vtkvmtkComputationalGeometry.vtkvmtkPolyDataCenterlineGroupsClipper()
+    surfaceClipper.SetInputData(surfacePolyData)
+    surfaceClipper.SetCenterlines(centerlines)
+    surfaceClipper.SetCenterlineGroupIdsArrayName(self.groupIdsArrayName)
+    surfaceClipper.SetGroupIdsArrayName(self.groupIdsArrayName)
+    surfaceClipper.SetCenterlineRadiusArrayName(self.radiusArrayName)
+    surfaceClipper.SetBlankingArrayName(self.blankingArrayName)
+    surfaceClipper.SetGenerateClippedOutput(0)
+    surfaceClipper.SetClipAllCenterlineGroupIds(1)
+    surfaceClipper.Update()
+    groupsPolyData = surfaceClipper.GetOutput()
+
+    # the group ids are point data, all points of a cell are in the same group
+    if groupsPolyData.GetCellData().GetArray(self.groupIdsArrayName):
+      cellGroupIds = numpy_support.vtk_to_numpy(groupsPolyData.GetCellData().GetArray(self.groupIdsArrayName))
+    else:
+      pointGroupIds = numpy_support.vtk_to_numpy(groupsPolyData.GetPointData().GetArray(self.groupIdsArrayName))
+      polys = groupsPolyData.GetPolys()
+      firstPointIds = numpy_support.vtk_to_numpy(polys.GetConnectivityArray())[numpy_support.vtk_to_numpy(polys.GetOffsetsArray())[:-1]]
+      cellGroupIds = pointGroupIds[firstPointIds]
+    cellGroupIds = np.asarray(cellGroupIds, dtype=np.int64)
+    return (groupsPolyData, cellGroupIds)
+
+  def mergeSeams(self, polyData):
+    """ merge the duplicate points at the seams between groups and remove the unused points """
+    cleaner = vtk.vtkCleanPolyData()
+    cleaner.SetInputData(polyData)
+    cleaner.ToleranceIsAbsoluteOff()
+    cleaner.SetTolerance(self.seamMergeTolerance)
+    cleaner.Update()
+    return cleaner.GetOutput()
+
+  @staticmethod
+  def countBoundaryEdges(polyData):
+    """ number of polygon edges that are used by only one polygon """
+    from vtk.util import numpy_support
+    polys = polyData.GetPolys()
+    offsets = numpy_support.vtk_to_numpy(polys.GetOffsetsArray())
+    connectivity = numpy_support.vtk_to_numpy(polys.GetConnectivityArray())
+    if connectivity.shape[0] == 0:
+      return 0
+    # edge from each cell point to the next one, the last point of a cell connects to the first
+    nextEntries = np.arange(1, connectivity.shape[0]+1)
+    nonEmpty = offsets[1:] > offsets[:-1]
+    nextEntries[offsets[1:][nonEmpty]-1] = offsets[:-1][nonEmpty]
+    edges = np.sort(np.stack([connectivity, connectivity[nextEntries]], axis=1), axis=1)
+    (_, counts) = np.unique(edges, axis=0, return_counts=True)
+    return int(np.count_nonzero(counts == 1))
+
+  def extractGroups(self, groupsPolyData, cellGroupIds, groupIds, remove=False):
+    """ cells of the groups (or all other cells if remove is True) of the surface clipped into groups (see getSurfaceGroups), 
+    extracted with a single cell mask. The seams between the kept groups are merged again.
+    """
+    from vtk.util import numpy_support
+    mask = np.isin(cellGroupIds, np.asarray(list(groupIds), dtype=np.int64), invert=remove)
+
+    polys = groupsPolyData.GetPolys()
+    offsets = numpy_support.vtk_to_numpy(polys.GetOffsetsArray())
+    connectivity = numpy_support.vtk_to_numpy(polys.GetConnectivityArray())
+    cellSizes = np.diff(offsets)
+    extractedPolys = vtk.vtkCellArray()
+    extractedPolys.SetData(numpy_support.numpy_to_vtkIdTypeArray(np.concatenate([[0], np.cumsum(cellSizes[mask])]).astype(np.int64), deep=True),
+                           numpy_support.numpy_to_vtkIdTypeArray(connectivity[np.repeat(mask, cellSizes)].astype(np.int64), deep=True))
+
+    # the points and point data are shared with the groups surface
+    extractedPolyData = vtk.vtkPolyData()
+    extractedPolyData.SetPoints(groupsPolyData.GetPoints())
+    extractedPolyData.GetPointData().ShallowCopy(groupsPolyData.GetPointData())
+    extractedPolyData.SetPolys(extractedPolys)
+    cellData = groupsPolyData.GetCellData()
+    for i in range(cellData.GetNumberOfArrays()):
+      if not cellData.GetArray(i):
+        continue
+      vtkArray = numpy_support.numpy_to_vtk(numpy_support.vtk_to_numpy(cellData.GetArray(i))[mask], deep=True)
+      vtkArray.SetName(cellData.GetArrayName(i))
+      extractedPolyData.GetCellData().AddArray(vtkArray)
 
     outputSurfacePolyData = vtk.vtkPolyData()
-    outputSurfacePolyData.DeepCopy(surfaceClipper.GetClippedOutput())
-    
-    stopTime = time.time()
-    logging.info('Processing completed in {0:.2f} seconds'.format(stopTime-startTime))
-    
+    outputSurfacePolyData.DeepCopy(self.mergeSeams(extractedPolyData))
     return outputSurfacePolyData
+
 #
 # ClipBranchesTest
 #
@@ -442,6 +664,7 @@ class ClipBranchesTest(ScriptedLoadableModuleTest):
     """
     self.setUp()
     self.test_ClipBranches1()
+    self.test_MergeSeams()
 
   def test_ClipBranches1(self):
     """ Ideally you should have several levels of tests.  At the lowest level
@@ -488,3 +711,42 @@ class ClipBranchesTest(ScriptedLoadableModuleTest):
     # self.assertEqual(outputScalarRange[1], inputScalarRange[1])
 
     # self.delayDisplay('Test passed')
+
+  def test_MergeSeams(self):
+    """ extracting all groups of a surface clipped into groups should not leave cracks at the seams, 
+    i.e. no boundary edges beyond the boundary edges of the input surface
+    """
+    from vtk.util import numpy_support
+    self.delayDisplay("Starting the merge seams test")
+    logic = ClipBranchesLogic()
+
+    # sphere clipped into two groups, with duplicate points at the seam
+    sphere = vtk.vtkSphereSource()
+    sphere.SetThetaResolution(40)
+    sphere.SetPhiResolution(40)
+    sphere.Update()
+    cylinder = vtk.vtkCylinder()
+    cylinder.SetRadius(0.3)
+    cylinder.SetAxis(1,0,0)
+    clipper = vtk.vtkClipPolyData()
+    clipper.SetInputData(sphere.GetOutput())
+    clipper.SetClipFunction(cylinder)
+    clipper.GenerateClippedOutputOn()
+    clipper.Update()
+    appendFilter = vtk.vtkAppendPolyData()
+    appendFilter.AddInputData(clipper.GetOutput())
+    appendFilter.AddInputData(clipper.GetClippedOutput())
+    appendFilter.Update()
+    groupsPolyData = appendFilter.GetOutput()
+    cellGroupIds = np.concatenate([np.zeros(clipper.GetOutput().GetNumberOfCells(), dtype=np.int64),
+                                   np.ones(clipper.GetClippedOutput().GetNumberOfCells(), dtype=np.int64)])
+    self.assertGreater(logic.countBoundaryEdges(groupsPolyData), 0)
+
+    mergedPolyData = logic.extractGroups(groupsPolyData, cellGroupIds, [0, 1])
+    self.assertEqual(logic.countBoundaryEdges(mergedPolyData), logic.countBoundaryEdges(sphere.GetOutput()))
+    self.assertEqual(mergedPolyData.GetNumberOfCells(), groupsPolyData.GetNumberOfCells())
+    # removing a group only opens the surface at the seam of the removed group
+    openedPolyData = logic.extractGroups(groupsPolyData, cellGroupIds, [1], remove=True)
+    self.assertEqual(logic.countBoundaryEdges(openedPolyData), logic.countBoundaryEdges(clipper.GetOutput()))
+
+    self.delayDisplay('Test passed')
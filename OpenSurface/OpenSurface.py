@@ -1,6 +1,8 @@
+import collections
 import logging
 import os
 
+import qt
 import vtk
 from vtk.numpy_interface import dataset_adapter as dsa
 import slicer
@@ -66,12 +68,21 @@ class OpenSurfaceWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
     self.layout.addWidget(uiWidget)
     self.ui = slicer.util.childWidgetVariables(uiWidget)
 
-    # initialize pointslocator, used in the positioning of the ROI box for clipping, to None 
-    self.pointsLocator = None
-
     # intitialize indicator whether ROIbox should be moved or not
     self.moveROIBox = False
 
+    # undo/redo history of the clips, started at the first clip
+    self.clipHistory = None
+    self.clipHistoryOutputPolyData = None
+
+    # cursor events are coalesced: the timer updates the ROI box at most once per frame, for the latest cursor position
+    self.roiCursorPosition = None
+    self.roiUpdateInProgress = False
+    self.roiUpdateTimer = qt.QTimer()
+    self.roiUpdateTimer.setSingleShot(True)
+    self.roiUpdateTimer.setInterval(16)
+    self.roiUpdateTimer.connect('timeout()', self.onROIUpdateTimer)
+
     # Set scene in MRML widgets. Make sure that in Qt designer the top-level qMRMLWidget's
     # "mrmlSceneChanged(vtkMRMLScene*)" signal in is connected to each MRML widget's.
     # "setMRMLScene(vtkMRMLScene*)" slot.
@@ -93,10 +104,16 @@ class OpenSurfaceWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
     self.ui.inputSurfaceSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.updateParameterNodeFromGUI)
     self.ui.inputCenterlineSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.updateParameterNodeFromGUI)
     self.ui.outputSurfaceSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.updateParameterNodeFromGUI)
+    self.ui.endCutDistanceSpinBox.connect("valueChanged(double)", self.updateParameterNodeFromGUI)
+    self.ui.endCutInRadiiCheckBox.connect("toggled(bool)", self.updateParameterNodeFromGUI)
+    self.ui.planeCutCheckBox.connect("toggled(bool)", self.updateParameterNodeFromGUI)
     
     
     # Buttons
     self.ui.applyButton.connect('clicked(bool)', self.onApplyButton)
+    self.ui.openEndsButton.connect('clicked(bool)', self.onOpenEndsButton)
+    self.ui.undoButton.connect('clicked(bool)', self.onUndoButton)
+    self.ui.redoButton.connect('clicked(bool)', self.onRedoButton)
 
     # slider
     #self.ui.planeLocationWidget.connect('valueChanged(double)', self.setCurrentPlaneIndex)
@@ -110,6 +127,7 @@ class OpenSurfaceWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
     Called when the application closes and the module widget is destroyed.
     """
     self.removeObservers()
+    self.roiUpdateTimer.stop()
 
   def enter(self):
     """
@@ -210,19 +228,16 @@ class OpenSurfaceWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
     self.ui.inputSurfaceSelector.setCurrentNode(self._parameterNode.GetNodeReference("InputSurface"))
     self.ui.inputCenterlineSelector.setCurrentNode(self._parameterNode.GetNodeReference("InputCenterline"))
     self.ui.outputSurfaceSelector.setCurrentNode(self._parameterNode.GetNodeReference("OutputSurface"))
+    self.ui.endCutDistanceSpinBox.value = float(self._parameterNode.GetParameter("EndCutDistance"))
+    self.ui.endCutInRadiiCheckBox.checked = (self._parameterNode.GetParameter("EndCutInRadii") == "true")
+    self.ui.planeCutCheckBox.checked = (self._parameterNode.GetParameter("PlaneCut") == "true")
     
     # Update buttons states and tooltips
     if self._parameterNode.GetNodeReference("InputSurface") and self._parameterNode.GetNodeReference("InputCenterline"):
       print("*")
     
       if not self._parameterNode.GetNodeReference("OpenSurface_ROIBox"):
-        roiBoxReady = self.initializeROIBox()
-        # initialize points locator used in the positioning of the ROI box  
-        if roiBoxReady:
-          if not self.pointsLocator:
-            self.pointsLocator = vtk.vtkPointLocator() # could try using vtk.vtkStaticPointLocator() if need to optimize
-            self.pointsLocator.SetDataSet(self._parameterNode.GetNodeReference("InputCenterline").GetPolyData())
-            self.pointsLocator.BuildLocator() 
+        self.initializeROIBox()
         # initialize output model if none is selected
       if not self._parameterNode.GetNodeReference("OutputSurface"):
         outputNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLModelNode', 'open_model')
@@ -236,6 +251,9 @@ class OpenSurfaceWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
     else:
       self.ui.applyButton.toolTip = " to apply clip, first place ROI"
       self.ui.applyButton.enabled = False
+
+    self.ui.openEndsButton.enabled = (self._parameterNode.GetNodeReference("InputSurface") is not None 
+                                      and self._parameterNode.GetNodeReference("InputCenterline") is not None)
       
     
     # All the GUI updates are done
@@ -255,6 +273,9 @@ class OpenSurfaceWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
     self._parameterNode.SetNodeReferenceID("InputSurface", self.ui.inputSurfaceSelector.currentNodeID)
     self._parameterNode.SetNodeReferenceID("InputCenterline", self.ui.inputCenterlineSelector.currentNodeID)
     self._parameterNode.SetNodeReferenceID("OutputSurface", self.ui.outputSurfaceSelector.currentNodeID)
+    self._parameterNode.SetParameter("EndCutDistance", str(self.ui.endCutDistanceSpinBox.value))
+    self._parameterNode.SetParameter("EndCutInRadii", "true" if self.ui.endCutInRadiiCheckBox.checked else "false")
+    self._parameterNode.SetParameter("PlaneCut", "true" if self.ui.planeCutCheckBox.checked else "false")
     
     
     self._parameterNode.EndModify(wasModified)
@@ -263,40 +284,19 @@ class OpenSurfaceWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
     # initialize the ROI box at index 0
     print("InitializeROIBox")
     try:
-      # check if centerlinegeometry has already been computed, if not, compute it once
+      # the ROI frames are computed once per centerline by the logic, the centerline node is not modified
       centerlineModelNode = self._parameterNode.GetNodeReference("InputCenterline")
-      if not centerlineModelNode.HasPointScalarName("FrenetTangent"):
-        centerlineGeometryPolyData = self.logic.computeCenterlineGeometry(self.logic.polyDataFromNode(centerlineModelNode))
-        centerlineModelNode.SetAndObserveMesh(centerlineGeometryPolyData)
-
-      # compute plane normal to centerline
-      plane_idx = 0
-      planeNode = self.logic.createPlaneNormalToCenterline(self.logic.polyDataFromNode(centerlineModelNode), plane_idx, "OpenSurface_SlicePlane") 
-      planeNode.SetHideFromEditors(1)
-    
-      # create ROI BOX markups node
+
+      # create ROI BOX markups node normal to the centerline at index 0
+      (roiFrames, roiSizes) = self.logic.computeROIFrames(self.logic.polyDataFromNode(centerlineModelNode))
       roiNode = self._parameterNode.GetNodeReference("OpenSurface_ROIBox")
       if not roiNode:
-        roiNode = self.logic.createROIBox(planeNode.GetCenter(),planeNode.GetSize()[0],planeNode.GetSize()[0],planeNode.GetSize()[0],"OpenSurface_ROIBox")
+        roiNode = self.logic.createROIBox(roiFrames[0,:3,3],roiSizes[0],roiSizes[0],roiSizes[0],"OpenSurface_ROIBox")
         roiNode.GetDisplayNode().SetPointLabelsVisibility(False)
         roiNode.GetDisplayNode().SetPropertiesLabelVisibility(False)
         # add to parameter node
         self._parameterNode.SetNodeReferenceID("OpenSurface_ROIBox", roiNode.GetID())
-      # get the roibox's planes
-      roiPlanes = vtk.vtkPlanes()
-      roiNode.GetPlanes(roiPlanes)
-      
-      # convert one of the roi planes to markupplane for registration
-      roiPlane0 = roiPlanes.GetPlane(0)
-      planeROINode = self.logic.createPlaneFromOriginAndNormal(roiPlane0.GetOrigin(),roiPlane0.GetNormal(),planeNode.GetSize()[0],"OpenSurface_ROIPlane")
-      planeROINode.SetHideFromEditors(1)
-      
-      #align the roi to the plane normal to the centerline using the roi plane in the aligning process
-      self.logic.alignPlanes(planeNode,planeROINode,roiNode)
-      
-      # remove nodes that are no longer necessary
-      slicer.mrmlScene.RemoveNode(planeNode)
-      slicer.mrmlScene.RemoveNode(planeROINode)
+      self.logic.setROIFrame(roiNode, roiFrames[0], roiSizes[0])
 
       # setup crosshair to get positionon centerline model. Position can be selected by moving the mouse while holding the shift+'r' key ( slicer<5.4) 
       # or the 'r'key (>= slicer 5.4). Code based on script repository
@@ -326,16 +326,34 @@ class OpenSurfaceWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
       self.moveROIBox = False 
 
   def onMouseMoved(self,observer, eventid):
-    centerlineModelNode = self._parameterNode.GetNodeReference("InputCenterline")
+    if not self.moveROIBox:
+      return
+    # only store the latest cursor position, the ROI box is updated by the timer
     crosshairNode = slicer.util.getNode("Crosshair")
     ras=[0,0,0]
     crosshairNode.GetCursorPositionRAS(ras)
-    closestPointId = self.pointsLocator.FindClosestPoint(ras)
-    ras = centerlineModelNode.GetPolyData().GetPoint(closestPointId)
-   
-    if self.moveROIBox:
+    self.roiCursorPosition = ras
+    if not self.roiUpdateTimer.isActive():
+      self.roiUpdateTimer.start()
+
+  def onROIUpdateTimer(self):
+    if self.roiCursorPosition is None:
+      return
+    if self.roiUpdateInProgress:
+      # try again when the running update is finished
+      self.roiUpdateTimer.start()
+      return
+    ras = self.roiCursorPosition
+    self.roiCursorPosition = None
+    self.roiUpdateInProgress = True
+    try:
+      # the locator of the centerline is rebuilt when the centerline is modified or replaced
+      centerlineModelNode = self._parameterNode.GetNodeReference("InputCenterline")
+      closestPointId = self.logic.getCenterlinePointLocator(centerlineModelNode.GetPolyData()).findClosestPoint(ras)
       # redraw ROIbox for clipping
-      self.updateROIBox(closestPointId)   
+      self.updateROIBox(closestPointId)
+    finally:
+      self.roiUpdateInProgress = False
 
  
   def updateROIBox(self, pointIndex):
@@ -350,59 +368,299 @@ class OpenSurfaceWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
       
     with slicer.util.tryWithErrorDisplay("Failed to compute results.", waitCursor=True):
      
-      # check if centerlinegeometry has already been computed, if not, compute it once
+      # look up the precomputed ROI frame of the point, the frames are only computed once per centerline
       centerlineModelNode = self._parameterNode.GetNodeReference("InputCenterline")
-      if not centerlineModelNode.HasPointScalarName("FrenetTangent"):
-        centerlineGeometryPolyData = self.logic.computeCenterlineGeometry(self.logic.polyDataFromNode(centerlineModelNode))
-        centerlineModelNode.SetAndObserveMesh(centerlineGeometryPolyData)
-
-      # Todo: move this to logic class
       roiNode = self._parameterNode.GetNodeReference("OpenSurface_ROIBox")
-      
-      planeNode = self.logic.createPlaneNormalToCenterline(self.logic.polyDataFromNode(centerlineModelNode), pointIndex, "OpenSurface_SlicePlane") 
-      planeNode.SetHideFromEditors(1)
-      
-      # get the roibox's planes
-      roiPlanes = vtk.vtkPlanes()
-      roiNode.GetPlanes(roiPlanes)
-      
-      # convert one of the roi planes to markupplane  for registration
-      roiPlane0 = roiPlanes.GetPlane(0)
-      planeROINode = self.logic.createPlaneFromOriginAndNormal(roiPlane0.GetOrigin(),roiPlane0.GetNormal(),planeNode.GetSize()[0],"OpenSurface_ROIPlane")
-      planeROINode.SetHideFromEditors(1)
-      
-      #align the roi to the plane normal to the centerline using the roi plane in the aligning process
-      self.logic.alignPlanes(planeNode,planeROINode,roiNode)
-      
-      # resize ROIbox
-      roiNode.SetSize(planeNode.GetSize()[0],planeNode.GetSize()[0],planeNode.GetSize()[0])
+      (roiFrames, roiSizes) = self.logic.computeROIFrames(self.logic.polyDataFromNode(centerlineModelNode))
+      self.logic.setROIFrame(roiNode, roiFrames[pointIndex], roiSizes[pointIndex])
 
-      # remove nodes that are no longer necessary
-      slicer.mrmlScene.RemoveNode(planeNode)
-      slicer.mrmlScene.RemoveNode(planeROINode)
-      
- 
-   
   def onApplyButton(self):
     """
     Run processing when user clicks "Apply" button.
     """
     with slicer.util.tryWithErrorDisplay("Failed to compute results.", waitCursor=True):
 
-      # clip the model using the markupsROINode. Use the dynamic modeler module's ROI cut tool fo this.
-      modelNode = self._parameterNode.GetNodeReference("InputSurface")
       roiNode = self._parameterNode.GetNodeReference("OpenSurface_ROIBox")
-      outputNode = self._parameterNode.GetNodeReference("OutputSurface")      
-      self.logic.clipROIFromModel(modelNode,roiNode,outputNode)
-      # display outputnode and hide inputnode
-      if modelNode is not outputNode:
-      #  print("hide inputnode")
-        modelNode.SetDisplayVisibility(0)
-      outputNode.SetDisplayVisibility(1)
-      outputNode.GetDisplayNode().SetOpacity(0.6)
-      outputNode.GetDisplayNode().SetColor(0.5,0.9,0.88)
-      
-  
+      if self._parameterNode.GetParameter("PlaneCut") == "true":
+        # cut the model with the plane normal to the centerline at the ROI box position
+        centerlinePolyData = self._parameterNode.GetNodeReference("InputCenterline").GetPolyData()
+        pointIndex = int(self._parameterNode.GetParameter("SlicePlaneLocation"))
+        self.applyClip(lambda polyData: self.logic.clipPlaneFromPolyData(polyData, centerlinePolyData, pointIndex))
+      else:
+        # clip the model using the markupsROINode
+        self.applyClip(lambda polyData: self.logic.clipROIFromPolyData(polyData, roiNode))
+
+  def onOpenEndsButton(self):
+    """
+    Open all inlets and outlets at the cut distance from the ends of the centerlines.
+    """
+    with slicer.util.tryWithErrorDisplay("Failed to open the surface.", waitCursor=True):
+
+      centerlinePolyData = self._parameterNode.GetNodeReference("InputCenterline").GetPolyData()
+      cutSpecifications = self.logic.getEndCutSpecifications(centerlinePolyData, float(self._parameterNode.GetParameter("EndCutDistance")), 
+                                                             self._parameterNode.GetParameter("EndCutInRadii") == "true")
+      self.applyClip(lambda polyData: self.logic.clipSurfaceAtCenterlineCuts(polyData, centerlinePolyData, cutSpecifications))
+
+  def onUndoButton(self):
+    with slicer.util.tryWithErrorDisplay("Failed to undo the clip.", waitCursor=True):
+      if self.clipHistory:
+        self.showClipResult(self.clipHistory.undo())
+
+  def onRedoButton(self):
+    with slicer.util.tryWithErrorDisplay("Failed to redo the clip.", waitCursor=True):
+      if self.clipHistory:
+        self.showClipResult(self.clipHistory.redo())
+
+  def applyClip(self, clipFunction):
+    """ clip the current surface of the clip history with clipFunction(polyData) and show the result.
+    Successive clips are applied to the result of the previous clip, they can be undone with the undo button.
+    """
+    modelNode = self._parameterNode.GetNodeReference("InputSurface")
+    # restart the history if another input surface was selected (the input can also be the output node)
+    if (self.clipHistory is None or 
+        modelNode.GetPolyData() not in (self.clipHistory.sourcePolyData, self.clipHistoryOutputPolyData)):
+      self.clipHistory = ClipHistory(modelNode.GetPolyData())
+    self.showClipResult(self.clipHistory.push(clipFunction(self.clipHistory.getCurrentPolyData())))
+
+  def showClipResult(self, polyData):
+    modelNode = self._parameterNode.GetNodeReference("InputSurface")
+    outputNode = self._parameterNode.GetNodeReference("OutputSurface")
+    if not outputNode:
+      outputNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLModelNode', 'open_model')
+      self._parameterNode.SetNodeReferenceID("OutputSurface",outputNode.GetID())
+    outputNode.SetAndObserveMesh(polyData)
+    self.clipHistoryOutputPolyData = polyData
+    if not outputNode.GetDisplayNode():
+      outputNode.CreateDefaultDisplayNodes()
+    # display outputnode and hide inputnode
+    if modelNode is not outputNode:
+      modelNode.SetDisplayVisibility(0)
+    outputNode.SetDisplayVisibility(1)
+    outputNode.GetDisplayNode().SetOpacity(0.6)
+    outputNode.GetDisplayNode().SetColor(0.5,0.9,0.88)
+    self.ui.undoButton.enabled = self.clipHistory.canUndo()
+    self.ui.redoButton.enabled = self.clipHistory.canRedo()
+
+#
+# CenterlinePointLocator
+#
+
+class CenterlinePointLocator:
+  """ Static point locator of a centerline, used to pick the centerline point closest to a position.
+  Use CenterlinePointLocator.get: the locator is stored with the ClipBranches.CenterlineData of the centerline, so it is 
+  built once per centerline polydata and rebuilt (lazily) when the polydata is modified.
+  """
+  # number of position x centerline point distances computed at once by findClosestPoints
+  chunkEntries = 1 << 22
+
+  @classmethod
+  def get(cls, centerlinePolyData):
+    """ locator of the polydata, only built again if the polydata was modified since the last call """
+    import ClipBranches
+    centerlineData = ClipBranches.CenterlineData.get(centerlinePolyData)
+    if 'PointLocator' not in centerlineData.derived:
+      centerlineData.derived['PointLocator'] = cls(centerlinePolyData, centerlineData.points)
+    return centerlineData.derived['PointLocator']
+
+  def __init__(self, centerlinePolyData, points):
+    self.locator = vtk.vtkStaticPointLocator()
+    self.locator.SetDataSet(centerlinePolyData)
+    self.locator.BuildLocator()
+    self.points = np.asarray(points, dtype=float)
+    self.pointsSquaredNorm = np.sum(self.points**2, axis=1)
+
+  def findClosestPoint(self, position):
+    """ id of the centerline point closest to the (x,y,z) position """
+    return self.locator.FindClosestPoint(position)
+
+  def findClosestPoints(self, positions):
+    """ ids of the centerline points closest to each of the positions (array of shape (n,3)) """
+    positions = np.asarray(positions, dtype=float).reshape(-1,3)
+    closestPointIds = np.zeros(positions.shape[0], dtype=np.int64)
+    if self.points.shape[0] == 0:
+      return closestPointIds - 1
+    # brute force in chunks (centerlines have few points): squared distances up to the squared norm of the positions
+    chunkSize = max(1, self.chunkEntries // self.points.shape[0])
+    for start in range(0, positions.shape[0], chunkSize):
+      distances = self.pointsSquaredNorm[None,:] - 2*positions[start:start+chunkSize] @ self.points.T
+      closestPointIds[start:start+chunkSize] = np.argmin(distances, axis=1)
+    return closestPointIds
+
+#
+# ClipHistory
+#
+
+class ClipHistory:
+  """ Undo/redo history of successive clips of a surface (polygons). Each step is stored as a delta against the original 
+  surface: a bitmask (np.packbits) of the original cells that are still intact, and the cells created by the cuts with 
+  their new points. Clip the polydata of getCurrentPolyData, which carries the ids of the original cells and points, 
+  and add the result with push.
+  """
+  cellIdsArrayName = 'ClipHistoryCellIds'
+  pointIdsArrayName = 'ClipHistoryPointIds'
+
+  def __init__(self, surfacePolyData):
+    from vtk.util import numpy_support
+    self.sourcePolyData = surfacePolyData
+    self.points = numpy_support.vtk_to_numpy(surfacePolyData.GetPoints().GetData())
+    self.offsets = numpy_support.vtk_to_numpy(surfacePolyData.GetPolys().GetOffsetsArray())
+    self.connectivity = numpy_support.vtk_to_numpy(surfacePolyData.GetPolys().GetConnectivityArray())
+    self.numberOfPoints = self.points.shape[0]
+    self.numberOfCells = self.offsets.shape[0] - 1
+    self.pointData = self.getArrays(surfacePolyData.GetPointData())
+    self.cellData = self.getArrays(surfacePolyData.GetCellData())
+
+    # step 0 is the original surface, tagged with the ids of its cells and points
+    self.originalPolyData = vtk.vtkPolyData()
+    self.originalPolyData.ShallowCopy(surfacePolyData)
+    self.addIdArrays(self.originalPolyData, np.arange(self.numberOfCells), np.arange(self.numberOfPoints))
+    self.steps = [None]
+    self.index = 0
+    self.currentPolyData = self.originalPolyData
+
+  @staticmethod
+  def getArrays(fieldData):
+    """ named numeric arrays as numpy views """
+    from vtk.util import numpy_support
+    arrays = {}
+    for i in range(fieldData.GetNumberOfArrays()):
+      array = fieldData.GetArray(i)
+      if array and array.GetName():
+        arrays[array.GetName()] = numpy_support.vtk_to_numpy(array)
+    return arrays
+
+  def addIdArrays(self, polyData, cellIds, pointIds):
+    """ add the original cell and point ids (-1 for new cells and points). The point ids are stored as double, 
+    id type arrays are not interpolated by the clip filters
+    """
+    from vtk.util import numpy_support
+    for (fieldData, ids, arrayName) in [(polyData.GetCellData(), np.asarray(cellIds, dtype=np.int64), self.cellIdsArrayName), 
+                                        (polyData.GetPointData(), np.asarray(pointIds, dtype=float), self.pointIdsArrayName)]:
+      idArray = numpy_support.numpy_to_vtk(ids, deep=True)
+      idArray.SetName(arrayName)
+      fieldData.AddArray(idArray)
+
+  def getCurrentPolyData(self):
+    """ polydata of the current step, with the id arrays, to be clipped """
+    return self.currentPolyData
+
+  def getDisplayPolyData(self):
+    """ polydata of the current step without the id arrays """
+    displayPolyData = vtk.vtkPolyData()
+    displayPolyData.ShallowCopy(self.currentPolyData)
+    displayPolyData.GetCellData().RemoveArray(self.cellIdsArrayName)
+    displayPolyData.GetPointData().RemoveArray(self.pointIdsArrayName)
+    return displayPolyData
+
+  def canUndo(self):
+    return self.index > 0
+
+  def canRedo(self):
+    return self.index < len(self.steps) - 1
+
+  def push(self, clippedPolyData):
+    """ add a clip of the current polydata as a new step, the steps that were undone are discarded.
+    returns the polydata to display
+    """
+    from vtk.util import numpy_support
+    cellIds = numpy_support.vtk_to_numpy(clippedPolyData.GetCellData().GetArray(self.cellIdsArrayName)).astype(np.int64)
+    pointIds = np.round(numpy_support.vtk_to_numpy(clippedPolyData.GetPointData().GetArray(self.pointIdsArrayName))).astype(np.int64)
+    points = numpy_support.vtk_to_numpy(clippedPolyData.GetPoints().GetData())
+    offsets = numpy_support.vtk_to_numpy(clippedPolyData.GetPolys().GetOffsetsArray())
+    connectivity = numpy_support.vtk_to_numpy(clippedPolyData.GetPolys().GetConnectivityArray())
+    sizes = np.diff(offsets)
+
+    # original points: the id is interpolated at the new points of the cuts, so also check the coordinates
+    isOriginalPoint = (pointIds >= 0) & (pointIds < self.numberOfPoints)
+    isOriginalPoint[isOriginalPoint] = np.all(points[isOriginalPoint] == self.points[pointIds[isOriginalPoint]], axis=1)
+    originalPointIds = np.where(isOriginalPoint, pointIds, -1)
+
+    # intact cells have the points of the original cell with their id, in the same order
+    intact = (cellIds >= 0) & (cellIds < self.numberOfCells)
+    intact[intact] = sizes[intact] == np.diff(self.offsets)[cellIds[intact]]
+    entryCells = np.repeat(np.arange(sizes.shape[0]), sizes)
+    entries = np.nonzero(intact[entryCells])[0]
+    expectedPointIds = self.connectivity[self.offsets[cellIds[entryCells[entries]]] + entries - offsets[entryCells[entries]]]
+    intact[entryCells[entries[originalPointIds[connectivity[entries]] != expectedPointIds]]] = False
+    mask = np.zeros(self.numberOfCells, dtype=bool)
+    mask[cellIds[intact]] = True
+
+    # cells created by the cuts, their points are numbered after the original points
+    extraConnectivity = connectivity[~intact[entryCells]]
+    newPointIds = np.unique(extraConnectivity[~isOriginalPoint[extraConnectivity]])
+    pointMap = originalPointIds.copy()
+    pointMap[newPointIds] = self.numberOfPoints + np.arange(newPointIds.shape[0])
+    clippedPointData = self.getArrays(clippedPolyData.GetPointData())
+    clippedCellData = self.getArrays(clippedPolyData.GetCellData())
+    step = {'mask': np.packbits(mask),
+            'newPoints': points[newPointIds].copy(),
+            'newPointData': {name: clippedPointData[name][newPointIds].copy() for name in self.pointData if name in clippedPointData},
+            'cellSizes': sizes[~intact].copy(),
+            'cellConnectivity': pointMap[extraConnectivity],
+            'cellData': {name: clippedCellData[name][~intact].copy() for name in self.cellData if name in clippedCellData}}
+
+    del self.steps[self.index+1:]
+    self.steps.append(step)
+    self.index += 1
+    self.currentPolyData = clippedPolyData
+    return self.getDisplayPolyData()
+
+  def undo(self):
+    """ go back one step, returns the polydata to display """
+    if self.canUndo():
+      self.index -= 1
+      self.currentPolyData = self.reconstruct(self.index)
+    return self.getDisplayPolyData()
+
+  def redo(self):
+    """ go forward one step, returns the polydata to display """
+    if self.canRedo():
+      self.index += 1
+      self.currentPolyData = self.reconstruct(self.index)
+    return self.getDisplayPolyData()
+
+  def reconstruct(self, index):
+    """ polydata of a step: the intact original cells and the cells of the cuts, without unused points """
+    from vtk.util import numpy_support
+    if index == 0:
+      return self.originalPolyData
+    step = self.steps[index]
+    mask = np.unpackbits(step['mask'], count=self.numberOfCells).astype(bool)
+    originalSizes = np.diff(self.offsets)
+    sizes = np.concatenate([originalSizes[mask], step['cellSizes']])
+    connectivity = np.concatenate([self.connectivity[np.repeat(mask, originalSizes)], step['cellConnectivity']])
+
+    # remove the unused points
+    numberOfNewPoints = step['newPoints'].shape[0]
+    used = np.zeros(self.numberOfPoints + numberOfNewPoints, dtype=bool)
+    used[connectivity] = True
+    usedPointIds = np.cumsum(used) - 1
+
+    polyData = vtk.vtkPolyData()
+    points = vtk.vtkPoints()
+    points.SetData(numpy_support.numpy_to_vtk(np.concatenate([self.points, step['newPoints']])[used], deep=True))
+    polyData.SetPoints(points)
+    polys = vtk.vtkCellArray()
+    polys.SetData(numpy_support.numpy_to_vtkIdTypeArray(np.concatenate([[0], np.cumsum(sizes)]).astype(np.int64), deep=True),
+                  numpy_support.numpy_to_vtkIdTypeArray(usedPointIds[connectivity].astype(np.int64), deep=True))
+    polyData.SetPolys(polys)
+
+    # arrays missing in the step (e.g. removed by a filter) are zero at the new points and cells
+    numberOfNewCells = step['cellSizes'].shape[0]
+    pointArrays = {name: np.concatenate([array, step['newPointData'].get(name, np.zeros((numberOfNewPoints,) + array.shape[1:])).astype(array.dtype)])[used]
+                   for (name, array) in self.pointData.items()}
+    cellArrays = {name: np.concatenate([array[mask], step['cellData'].get(name, np.zeros((numberOfNewCells,) + array.shape[1:])).astype(array.dtype)])
+                  for (name, array) in self.cellData.items()}
+    for (fieldData, arrays) in [(polyData.GetPointData(), pointArrays), (polyData.GetCellData(), cellArrays)]:
+      for (name, values) in arrays.items():
+        vtkArray = numpy_support.numpy_to_vtk(values, deep=True)
+        vtkArray.SetName(name)
+        fieldData.AddArray(vtkArray)
+
+    cellIds = np.concatenate([np.nonzero(mask)[0], np.full(numberOfNewCells, -1)])
+    pointIds = np.concatenate([np.arange(self.numberOfPoints), np.full(numberOfNewPoints, -1)])[used]
+    self.addIdArrays(polyData, cellIds, pointIds)
+    return polyData
 
 #
 # OpenSurfaceLogic
@@ -418,6 +676,10 @@ class OpenSurfaceLogic(ScriptedLoadableModuleLogic):
   https://github.com/Slicer/Slicer/blob/master/Base/Python/slicer/ScriptedLoadableModule.py
   """
 
+  # centerline geometry of recently used centerlines: (content hash, smoothing parameters) -> geometry arrays
+  centerlineGeometryCache = collections.OrderedDict()
+  centerlineGeometryCacheSize = 8
+
   def __init__(self):
     """
     Called when the logic class is instantiated. Can be used for initializing member variables.
@@ -446,6 +708,12 @@ class OpenSurfaceLogic(ScriptedLoadableModuleLogic):
     """
     if not parameterNode.GetParameter("SlicePlaneLocation"):
       parameterNode.SetParameter("SlicePlaneLocation", "0")
+    if not parameterNode.GetParameter("EndCutDistance"):
+      parameterNode.SetParameter("EndCutDistance", "2.0")
+    if not parameterNode.GetParameter("EndCutInRadii"):
+      parameterNode.SetParameter("EndCutInRadii", "false")
+    if not parameterNode.GetParameter("PlaneCut"):
+      parameterNode.SetParameter("PlaneCut", "false")
     
   def polyDataFromNode(self, surfaceNode):
     if not surfaceNode:
@@ -460,11 +728,12 @@ class OpenSurfaceLogic(ScriptedLoadableModuleLogic):
       
         
       
-  def computeCenterlineGeometry(self,centerlinePolyData):
+  def computeCenterlineGeometry(self,centerlinePolyData,smoothing=False,numberOfSmoothingIterations=100,smoothingFactor=0.1):
     """
     Compute the centerline geometry
     Can be used without the GUI widget.
     :param centerlinePolyData: Centerline model of vessel
+    :param smoothing: compute the geometry on smoothed lines, the output points are not smoothed
     """
     import vtkvmtkComputationalGeometryPython as vtkvmtkComputationalGeometry
     centerlineGeometry = vtkvmtkComputationalGeometry.vtkvmtkCenterlineGeometry()
@@ -476,12 +745,48 @@ class OpenSurfaceLogic(ScriptedLoadableModuleLogic):
     centerlineGeometry.SetFrenetTangentArrayName(self.frenetTangentArrayName)
     centerlineGeometry.SetFrenetNormalArrayName(self.frenetNormalArrayName)
     centerlineGeometry.SetFrenetBinormalArrayName(self.frenetBinormalArrayName)
-    # centerlineGeometry.SetLineSmoothing(0)
-    # centerlineGeometry.SetOutputSmoothedLines(0)
-    # centerlineGeometry.SetNumberOfSmoothingIterations(100)
-    # centerlineGeometry.SetSmoothingFactor(0.1)
+    centerlineGeometry.SetLineSmoothing(1 if smoothing else 0)
+    centerlineGeometry.SetOutputSmoothedLines(0)
+    centerlineGeometry.SetNumberOfSmoothingIterations(numberOfSmoothingIterations)
+    centerlineGeometry.SetSmoothingFactor(smoothingFactor)
     centerlineGeometry.Update()
     return centerlineGeometry.GetOutput()
+
+  def getCenterlineContentHash(self, centerlinePolyData):
+    """ hash of the points, lines and radii of the centerline, computed once as long as the polydata is not modified """
+    import hashlib
+    import ClipBranches
+    centerlineData = ClipBranches.CenterlineData.get(centerlinePolyData)
+    if 'ContentHash' not in centerlineData.derived:
+      contentHash = hashlib.blake2b(digest_size=16)
+      for array in [centerlineData.points, centerlineData.offsets, centerlineData.connectivity, centerlineData.pointData.get('Radius', np.zeros(0))]:
+        contentHash.update(np.ascontiguousarray(array).tobytes())
+      centerlineData.derived['ContentHash'] = contentHash.hexdigest()
+    return centerlineData.derived['ContentHash']
+
+  def getCenterlineGeometry(self, centerlinePolyData, smoothing=False, numberOfSmoothingIterations=100, smoothingFactor=0.1):
+    """ geometry of the centerline, computed once per centerline content and smoothing parameters. The centerline itself 
+    is not modified, the arrays are returned separately: a dictionary array name -> numpy array with the point arrays 
+    (Frenet tangent, normal and binormal, curvature, torsion) and the cell arrays (length, tortuosity)
+    """
+    from vtk.util import numpy_support
+    key = (self.getCenterlineContentHash(centerlinePolyData), bool(smoothing), int(numberOfSmoothingIterations), float(smoothingFactor))
+    cache = OpenSurfaceLogic.centerlineGeometryCache
+    if key in cache:
+      cache.move_to_end(key)
+      return cache[key]
+    centerlineGeometryPolyData = self.computeCenterlineGeometry(centerlinePolyData, smoothing, numberOfSmoothingIterations, smoothingFactor)
+    geometryArrays = {}
+    for (fieldData, arrayNames) in [(centerlineGeometryPolyData.GetPointData(), [self.frenetTangentArrayName, self.frenetNormalArrayName, 
+                                     self.frenetBinormalArrayName, self.curvatureArrayName, self.torsionArrayName]),
+                                    (centerlineGeometryPolyData.GetCellData(), [self.lengthArrayName, self.tortuosityArrayName])]:
+      for arrayName in arrayNames:
+        if fieldData.GetArray(arrayName):
+          geometryArrays[arrayName] = numpy_support.vtk_to_numpy(fieldData.GetArray(arrayName)).copy()
+    cache[key] = geometryArrays
+    while len(cache) > OpenSurfaceLogic.centerlineGeometryCacheSize:
+      cache.popitem(last=False)
+    return geometryArrays
   
   def createPlaneFromOriginAndNormal(self,origin,normal,size, nodename,parameterNode=None):
     """create a markups plane at the coordinates in origin with orientation orthogononal to the normal vector. If the plane node already exists it is updated with the passed origin and normal"""
@@ -505,17 +810,14 @@ class OpenSurfaceLogic(ScriptedLoadableModuleLogic):
     Create a markups plane normal to the centerline and display it in the current scene
     :param centerlinePolyData: Centerline model of vessel
     """
-    from vtk.numpy_interface import dataset_adapter as dsa
-    # TODO: replace this with slicer util methods
-    pointdata = dsa.WrapDataObject(centerlinePolyData).PointData
-    normaldata = pointdata['FrenetNormal']
-    tangentdata = pointdata['FrenetTangent']
-    points = dsa.WrapDataObject(centerlinePolyData).Points
+    import ClipBranches
+    centerlineData = ClipBranches.CenterlineData.get(centerlinePolyData)
+    (tangents, normals) = self.computeRotationMinimizingFrames(centerlinePolyData)
     
     # plane coords and normal
-    planeCenter = points[planeIdx,:]
-    planeNormal = tangentdata[planeIdx,:]
-    planeSize = 2*pointdata['Radius'][planeIdx]*1.5
+    planeCenter = centerlineData.points[planeIdx,:]
+    planeNormal = tangents[planeIdx,:]
+    planeSize = 2*centerlineData.pointData['Radius'][planeIdx]*1.5
     # create/update a markups plane normal to the centerline curve at the indexed location
     return self.createPlaneFromOriginAndNormal(planeCenter,planeNormal,planeSize,nodename,parameterNode)
     
@@ -530,6 +832,122 @@ class OpenSurfaceLogic(ScriptedLoadableModuleLogic):
       
     return roiNode   
 
+  def getCenterlinePointLocator(self, centerlinePolyData):
+    """ point locator of the centerline, rebuilt only when the centerline was modified """
+    return CenterlinePointLocator.get(centerlinePolyData)
+
+  def findClosestCenterlinePoints(self, centerlinePolyData, positions):
+    """ ids of the centerline points closest to the positions (array of shape (n,3)) """
+    return CenterlinePointLocator.get(centerlinePolyData).findClosestPoints(positions)
+
+  @staticmethod
+  def orthogonalVectors(vectors):
+    """ unit vectors orthogonal to the (unit) vectors, array of shape (n,3) """
+    axes = np.eye(3)[np.argmin(np.abs(vectors), axis=1)]
+    orthogonal = np.cross(vectors, axes)
+    return orthogonal/np.linalg.norm(orthogonal, axis=1)[:,None]
+
+  def computeRotationMinimizingFrames(self, centerlinePolyData):
+    """ tangent and normal of the rotation minimizing frame at every centerline point, computed with the double reflection 
+    method (Wang et al. 2008) for all cells at once. Unlike the Frenet frame the frame is defined on straight segments and 
+    does not flip at inflection points. The tangents point along the cells. The frames are reused as long as the centerline 
+    is not modified. returns two arrays of shape (number of points,3)
+    """
+    import ClipBranches
+    centerlineData = ClipBranches.CenterlineData.get(centerlinePolyData)
+    if 'RotationMinimizingFrames' in centerlineData.derived:
+      return centerlineData.derived['RotationMinimizingFrames']
+
+    offsets = centerlineData.offsets
+    connectivity = centerlineData.connectivity
+    numberOfPoints = centerlineData.points.shape[0]
+    numberOfEntries = connectivity.shape[0]
+    cellSizes = np.diff(offsets)
+    entryCellIds = np.repeat(np.arange(cellSizes.shape[0]), cellSizes)
+    cellStarts = offsets[:-1][entryCellIds]
+    cellEnds = offsets[1:][entryCellIds] - 1
+    entries = np.arange(numberOfEntries)
+    points = centerlineData.points[connectivity]
+
+    # tangents by central differences within the cells, one-sided at the cell ends
+    tangents = points[np.minimum(entries+1, cellEnds)] - points[np.maximum(entries-1, cellStarts)]
+    tangentNorms = np.linalg.norm(tangents, axis=1)
+    tangents[tangentNorms < 1e-12] = (1.0, 0.0, 0.0)
+    tangents /= np.linalg.norm(tangents, axis=1)[:,None]
+
+    # the normal of the next point is the normal of the point reflected twice: in the plane bisecting the segment and in the 
+    # plane bisecting the reflected and the next tangent. Both reflections are linear, so the step is a 3x3 matrix
+    # and the normals are the cumulative matrix products along the cells applied to the initial normals
+    def reflections(v):
+      c = np.sum(v*v, axis=1)
+      c[c < 1e-24] = np.inf
+      return np.eye(3)[None,:,:] - (2.0/c)[:,None,None]*v[:,:,None]*v[:,None,:]
+    steps = np.tile(np.eye(3), (numberOfEntries,1,1))
+    hasPrevious = entries > cellStarts
+    (previous, current) = (entries[hasPrevious]-1, entries[hasPrevious])
+    firstReflections = reflections(points[current] - points[previous])
+    reflectedTangents = np.einsum('nij,nj->ni', firstReflections, tangents[previous])
+    steps[current] = reflections(tangents[current] - reflectedTangents) @ firstReflections
+
+    # segmented inclusive scan of the matrix products (Hillis-Steele), log2(longest cell) passes
+    products = steps
+    shift = 1
+    while shift < cellSizes.max(initial=0):
+      combine = entries - shift >= cellStarts
+      products[combine] = products[combine] @ products[entries[combine]-shift]
+      shift *= 2
+
+    initialNormals = self.orthogonalVectors(tangents[offsets[:-1][cellSizes > 0]])
+    cellInitialNormals = np.zeros((cellSizes.shape[0],3))
+    cellInitialNormals[cellSizes > 0] = initialNormals
+    normals = np.einsum('nij,nj->ni', products, cellInitialNormals[entryCellIds])
+    # remove the numerical drift
+    normals -= np.sum(normals*tangents, axis=1)[:,None]*tangents
+    normals /= np.linalg.norm(normals, axis=1)[:,None]
+
+    # points that are shared by cells get the frame of the cell they are assigned to
+    pointTangents = np.tile((1.0, 0.0, 0.0), (numberOfPoints,1))
+    pointNormals = np.tile((0.0, 1.0, 0.0), (numberOfPoints,1))
+    owned = entryCellIds == centerlineData.pointCellIds[connectivity]
+    pointTangents[connectivity[owned]] = tangents[owned]
+    pointNormals[connectivity[owned]] = normals[owned]
+
+    centerlineData.derived['RotationMinimizingFrames'] = (pointTangents, pointNormals)
+    return (pointTangents, pointNormals)
+
+  def computeROIFrames(self, centerlinePolyData, boxScale=1.5):
+    """ rigid transform (4x4, x axis along the centerline tangent) and size of the ROI box at every centerline point, 
+    computed in one pass and reused as long as the centerline is not modified. The box size is 2*boxScale*radius.
+    The boxes are oriented with the rotation minimizing frames, so they do not flip between neighbouring points.
+    returns arrays of shape (number of points,4,4) and (number of points,)
+    """
+    import ClipBranches
+    centerlineData = ClipBranches.CenterlineData.get(centerlinePolyData)
+    key = ('ROIFrames', boxScale)
+    if key in centerlineData.derived:
+      return centerlineData.derived[key]
+
+    numberOfPoints = centerlineData.points.shape[0]
+    (tangents, normals) = self.computeRotationMinimizingFrames(centerlinePolyData)
+
+    frames = np.zeros((numberOfPoints,4,4))
+    frames[:,:3,0] = tangents
+    frames[:,:3,1] = normals
+    frames[:,:3,2] = np.cross(tangents, normals)
+    frames[:,:3,3] = centerlineData.points
+    frames[:,3,3] = 1.0
+    sizes = 2*centerlineData.pointData['Radius']*boxScale
+
+    centerlineData.derived[key] = (frames, sizes)
+    return (frames, sizes)
+
+  def setROIFrame(self, roiNode, frame, size):
+    """ place the (cubic) ROI box with the 4x4 transform frame, e.g. one of the frames from computeROIFrames """
+    wasModified = roiNode.StartModify()
+    roiNode.SetAndObserveObjectToNodeMatrix(slicer.util.vtkMatrixFromArray(frame))
+    roiNode.SetSize(size,size,size)
+    roiNode.EndModify(wasModified)
+
   def alignPlanes(self,plane0Node,plane1Node, transformableNode=None):
     """ Align two planes through rigid registration of the center, normal, and one corner point.
     apply and harden the transform to planeNode1 and, if provided, an additional  nNode.
@@ -550,25 +968,17 @@ class OpenSurfaceLogic(ScriptedLoadableModuleLogic):
                                   np.subtract(plane1Node.GetOrigin(),plane1Node.GetNormal()),
                                   plane1Corners.GetPoint(0)])
     
-    # registration
-    import SimpleITK as sitk
-    
-    # use simpleITKs initializer to register the points
-    initializer = sitk.LandmarkBasedTransformInitializerFilter()
-    initializer.SetFixedLandmarks(fixedPointsArray.flatten()) # flatten the array as the initializer expects the point coordinates in one flat list [x1, y1, z1,x2,y2,z2, ...]
-    initializer.SetMovingLandmarks(movingPointsArray.flatten())
-    transform = initializer.Execute(sitk.VersorRigid3DTransform())
-    # convert/cast to derived interface to access transformation matrix
-    transform = sitk.VersorRigid3DTransform(transform)
-
-    # get 4x4 numpy array representing the transformation matrix
-    A = np.array(transform.GetMatrix()).reshape(3,3)
-    c = np.array(transform.GetCenter())
-    t = np.array(transform.GetTranslation())
+    # least squares rigid registration of the points (Kabsch) in closed form, the transform maps the fixed to the moving 
+    # points like a landmark registration and is applied as transform from parent
+    fixedCenter = fixedPointsArray.mean(axis=0)
+    movingCenter = movingPointsArray.mean(axis=0)
+    (u, _, vt) = np.linalg.svd((fixedPointsArray-fixedCenter).T @ (movingPointsArray-movingCenter))
+    reflection = np.diag([1.0, 1.0, np.sign(np.linalg.det(vt.T @ u.T))])
+    A = vt.T @ reflection @ u.T
     
     overall = np.eye(4)
     overall[0:3,0:3] = A
-    overall[0:3,3] = -np.dot(A,c)+t+c
+    overall[0:3,3] = movingCenter - np.dot(A,fixedCenter)
     
     matrix = slicer.util.vtkMatrixFromArray(overall)
     
@@ -589,16 +999,329 @@ class OpenSurfaceLogic(ScriptedLoadableModuleLogic):
     #remove transform node
     slicer.mrmlScene.RemoveNode(transformNode)
   
+  def getROIPlanes(self, roiNode):
+    """ implicit function of the ROI box in world coordinates, with the plane normals pointing outward 
+    (i.e. negative inside the box)
+    """
+    roiPlanes = vtk.vtkPlanes()
+    roiNode.GetPlanes(roiPlanes)
+    origins = np.array([roiPlanes.GetPlane(i).GetOrigin() for i in range(roiPlanes.GetNumberOfPlanes())])
+    normals = np.array([roiPlanes.GetPlane(i).GetNormal() for i in range(roiPlanes.GetNumberOfPlanes())])
+    # the opposite face of each face is the one with a parallel normal, flip the normals pointing to the opposite face
+    parallel = np.abs(normals @ normals.T) - 2*np.eye(len(normals))
+    opposite = np.argmax(parallel, axis=1)
+    normals[np.sum(normals*(origins - origins[opposite]), axis=1) < 0] *= -1
+
+    from vtk.util import numpy_support
+    points = vtk.vtkPoints()
+    points.SetData(numpy_support.numpy_to_vtk(origins, deep=True))
+    outwardPlanes = vtk.vtkPlanes()
+    outwardPlanes.SetPoints(points)
+    outwardPlanes.SetNormals(numpy_support.numpy_to_vtk(normals, deep=True))
+    return outwardPlanes
+
+  def clipROIFromPolyData(self, surfacePolyData, roiNode):
+    """ remove the part of the surface inside the ROI box, returns the clipped polydata
+    """
+    clipper = vtk.vtkClipPolyData()
+    clipper.SetInputData(surfacePolyData)
+    clipper.SetClipFunction(self.getROIPlanes(roiNode))
+    # keep the part outside the box
+    clipper.InsideOutOff()
+    clipper.Update()
+    return clipper.GetOutput()
+
   def clipROIFromModel(self,inputModelNode,inputROINode,outputModelNode):
-    """ Clip a model with a ROI
+    """ Clip a model with a ROI, the part of the model inside the ROI is removed. 
+    The input and output model can be the same node
+    """
+    clippedPolyData = self.clipROIFromPolyData(inputModelNode.GetPolyData(), inputROINode)
+    outputModelNode.SetAndObserveMesh(clippedPolyData)
+    if not outputModelNode.GetDisplayNode():
+      outputModelNode.CreateDefaultDisplayNodes()
+
+  def labelConnectedRegions(self, polyData):
+    """ label of the connected region of each point of the polydata, points of the same region have the same label 
+    (the smallest point id of the region). Vectorized union find: the regions of the cell edges are merged and the labels 
+    are compressed by pointer jumping until no edge connects two regions.
+    """
+    from vtk.util import numpy_support
+    numberOfPoints = polyData.GetNumberOfPoints()
+    labels = np.arange(numberOfPoints)
+    polys = polyData.GetPolys()
+    if numberOfPoints == 0 or polys.GetNumberOfCells() == 0:
+      return labels
+    offsets = numpy_support.vtk_to_numpy(polys.GetOffsetsArray())
+    connectivity = numpy_support.vtk_to_numpy(polys.GetConnectivityArray())
+
+    # edges between consecutive points of each cell, the last point is connected to the first
+    nextEntries = np.arange(1, connectivity.shape[0]+1)
+    nextEntries[offsets[1:]-1] = offsets[:-1]
+    edges = np.stack([connectivity, connectivity[nextEntries]], axis=1)
+
+    while True:
+      edgeLabels = labels[edges]
+      (lowLabels, highLabels) = (edgeLabels.min(axis=1), edgeLabels.max(axis=1))
+      merged = lowLabels != highLabels
+      if not np.any(merged):
+        return labels
+      # attach the region with the higher label to the lower one, then point every label to its root
+      np.minimum.at(labels, highLabels[merged], lowLabels[merged])
+      while True:
+        rootLabels = labels[labels]
+        if np.array_equal(rootLabels, labels):
+          break
+        labels = rootLabels
+
+  def computePlaneCut(self, centerlinePolyData, pointIndex):
+    """ origin and normal of the plane normal to the centerline (tangent) at pointIndex. The normal points to the 
+    closest end of the centerline, i.e. to the part of the vessel that is removed
+    """
+    import ClipBranches
+    centerlineData = ClipBranches.CenterlineData.get(centerlinePolyData)
+    cellPointIds = centerlineData.getCellPointIds(centerlineData.getPointCellId(pointIndex))
+    cellPoints = centerlineData.points[cellPointIds]
+    index = int(np.nonzero(cellPointIds == pointIndex)[0][0])
+
+    # the tangent points along the centerline, orient the normal to the closest end
+    normal = np.array(self.computeRotationMinimizingFrames(centerlinePolyData)[0][pointIndex])
+    arcLength = np.concatenate([[0.0], np.cumsum(np.linalg.norm(np.diff(cellPoints, axis=0), axis=1))])
+    if arcLength[index] < arcLength[-1]/2:
+      normal = -normal
+    return (np.array(centerlinePolyData.GetPoint(pointIndex)), normal)
+
+  def clipPlaneFromPolyData(self, surfacePolyData, centerlinePolyData, pointIndex):
+    """ open the surface with the plane normal to the centerline at pointIndex. Only the region beyond the plane that is 
+    connected to the cut at the centerline point is removed, neighbouring vessels that cross the plane are kept.
+    returns the opened polydata
+    """
+    from vtk.util import numpy_support
+    (origin, normal) = self.computePlaneCut(centerlinePolyData, pointIndex)
+    plane = vtk.vtkPlane()
+    plane.SetOrigin(origin)
+    plane.SetNormal(normal)
+
+    # split the surface in the part beyond the plane (output) and the part before the plane (clipped output)
+    clipper = vtk.vtkClipPolyData()
+    clipper.SetInputData(surfacePolyData)
+    clipper.SetClipFunction(plane)
+    clipper.InsideOutOff()
+    clipper.GenerateClippedOutputOn()
+    clipper.Update()
+    beyondPolyData = clipper.GetOutput()
+    if beyondPolyData.GetNumberOfPoints() == 0:
+      return clipper.GetClippedOutput()
+
+    # the region to remove contains the point on the cut closest to the centerline point
+    labels = self.labelConnectedRegions(beyondPolyData)
+    points = numpy_support.vtk_to_numpy(beyondPolyData.GetPoints().GetData())
+    distances = np.linalg.norm(points - origin, axis=1)
+    cutPointIds = np.nonzero(np.abs((points - origin) @ normal) < 1e-6*max(1.0, distances.max()))[0]
+    if cutPointIds.shape[0] == 0:
+      cutPointIds = np.arange(points.shape[0])
+    removedLabel = labels[cutPointIds[np.argmin(distances[cutPointIds])]]
+
+    # keep the other regions beyond the plane
+    regionPolyData = vtk.vtkPolyData()
+    regionPolyData.ShallowCopy(beyondPolyData)
+    removedArray = numpy_support.numpy_to_vtk((labels == removedLabel).astype(np.uint8), deep=True)
+    removedArray.SetName('RemovedRegion')
+    regionPolyData.GetPointData().AddArray(removedArray)
+    threshold = vtk.vtkThreshold()
+    threshold.SetInputData(regionPolyData)
+    threshold.SetInputArrayToProcess(0, 0, 0, vtk.vtkDataObject.FIELD_ASSOCIATION_POINTS, 'RemovedRegion')
+    threshold.SetLowerThreshold(-0.5)
+    threshold.SetUpperThreshold(0.5)
+    threshold.SetThresholdFunction(vtk.vtkThreshold.THRESHOLD_BETWEEN)
+    threshold.AllScalarsOn()
+    geometryFilter = vtk.vtkGeometryFilter()
+    geometryFilter.SetInputConnection(threshold.GetOutputPort())
+
+    # join with the part before the plane (the RemovedRegion array is dropped, it is not in both inputs)
+    append = vtk.vtkAppendPolyData()
+    append.AddInputData(clipper.GetClippedOutput())
+    append.AddInputConnection(geometryFilter.GetOutputPort())
+    cleaner = vtk.vtkCleanPolyData()
+    cleaner.SetInputConnection(append.GetOutputPort())
+    cleaner.Update()
+    return cleaner.GetOutput()
+
+  def clipPlaneFromModel(self, inputModelNode, centerlineModelNode, pointIndex, outputModelNode):
+    """ open a model with the plane normal to the centerline at pointIndex (see clipPlaneFromPolyData). 
+    The input and output model can be the same node
+    """
+    openedPolyData = self.clipPlaneFromPolyData(inputModelNode.GetPolyData(), centerlineModelNode.GetPolyData(), pointIndex)
+    outputModelNode.SetAndObserveMesh(openedPolyData)
+    if not outputModelNode.GetDisplayNode():
+      outputModelNode.CreateDefaultDisplayNodes()
+
+  def computeCenterlineCuts(self, centerlinePolyData, cutSpecifications):
+    """ position, direction and radius of cuts along the centerlines, computed in one pass for all cuts.
+    :param cutSpecifications: list of (centerline id, position). A position >= 0 is the abscissa from the start of the 
+    centerline (cell), a position < 0 the distance from its end.
+    returns the cut origins (n,3), the directions (n,3) pointing to the closest end of the centerline, i.e. to the part 
+    of the vessel that is removed, and the radii (n,)
+    """
+    import ClipBranches
+    centerlineData = ClipBranches.CenterlineData.get(centerlinePolyData)
+    cellIds = np.array([cutSpecification[0] for cutSpecification in cutSpecifications], dtype=np.int64)
+    positions = np.array([cutSpecification[1] for cutSpecification in cutSpecifications], dtype=float)
+
+    # arc length along all the centerlines, the segments between consecutive centerlines have zero length
+    points = centerlineData.points[centerlineData.connectivity]
+    radii = centerlineData.pointData['Radius'][centerlineData.connectivity]
+    segmentLengths = np.linalg.norm(np.diff(points, axis=0), axis=1)
+    segmentLengths[centerlineData.offsets[1:-1]-1] = 0.0
+    arcLength = np.concatenate([[0.0], np.cumsum(segmentLengths)])
+
+    starts = centerlineData.offsets[cellIds]
+    ends = centerlineData.offsets[cellIds+1]-1
+    cellLengths = arcLength[ends] - arcLength[starts]
+    abscissas = np.clip(np.where(positions >= 0, positions, cellLengths + positions), 0.0, cellLengths)
+
+    # interpolate on the segment that contains the cut
+    cutArcLength = arcLength[starts] + abscissas
+    segmentEnds = np.clip(np.searchsorted(arcLength, cutArcLength, side='left'), starts+1, ends)
+    segmentStarts = segmentEnds - 1
+    weights = np.clip((cutArcLength - arcLength[segmentStarts])/np.maximum(arcLength[segmentEnds] - arcLength[segmentStarts], 1e-12), 0.0, 1.0)
+    origins = points[segmentStarts] + weights[:,None]*(points[segmentEnds] - points[segmentStarts])
+    cutRadii = radii[segmentStarts] + weights*(radii[segmentEnds] - radii[segmentStarts])
+
+    # direction of the segment, or of the whole centerline for degenerate segments, pointing to the closest end
+    directions = points[segmentEnds] - points[segmentStarts]
+    degenerate = np.linalg.norm(directions, axis=1) < 1e-12
+    directions[degenerate] = points[ends[degenerate]] - points[starts[degenerate]]
+    directions /= np.maximum(np.linalg.norm(directions, axis=1), 1e-12)[:,None]
+    directions[abscissas < cellLengths/2] *= -1
+
+    return (origins, directions, cutRadii)
+
+  def getEndCutSpecifications(self, centerlinePolyData, distance=2.0, distanceInRadii=False):
+    """ cut specifications (see computeCenterlineCuts) to open every inlet and outlet at a distance from the end of the 
+    centerlines. If distanceInRadii is set the distance is a multiple of the radius at the end point.
+    Ends shared by several centerlines (e.g. the inlet) are only cut once.
+    """
+    import ClipBranches
+    centerlineData = ClipBranches.CenterlineData.get(centerlinePolyData)
+    startPointIds = centerlineData.connectivity[centerlineData.offsets[:-1]]
+    endPointIds = centerlineData.connectivity[centerlineData.offsets[1:]-1]
+    cutSpecifications = []
+    for (pointIds, sign) in [(startPointIds, 1.0), (endPointIds, -1.0)]:
+      # first centerline of each distinct end point
+      (_, cellIds) = np.unique(np.round(centerlineData.points[pointIds], 6), axis=0, return_index=True)
+      for cellId in np.sort(cellIds):
+        endDistance = distance*centerlineData.pointData['Radius'][pointIds[cellId]] if distanceInRadii else distance
+        cutSpecifications.append((int(cellId), sign*float(endDistance)))
+    return cutSpecifications
+
+  def createCutFunction(self, origins, directions, radii, boxScale=1.5):
+    """ implicit function of the union of the cut boxes, negative inside the boxes. Each box starts at the cut plane and 
+    extends 2*boxScale*radius in the cut direction and boxScale*radius to the sides, so the opening is at the cut plane.
+    """
+    # lateral axes of the boxes
+    axes = np.eye(3)[np.argmin(np.abs(directions), axis=1)]
+    lateral0 = np.cross(directions, axes)
+    lateral0 /= np.linalg.norm(lateral0, axis=1)[:,None]
+    lateral1 = np.cross(directions, lateral0)
+    halfSizes = (boxScale*np.asarray(radii))[:,None]
+
+    # six planes per box with outward normals
+    planeOrigins = np.stack([origins, origins + 2*halfSizes*directions, origins + halfSizes*lateral0, origins - halfSizes*lateral0,
+                             origins + halfSizes*lateral1, origins - halfSizes*lateral1], axis=1)
+    planeNormals = np.stack([-directions, directions, lateral0, -lateral0, lateral1, -lateral1], axis=1)
+    return self.createBoxUnionFunction(planeOrigins, planeNormals)
+
+  def createBoxUnionFunction(self, planeOrigins, planeNormals):
+    """ implicit function of the union of boxes, negative inside the boxes. 
+    planeOrigins and planeNormals (outward) are arrays of shape (number of boxes,6,3)
     """
-    dynamicModelerNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLDynamicModelerNode")
-    dynamicModelerNode.SetHideFromEditors(1)
-    dynamicModelerNode.SetToolName("ROI cut")
-    dynamicModelerNode.SetNodeReferenceID("ROICut.InputModel", inputModelNode.GetID())
-    dynamicModelerNode.SetNodeReferenceID("ROICut.InputROI", inputROINode.GetID())
-    dynamicModelerNode.SetNodeReferenceID("ROICut.OutputNegativeModel", outputModelNode.GetID())
-    slicer.modules.dynamicmodeler.logic().RunDynamicModelerTool(dynamicModelerNode)
+    from vtk.util import numpy_support
+    boxFunction = vtk.vtkImplicitBoolean()
+    boxFunction.SetOperationTypeToUnion()
+    for (boxPlaneOrigins, boxPlaneNormals) in zip(planeOrigins, planeNormals):
+      points = vtk.vtkPoints()
+      points.SetData(numpy_support.numpy_to_vtk(boxPlaneOrigins, deep=True))
+      boxPlanes = vtk.vtkPlanes()
+      boxPlanes.SetPoints(points)
+      boxPlanes.SetNormals(numpy_support.numpy_to_vtk(boxPlaneNormals, deep=True))
+      boxFunction.AddFunction(boxPlanes)
+    return boxFunction
+
+  def getCutPointIndices(self, centerlinePolyData, cutPositions):
+    """ centerline point indices of the cut positions, which are point indices or (x,y,z) coordinates 
+    that are snapped to the closest centerline point
+    """
+    pointIndices = np.zeros(len(cutPositions), dtype=np.int64)
+    isIndex = np.array([np.isscalar(cutPosition) for cutPosition in cutPositions], dtype=bool)
+    if np.any(isIndex):
+      pointIndices[isIndex] = [int(cutPosition) for cutPosition in cutPositions if np.isscalar(cutPosition)]
+    if not np.all(isIndex):
+      positions = np.array([cutPosition for cutPosition in cutPositions if not np.isscalar(cutPosition)], dtype=float)
+      pointIndices[~isIndex] = self.findClosestCenterlinePoints(centerlinePolyData, positions)
+    return pointIndices
+
+  def openSurface(self, surfacePolyData, centerlinePolyData, cutPositions, boxScale=1.5):
+    """ open the surface with a ROI box normal to the centerline at each of the cut positions, the same boxes as placed 
+    interactively in the widget. The boxes are removed in a single clipping pass. 
+    cutPositions are centerline point indices or (x,y,z) coordinates, which are snapped to the closest centerline point.
+    Does not use the scene, so it can be used in batch scripts and worker processes. returns the opened polydata
+    """
+    pointIndices = self.getCutPointIndices(centerlinePolyData, cutPositions)
+    if pointIndices.shape[0] == 0:
+      openedPolyData = vtk.vtkPolyData()
+      openedPolyData.ShallowCopy(surfacePolyData)
+      return openedPolyData
+    (frames, sizes) = self.computeROIFrames(centerlinePolyData, boxScale)
+    (frames, halfSizes) = (frames[pointIndices], sizes[pointIndices,None]/2)
+
+    # six planes per box with outward normals, the box axes are the columns of the frames
+    (centers, axes) = (frames[:,:3,3], np.transpose(frames[:,:3,:3], (0,2,1)))
+    planeNormals = np.concatenate([axes, -axes], axis=1)
+    planeOrigins = centers[:,None,:] + halfSizes[:,:,None]*planeNormals
+
+    clipper = vtk.vtkClipPolyData()
+    clipper.SetInputData(surfacePolyData)
+    clipper.SetClipFunction(self.createBoxUnionFunction(planeOrigins, planeNormals))
+    # keep the part outside the boxes
+    clipper.InsideOutOff()
+    clipper.Update()
+    return clipper.GetOutput()
+
+  def clipSurfaceAtCenterlineCuts(self, surfacePolyData, centerlinePolyData, cutSpecifications, boxScale=1.5):
+    """ open the surface at all the cuts (see computeCenterlineCuts) in a single clipping pass. The parts beyond the cuts 
+    that are no longer connected to the vessel are removed, only the largest connected region is kept.
+    """
+    (origins, directions, radii) = self.computeCenterlineCuts(centerlinePolyData, cutSpecifications)
+    if origins.shape[0] == 0:
+      return surfacePolyData
+
+    clipper = vtk.vtkClipPolyData()
+    clipper.SetInputData(surfacePolyData)
+    clipper.SetClipFunction(self.createCutFunction(origins, directions, radii, boxScale))
+    # keep the part outside the boxes
+    clipper.InsideOutOff()
+
+    connectivityFilter = vtk.vtkPolyDataConnectivityFilter()
+    connectivityFilter.SetInputConnection(clipper.GetOutputPort())
+    connectivityFilter.SetExtractionModeToLargestRegion()
+
+    # remove the points of the discarded regions
+    cleaner = vtk.vtkCleanPolyData()
+    cleaner.SetInputConnection(connectivityFilter.GetOutputPort())
+    cleaner.PointMergingOff()
+    cleaner.Update()
+    return cleaner.GetOutput()
+
+  def openEnds(self, inputModelNode, centerlineModelNode, outputModelNode, distance=2.0, distanceInRadii=False):
+    """ open all the inlets and outlets of the model at a distance from the end of the centerlines. 
+    The input and output model can be the same node
+    """
+    centerlinePolyData = centerlineModelNode.GetPolyData()
+    cutSpecifications = self.getEndCutSpecifications(centerlinePolyData, distance, distanceInRadii)
+    openedPolyData = self.clipSurfaceAtCenterlineCuts(inputModelNode.GetPolyData(), centerlinePolyData, cutSpecifications)
+    outputModelNode.SetAndObserveMesh(openedPolyData)
+    if not outputModelNode.GetDisplayNode():
+      outputModelNode.CreateDefaultDisplayNodes()
 
 
 #
@@ -622,6 +1345,7 @@ class OpenSurfaceTest(ScriptedLoadableModuleTest):
     """
     self.setUp()
     self.test_OpenSurface1()
+    self.test_ClipHistory()
 
   def test_OpenSurface1(self):
     """ Ideally you should have several levels of tests.  At the lowest level
@@ -668,3 +1392,63 @@ class OpenSurfaceTest(ScriptedLoadableModuleTest):
     self.assertEqual(outputScalarRange[1], inputScalarRange[1])
 
     self.delayDisplay('Test passed')
+
+  def test_ClipHistory(self):
+    """ the surfaces reconstructed by undo and redo should be the same as the clipped surfaces, also after a clip 
+    following an undo
+    """
+    self.delayDisplay("Starting the clip history test")
+
+    sphere = vtk.vtkSphereSource()
+    sphere.SetThetaResolution(32)
+    sphere.SetPhiResolution(32)
+    sphere.Update()
+    history = ClipHistory(sphere.GetOutput())
+
+    def clip(polyData, origin, normal):
+      plane = vtk.vtkPlane()
+      plane.SetOrigin(origin)
+      plane.SetNormal(normal)
+      clipper = vtk.vtkClipPolyData()
+      clipper.SetInputData(polyData)
+      clipper.SetClipFunction(plane)
+      clipper.Update()
+      clippedPolyData = vtk.vtkPolyData()
+      clippedPolyData.DeepCopy(clipper.GetOutput())
+      return clippedPolyData
+
+    def summary(polyData):
+      # the cuts create quads, the area is computed on triangles
+      triangleFilter = vtk.vtkTriangleFilter()
+      triangleFilter.SetInputData(polyData)
+      massProperties = vtk.vtkMassProperties()
+      massProperties.SetInputConnection(triangleFilter.GetOutputPort())
+      massProperties.Update()
+      return (polyData.GetNumberOfCells(), massProperties.GetSurfaceArea())
+
+    def assertSameSurface(polyData, expectedPolyData):
+      (numberOfCells, area) = summary(polyData)
+      (expectedNumberOfCells, expectedArea) = summary(expectedPolyData)
+      self.assertEqual(numberOfCells, expectedNumberOfCells)
+      self.assertAlmostEqual(area, expectedArea, places=9)
+
+    firstClip = clip(history.getCurrentPolyData(), (0.0, 0.0, 0.2), (0.0, 0.0, 1.0))
+    history.push(firstClip)
+    secondClip = clip(history.getCurrentPolyData(), (0.1, 0.0, 0.0), (-1.0, 0.0, 0.0))
+    history.push(secondClip)
+
+    assertSameSurface(history.undo(), firstClip)
+    assertSameSurface(history.redo(), secondClip)
+    assertSameSurface(history.undo(), firstClip)
+    assertSameSurface(history.undo(), sphere.GetOutput())
+    self.assertFalse(history.canUndo())
+
+    # a clip after an undo discards the undone steps
+    assertSameSurface(history.redo(), firstClip)
+    otherClip = clip(history.getCurrentPolyData(), (0.0, -0.1, 0.0), (0.0, 1.0, 0.0))
+    assertSameSurface(history.push(otherClip), otherClip)
+    self.assertFalse(history.canRedo())
+    assertSameSurface(history.undo(), firstClip)
+    assertSameSurface(history.redo(), otherClip)
+
+    self.delayDisplay('Test passed')
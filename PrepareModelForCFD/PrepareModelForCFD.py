@@ -80,6 +80,7 @@ class PrepareModelForCFDWidget(ScriptedLoadableModuleWidget, VTKObservationMixin
     self.ui.openModelButton.connect('clicked(bool)', self.onOpenModelButton)
     self.ui.addFlowExtensionsButton.connect('clicked(bool)', self.onAddFlowExtensionsButton)
     self.ui.exportModelButton.connect('clicked(bool)', self.onExportModelButton)
+    self.ui.exportPatchesButton.connect('clicked(bool)', self.onExportPatchesButton)
     # Connections
 
     # These connections ensure that we update parameter node when scene is closed
@@ -400,6 +401,20 @@ class PrepareModelForCFDWidget(ScriptedLoadableModuleWidget, VTKObservationMixin
   def onExportModelButton(self):
     """ export models """
     slicer.util.openSaveDataDialog()    
+
+  def onExportPatchesButton(self):
+    """ export the wall and caps of the capped model as STL patches for meshing """
+    modelNode = self.ui.exportModelSelector.currentNode()
+    if not modelNode:
+      slicer.util.errorDisplay("Select the capped model to export")
+      return
+    filePath = qt.QFileDialog.getSaveFileName(None, "Export for meshing", modelNode.GetName()+".stl", "STL files (*.stl)")
+    if not filePath:
+      return
+    with slicer.util.tryWithErrorDisplay("Failed to export model.", waitCursor=True):
+      import AddFlowExtension
+      filePaths = AddFlowExtension.AddFlowExtensionLogic().exportPatchesSTL(modelNode.GetPolyData(), filePath, self.ui.separatePatchFilesCheckBox.checked)
+      logging.info("Exported " + ", ".join(filePaths))
     
   def showSingleModule(self, singleModule=True, toggle=False):
 